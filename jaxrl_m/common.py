@@ -6,9 +6,30 @@ import jax.numpy as jnp
 from jax import tree_util
 import optax
 import functools
+import collections
 
 nonpytree_field = functools.partial(flax.struct.field, pytree_node=False)
 
+# Number of times each `count_traces`-decorated function has been traced (i.e. compiled) in this process.
+trace_counts = collections.Counter()
+
+
+def count_traces(name):
+    """
+    Counts traces of the decorated function in `trace_counts[name]`. Place it under `jax.jit`:
+    the Python body only runs while tracing, so the count is the number of compilations.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapped(*args, **kwargs):
+            trace_counts[name] += 1
+            return fn(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
+
 
 def shard_batch(batch):
     d = jax.local_device_count()
@@ -1,3 +1,4 @@
+import os
 import numpy as np
 from jaxrl_m.typing import Data, Array
 from flax.core.frozen_dict import FrozenDict
@@ -72,6 +73,164 @@ class Dataset(FrozenDict):
         return tree_util.tree_map(lambda arr: arr[indx], self._dict)
 
 
+class MemmapDataset(Dataset):
+    """
+    Dataset backed by a directory of `.npy` files that are memory-mapped read-only.
+
+    Processes that load the same directory share the OS page cache instead of each holding
+    a private copy. Columns can be attached without copying the existing ones, and optionally
+    persisted to the directory so that other processes can map them as well.
+
+    Example:
+        MemmapDataset.save(dataset, 'cache/antmaze')
+        dataset = MemmapDataset.load('cache/antmaze')
+        dataset = dataset.add_column('rep_observations', rep_observations)
+        batch = dataset.sample(32)
+    """
+
+    directory = None
+
+    @classmethod
+    def save(cls, data: Data, directory: str):
+        """Writes every array leaf as `<directory>/<key>.npy` (nested dicts become subdirectories)."""
+        os.makedirs(directory, exist_ok=True)
+        for k, v in data.items():
+            if v is None:
+                continue
+            if hasattr(v, "items"):
+                cls.save(v, os.path.join(directory, k))
+            else:
+                np.save(os.path.join(directory, f"{k}.npy"), np.asarray(v))
+
+    @classmethod
+    def load(cls, directory: str, fields=None, mmap_mode="r"):
+        def load_dir(path):
+            data = {}
+            for name in sorted(os.listdir(path)):
+                full_path = os.path.join(path, name)
+                if name.endswith(".npy"):
+                    data[name[:-4]] = np.load(full_path, mmap_mode=mmap_mode)
+                elif os.path.isdir(full_path) and not name.startswith("."):
+                    data[name] = load_dir(full_path)
+            return data
+
+        data = load_dir(directory)
+        if fields is not None:
+            data = {k: data[k] for k in fields}
+        dataset = cls(data)
+        dataset.directory = directory
+        return dataset
+
+    def add_column(self, name: str, array: Array, persist: bool = False):
+        """
+        Returns a dataset with `name` attached; existing columns are shared, not copied.
+        With `persist=True` the column is written to the directory and re-opened as a memory map.
+        """
+        if persist:
+            assert self.directory is not None, "persist=True needs a dataset loaded from a directory"
+            path = os.path.join(self.directory, f"{name}.npy")
+            np.save(path, np.asarray(array))
+            array = np.load(path, mmap_mode="r")
+        dataset = self.copy({name: array})
+        dataset.directory = self.directory
+        return dataset
+
+
+class CompactDataset(Dataset):
+    """
+    Dataset that stores `observations` once instead of keeping a full `next_observations` copy.
+
+    For almost every row `next_observations[i] == observations[i + 1]`; only the rows where this does
+    not hold (episode ends) keep their successor, in `successor_locs` / `terminal_successors`.
+    `get_subset` resolves `next_observations` per batch. `dataset['next_observations']` is a
+    `NextObservationsView` that only resolves the rows it is indexed with; converting the whole
+    column to an array raises, so use `get_next_observations(indx)` or index the view.
+
+    Example:
+        dataset = CompactDataset.compress(dataset)
+        batch = dataset.sample(32)  # batch['next_observations'] is filled in as usual
+    """
+
+    compact_keys = ("successor_locs", "terminal_successors")
+
+    @classmethod
+    def compress(cls, dataset: Data, chunk_size: int = 100000):
+        observations = dataset["observations"]
+        next_observations = dataset["next_observations"]
+        size = len(observations)
+
+        is_successor = np.zeros(size, dtype=bool)
+        for start in range(0, size - 1, chunk_size):
+            end = min(start + chunk_size, size - 1)
+            is_successor[start:end] = np.all(observations[start + 1:end + 1] == next_observations[start:end], axis=tuple(range(1, observations.ndim)))
+        successor_locs = np.flatnonzero(~is_successor)
+
+        data = {k: v for k, v in dataset.items() if k != "next_observations"}
+        data["successor_locs"] = successor_locs
+        data["terminal_successors"] = np.asarray(next_observations[successor_locs])
+        return cls(data)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.size = len(self._dict["observations"])
+
+    def __contains__(self, key):
+        return key == "next_observations" or super().__contains__(key)
+
+    def __getitem__(self, key):
+        if key == "next_observations":
+            return NextObservationsView(self)
+        return super().__getitem__(key)
+
+    def get_next_observations(self, indx):
+        indx = np.asarray(indx)
+        successor_locs = self._dict["successor_locs"]
+        pos = np.minimum(np.searchsorted(successor_locs, indx), len(successor_locs) - 1)
+        is_terminal = successor_locs[pos] == indx
+        next_observations = self._dict["observations"][np.minimum(indx + 1, self.size - 1)]
+        next_observations[is_terminal] = self._dict["terminal_successors"][pos[is_terminal]]
+        return next_observations
+
+    def get_subset(self, indx):
+        indx = np.asarray(indx)
+        data = {k: v for k, v in self._dict.items() if k not in self.compact_keys}
+        batch = tree_util.tree_map(lambda arr: arr[indx], data)
+        batch["next_observations"] = self.get_next_observations(indx)
+        return batch
+
+
+class NextObservationsView:
+    """
+    `CompactDataset['next_observations']`: rows are resolved on indexing (`view[indx]`, any NumPy index).
+
+    Whole-column conversion (`np.asarray(view)`) raises instead of silently building the N x d array.
+    """
+
+    def __init__(self, dataset: CompactDataset):
+        self.dataset = dataset
+
+    @property
+    def shape(self):
+        return self.dataset._dict["observations"].shape
+
+    @property
+    def dtype(self):
+        return self.dataset._dict["observations"].dtype
+
+    def __len__(self):
+        return self.dataset.size
+
+    def __getitem__(self, indx):
+        if isinstance(indx, tuple):
+            return self[indx[0]][(slice(None), *indx[1:])]
+        if isinstance(indx, (int, np.integer)):
+            return self.dataset.get_next_observations(np.array([indx]))[0]
+        return self.dataset.get_next_observations(np.arange(self.dataset.size)[indx])
+
+    def __array__(self, dtype=None):
+        raise TypeError("CompactDataset does not store next_observations; use get_next_observations(indx) or index the view")
+
+
 class ReplayBuffer(Dataset):
     """
     Dataset where data is added to the buffer.
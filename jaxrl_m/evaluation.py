@@ -48,11 +48,65 @@ def kitchen_render(kitchen_env, wh=64):
     img = camera.render()
     return img
 
+def eval_goal_schedule(env_name):
+    """Dimensions used for the subgoal distance check and the subgoal refresh interval of `env_name`."""
+    if 'antmaze' in env_name:
+        return np.arange(2), 10
+    elif 'kitchen' in env_name:
+        return np.arange(9), 6
+    elif 'calvin' in env_name:
+        return np.arange(15), 3
+    else:
+        raise NotImplementedError
+
+def reset_with_goal(env, env_name, base_observation):
+    """Resets `env` and returns the first observation together with the evaluation goal observation."""
+    observation = env.reset()
+    if 'antmaze' in env_name:
+        goal = env.wrapped_env.target_goal
+        obs_goal = base_observation.copy()
+        obs_goal[:2] = goal
+    elif 'kitchen' in env_name:
+        observation, obs_goal = observation[:30], observation[30:]
+        obs_goal[:9] = base_observation[:9]
+    elif 'calvin' in env_name:
+        observation = observation['ob']
+        goal = np.array([0.25, 0.15, 0, 0.088, 1, 1])
+        obs_goal = base_observation.copy()
+        obs_goal[15:21] = goal
+    else:
+        raise NotImplementedError
+    return observation, obs_goal
+
+def env_step(env, env_name, action):
+    if 'antmaze' in env_name:
+        next_observation, r, done, info = env.step(action)
+    elif 'kitchen' in env_name:
+        next_observation, r, done, info = env.step(action)
+        next_observation = next_observation[:30]
+    elif 'calvin' in env_name:
+        next_observation, r, done, info = env.step({'ac': np.array(action)})
+        next_observation = next_observation['ob']
+        del info['robot_info']
+        del info['scene_info']
+    return next_observation, r, done, info
+
+def render_frame(env, env_name):
+    if 'antmaze' in env_name:
+        size = 500
+        return env.render(mode='rgb_array', width=size, height=size).transpose(2, 0, 1).copy()
+    elif 'kitchen' in env_name:
+        return kitchen_render(env, wh=200).transpose(2, 0, 1)
+    elif 'calvin' in env_name:
+        return env.render(mode='rgb_array').transpose(2, 0, 1)
+
 def evaluate_with_trajectories(
         policy_fn, high_policy_fn, encoder_fn, decoder_fn, value_goal_fn, env: gym.Env, env_name, num_episodes: int, base_observation=None, num_video_episodes=0,
         eval_temperature=0, epsilon=0, 
-        config=None, find_key_node = None, FLAGS = None
+        config=None, find_key_node = None, FLAGS = None, ask_policy = None, plan_subgoal = None
 ) -> Dict[str, float]:
+    # ask_policy: ASKPolicy (src/ask_policy.py)가 주어지면 step마다 하나의 jit 함수로 subgoal / key node / action 계산
+    # plan_subgoal: KeyNode.plan_subgoal (transition graph 최단경로의 다음 key node)이 주어지면 도달 가능할 때 subgoal로 사용
     trajectories = []
     stats = defaultdict(list)
 
@@ -60,28 +114,10 @@ def evaluate_with_trajectories(
     rep_trajectories = []
     for i in tqdm.tqdm(range(num_episodes + num_video_episodes), desc="evaluate_with_trajectories"):
         trajectory = defaultdict(list)
-        observation, done = env.reset(), False
         # Set goal
-        if 'antmaze' in env_name:
-            goal = env.wrapped_env.target_goal
-            obs_goal = base_observation.copy()
-            obs_goal[:2] = goal
-            node_dim = np.arange(2)
-            interval, min_dist = 10, 4
-        elif 'kitchen' in env_name:
-            observation, obs_goal = observation[:30], observation[30:]
-            obs_goal[:9] = base_observation[:9]
-            node_dim = np.arange(9)
-            interval, min_dist = 6, 3.0
-        elif 'calvin' in env_name:
-            observation = observation['ob']
-            goal = np.array([0.25, 0.15, 0, 0.088, 1, 1])
-            obs_goal = base_observation.copy()
-            obs_goal[15:21] = goal
-            node_dim = np.arange(15)
-            interval, min_dist = 3, 2.0 
-        else:
-            raise NotImplementedError
+        observation, obs_goal = reset_with_goal(env, env_name, base_observation)
+        node_dim, interval = eval_goal_schedule(env_name)
+        done = False
         
         render = []
         rep_trajectory = []
@@ -95,76 +131,90 @@ def evaluate_with_trajectories(
         
         cos_distances = []
         
-        if FLAGS.use_rep == "vae_encoder":
+        if ask_policy is not None:
+            policy_state = ask_policy.reset(observation, obs_goal)
+        elif FLAGS.use_rep == "vae_encoder":
             obs_goal,_ ,_ = encoder_fn(observation=obs_goal)
         elif FLAGS.use_rep in ["hilp_subgoal_encoder", "hilp_encoder"]:
             obs_goal =  encoder_fn(observations=jnp.expand_dims(obs_goal, axis=0))[0]
             
         while not done:
-            if FLAGS.use_rep == "vae_encoder" :
-                observation,_ ,_ = encoder_fn(observation=observation)
-            elif FLAGS.use_rep == "hilp_encoder" :
-                observation =  encoder_fn(observations=jnp.expand_dims(observation, axis=0))[0]
+            if ask_policy is not None:
+                action, policy_state, policy_info = ask_policy(policy_state, observation)
+                observation, cur_obs_delta = policy_info['observation'], policy_info['cur_obs_delta']
+                h_step, dist = policy_info['h_step'], policy_info['dist']
+                h_steps.append(h_step)
+                dists.append(dist)
+                if 'cos_distance' in policy_info:
+                    cos_distances.append(policy_info['cos_distance'])
+            else:
+                if FLAGS.use_rep == "vae_encoder" :
+                    observation,_ ,_ = encoder_fn(observation=observation)
+                elif FLAGS.use_rep == "hilp_encoder" :
+                    observation =  encoder_fn(observations=jnp.expand_dims(observation, axis=0))[0]
                 
-            if h_step == interval or dist < init_dist * 0.5:
-                cur_obs_subgoal = high_policy_fn(observations=observation, goals=obs_goal, temperature=eval_temperature)
-                if FLAGS.use_rep in ["hiql_goal_encoder", "vae_encoder"]:
-                    if FLAGS.rep_normalizing_On:
-                       cur_obs_subgoal = cur_obs_subgoal / np.linalg.norm(cur_obs_subgoal, axis=-1, keepdims=True) * np.sqrt(cur_obs_subgoal.shape[-1])
+                if h_step == interval or dist < init_dist * 0.5:
+                    cur_obs_subgoal = high_policy_fn(observations=observation, goals=obs_goal, temperature=eval_temperature)
+                    if FLAGS.use_rep in ["hiql_goal_encoder", "vae_encoder"]:
+                        if FLAGS.rep_normalizing_On:
+                           cur_obs_subgoal = cur_obs_subgoal / np.linalg.norm(cur_obs_subgoal, axis=-1, keepdims=True) * np.sqrt(cur_obs_subgoal.shape[-1])
+                        else:
+                            cur_obs_subgoal = observation + cur_obs_subgoal
+                    elif FLAGS.use_rep in ["hilp_encoder", "hilp_subgoal_encoder"]: 
+                        cur_obs_subgoal = cur_obs_subgoal
                     else:
                         cur_obs_subgoal = observation + cur_obs_subgoal
-                elif FLAGS.use_rep in ["hilp_encoder", "hilp_subgoal_encoder"]: 
-                    cur_obs_subgoal = cur_obs_subgoal
-                else:
-                    cur_obs_subgoal = observation + cur_obs_subgoal
                     
-                if FLAGS.relative_dist_in_eval_On:
-                    if FLAGS.use_rep =="hilp_encoder":
-                        cur_obs_delta = observation
-                    elif FLAGS.use_rep =="hilp_subgoal_encoder":
-                        cur_obs_delta =  encoder_fn(observations=jnp.expand_dims(observation, axis=0))[0] # relative_dist_in_eval_On 구하기 위해 수행
-                    else:   
-                        cur_obs_delta = value_goal_fn(bases=observation, targets=obs_goal)
-                    init_dist = np.linalg.norm(cur_obs_subgoal - cur_obs_delta)
+                    if FLAGS.relative_dist_in_eval_On:
+                        if FLAGS.use_rep =="hilp_encoder":
+                            cur_obs_delta = observation
+                        elif FLAGS.use_rep =="hilp_subgoal_encoder":
+                            cur_obs_delta =  encoder_fn(observations=jnp.expand_dims(observation, axis=0))[0] # relative_dist_in_eval_On 구하기 위해 수행
+                        else:   
+                            cur_obs_delta = value_goal_fn(bases=observation, targets=obs_goal)
+                        init_dist = np.linalg.norm(cur_obs_subgoal - cur_obs_delta)
                     
-                cur_obs_goal = cur_obs_sub_goal = cur_obs_subgoal 
-                h_step = 0
+                    cur_obs_goal = cur_obs_sub_goal = cur_obs_subgoal 
+                    h_step = 0
             
-            if FLAGS.use_rep =="hilp_encoder":
-                    cur_obs_delta = observation
-            elif FLAGS.use_rep =="hilp_subgoal_encoder":
-                    cur_obs_delta =  encoder_fn(observations=jnp.expand_dims(observation, axis=0))[0] # relative_dist_in_eval_On 구하기 위해 수행
-            elif FLAGS.use_rep in ["hiql_goal_encoder","vae_encoder"]:          
-                cur_obs_delta = value_goal_fn(bases=observation, targets=obs_goal)
-                dist = np.linalg.norm(cur_obs_goal - cur_obs_delta) # "cur_obs_goal - cur_obs_delta" => "이전에 생성한 subgoal 위치(변화량) - 현재 obs 위치(변화량)"
-            else:
-                dist = np.linalg.norm(cur_obs_goal[node_dim] - observation[node_dim])
+                if FLAGS.use_rep =="hilp_encoder":
+                        cur_obs_delta = observation
+                elif FLAGS.use_rep =="hilp_subgoal_encoder":
+                        cur_obs_delta =  encoder_fn(observations=jnp.expand_dims(observation, axis=0))[0] # relative_dist_in_eval_On 구하기 위해 수행
+                elif FLAGS.use_rep in ["hiql_goal_encoder","vae_encoder"]:          
+                    cur_obs_delta = value_goal_fn(bases=observation, targets=obs_goal)
+                    dist = np.linalg.norm(cur_obs_goal - cur_obs_delta) # "cur_obs_goal - cur_obs_delta" => "이전에 생성한 subgoal 위치(변화량) - 현재 obs 위치(변화량)"
+                else:
+                    dist = np.linalg.norm(cur_obs_goal[node_dim] - observation[node_dim])
                                        
-            h_step +=1
-            h_steps.append(h_step)
-            dists.append(dist)
+                h_step +=1
+                h_steps.append(h_step)
+                dists.append(dist)
         
-            if config['use_keynode_in_eval_On']:
-                cos_distance, _, _, cur_obs_key_node = find_key_node(cur_obs_sub_goal)
-                if cos_distance >= FLAGS.mapping_threshold:
-                    diff_sub_goal_node = np.linalg.norm(cur_obs_key_node - cur_obs_sub_goal, axis=-1, keepdims=True)
-                    diff_sub_goal_nodes.append(diff_sub_goal_node)
-                    cur_obs_goal = cur_obs_key_node  
-                cos_distances.append(cos_distance)
+                if config['use_keynode_in_eval_On']:
+                    cos_distance, _, _, cur_obs_key_node = find_key_node(cur_obs_sub_goal)
+                    if cos_distance >= FLAGS.mapping_threshold:
+                        diff_sub_goal_node = np.linalg.norm(cur_obs_key_node - cur_obs_sub_goal, axis=-1, keepdims=True)
+                        diff_sub_goal_nodes.append(diff_sub_goal_node)
+                        cur_obs_goal = cur_obs_key_node  
+                    cos_distances.append(cos_distance)
+
+                if plan_subgoal is not None:
+                    # key node와 같은 공간에서의 현재 state / goal (hiql은 rep_type == 'state'의 value_goal(x, x))
+                    if FLAGS.use_rep == "hiql_goal_encoder":
+                        state_rep, goal_rep = value_goal_fn(bases=observation, targets=observation), value_goal_fn(bases=obs_goal, targets=obs_goal)
+                    elif FLAGS.use_rep == "hilp_subgoal_encoder":
+                        state_rep, goal_rep = cur_obs_delta, obs_goal
+                    else:
+                        state_rep, goal_rep = observation, obs_goal
+                    planned, planned_subgoal = plan_subgoal(state_rep, goal_rep)
+                    if planned:
+                        cur_obs_goal = planned_subgoal
     
-            cur_obs_goal_rep = cur_obs_goal                
-            action = policy_fn(observations=observation, goals=cur_obs_goal_rep, low_dim_goals=True, temperature=eval_temperature)
+                cur_obs_goal_rep = cur_obs_goal                
+                action = policy_fn(observations=observation, goals=cur_obs_goal_rep, low_dim_goals=True, temperature=eval_temperature)
             
-            if 'antmaze' in env_name:
-                next_observation, r, done, info = env.step(action)
-            elif 'kitchen' in env_name:
-                next_observation, r, done, info = env.step(action)
-                next_observation = next_observation[:30]
-            elif 'calvin' in env_name:
-                next_observation, r, done, info = env.step({'ac': np.array(action)})
-                next_observation = next_observation['ob']
-                del info['robot_info']
-                del info['scene_info']
+            next_observation, r, done, info = env_step(env, env_name, action)
 
             step += 1
 
@@ -187,29 +237,7 @@ def evaluate_with_trajectories(
             if i >= num_episodes and step % 3 == 0:
                 if FLAGS.use_rep in ["hiql_goal_encoder", "hilp_subgoal_encoder", "hilp_encoder", "vae_encoder"] and FLAGS.relative_dist_in_eval_On:
                     rep_trajectory.append(cur_obs_delta)
-                if 'antmaze' in env_name:
-                    size = 500
-                    box_size = 0.015
-                    cur_frame = env.render(mode='rgb_array', width=size, height=size).transpose(2, 0, 1).copy()
-                    if ('large' in env_name or 'ultra' in env_name):
-                        def xy_to_pixxy(x, y):
-                            if 'large' in env_name:
-                                pixx = (x / 36) * (0.93 - 0.07) + 0.07
-                                pixy = (y / 24) * (0.21 - 0.79) + 0.79
-                            elif 'ultra' in env_name:
-                                pixx = (x / 52) * (0.955 - 0.05) + 0.05
-                                pixy = (y / 36) * (0.19 - 0.81) + 0.81
-                            return pixx, pixy
-      
-                        #x_sub_goal, y_sub_goal = cur_obs_sub_goal[:2]
-                        #sub_pixx, sub_pixy = xy_to_pixxy(x_sub_goal, y_sub_goal)
-                        #cur_frame[:3, int((sub_pixy - box_size) * size):int((sub_pixy + box_size) * size), int((sub_pixx - box_size) * size):int((sub_pixx + box_size) * size)] = 160
-                    render.append(cur_frame)
-                elif 'kitchen' in env_name:
-                    render.append(kitchen_render(env, wh=200).transpose(2, 0, 1))
-                elif 'calvin' in env_name:
-                    cur_frame = env.render(mode='rgb_array').transpose(2, 0, 1)
-                    render.append(cur_frame)     
+                render.append(render_frame(env, env_name))
         if 'calvin' in env_name:
             info['return'] = sum(trajectory['reward'])
         add_to(stats, flatten(info, parent_key="final"))
@@ -224,6 +252,159 @@ def evaluate_with_trajectories(
     
     return stats, trajectories, renders, rep_trajectories, cos_distances
 
+def evaluate_with_trajectories_vectorized(
+        policy_fn, high_policy_fn, encoder_fn, decoder_fn, value_goal_fn, envs, env_name, num_episodes: int, base_observation=None, num_video_episodes=0,
+        eval_temperature=0, epsilon=0,
+        config=None, find_key_node = None, FLAGS = None
+) -> Dict[str, float]:
+    """
+    Batched counterpart of `evaluate_with_trajectories` that steps the environment copies in `envs` in lockstep.
+
+    Each step makes one batched call to the encoder, `high_policy_fn`, `find_key_node` and `policy_fn` for all
+    copies. The subgoal refresh (`h_step == interval` or the relative distance check) is decided per copy with a mask.
+    A copy whose episode is done is reset with the next pending episode. Copies with nothing left to run keep their
+    last observation and their outputs are discarded, so batch shapes (and compiled functions) never change.
+    Returns the same tuple as `evaluate_with_trajectories`, with episodes in order.
+    """
+    num_envs = len(envs)
+    total_episodes = num_episodes + num_video_episodes
+    node_dim, interval = eval_goal_schedule(env_name)
+    rep_eval = FLAGS.use_rep in ["hiql_goal_encoder", "hilp_subgoal_encoder", "hilp_encoder", "vae_encoder"] and FLAGS.relative_dist_in_eval_On
+
+    stats = defaultdict(list)
+    trajectories = [defaultdict(list) for _ in range(total_episodes)]
+    renders = [[] for _ in range(total_episodes)]
+    rep_trajectories = [None] * total_episodes
+    episode_dists = [[] for _ in range(total_episodes)]
+    episode_cos_distances = [[] for _ in range(total_episodes)]
+
+    slot_episode = np.full(num_envs, -1)  # episode index running in each copy (-1: finished)
+    slot_steps = np.zeros(num_envs, dtype=int)
+    observations = [None] * num_envs
+    obs_goals = [None] * num_envs
+    h_step = np.full(num_envs, interval)
+    dist = np.zeros(num_envs)
+    init_dist = np.zeros(num_envs)
+    cur_obs_goal = cur_obs_sub_goal = None
+    next_episode = 0
+
+    def start_episode(k):
+        nonlocal next_episode
+        observation, obs_goal = reset_with_goal(envs[k], env_name, base_observation)
+        if FLAGS.use_rep == "vae_encoder":
+            obs_goal, _, _ = encoder_fn(observation=obs_goal)
+        elif FLAGS.use_rep in ["hilp_subgoal_encoder", "hilp_encoder"]:
+            obs_goal = encoder_fn(observations=jnp.expand_dims(obs_goal, axis=0))[0]
+        observations[k], obs_goals[k] = observation, np.asarray(obs_goal)
+        slot_episode[k], slot_steps[k] = next_episode, 0
+        h_step[k], dist[k] = interval, 0
+        init_dist[k] = 1e5 if FLAGS.relative_dist_in_eval_On else 0
+        next_episode += 1
+
+    for k in range(num_envs):
+        if next_episode < total_episodes:
+            start_episode(k)
+        else:
+            observations[k], obs_goals[k] = observations[0], obs_goals[0]
+
+    pbar = tqdm.tqdm(total=total_episodes, desc="evaluate_with_trajectories_vectorized")
+    while (slot_episode >= 0).any():
+        observation = np.stack(observations)
+        obs_goal = np.stack(obs_goals)
+        if FLAGS.use_rep == "vae_encoder":
+            observation, _, _ = encoder_fn(observation=observation)
+        elif FLAGS.use_rep == "hilp_encoder":
+            observation = encoder_fn(observations=observation)
+        observation = np.asarray(observation)
+
+        # representation of the current observation, shared by the refresh check and the distance below
+        if FLAGS.use_rep == "hilp_encoder":
+            cur_obs_delta = observation
+        elif FLAGS.use_rep == "hilp_subgoal_encoder":
+            cur_obs_delta = np.asarray(encoder_fn(observations=observation))
+        elif FLAGS.use_rep in ["hiql_goal_encoder", "vae_encoder"] or FLAGS.relative_dist_in_eval_On:
+            cur_obs_delta = np.asarray(value_goal_fn(bases=observation, targets=obs_goal))
+        else:
+            cur_obs_delta = None
+
+        refresh = (h_step == interval) | (dist < init_dist * 0.5)
+        if refresh.any():
+            cur_obs_subgoal = np.asarray(high_policy_fn(observations=observation, goals=obs_goal, temperature=eval_temperature))
+            if FLAGS.use_rep in ["hiql_goal_encoder", "vae_encoder"]:
+                if FLAGS.rep_normalizing_On:
+                    cur_obs_subgoal = cur_obs_subgoal / np.linalg.norm(cur_obs_subgoal, axis=-1, keepdims=True) * np.sqrt(cur_obs_subgoal.shape[-1])
+                else:
+                    cur_obs_subgoal = observation + cur_obs_subgoal
+            elif FLAGS.use_rep not in ["hilp_encoder", "hilp_subgoal_encoder"]:
+                cur_obs_subgoal = observation + cur_obs_subgoal
+
+            if FLAGS.relative_dist_in_eval_On:
+                init_dist = np.where(refresh, np.linalg.norm(cur_obs_subgoal - cur_obs_delta, axis=-1), init_dist)
+            if cur_obs_goal is None:
+                cur_obs_goal = cur_obs_sub_goal = cur_obs_subgoal
+            cur_obs_goal = np.where(refresh[:, None], cur_obs_subgoal, cur_obs_goal)
+            cur_obs_sub_goal = np.where(refresh[:, None], cur_obs_subgoal, cur_obs_sub_goal)
+            h_step[refresh] = 0
+
+        if FLAGS.use_rep in ["hiql_goal_encoder", "vae_encoder"]:
+            dist = np.linalg.norm(cur_obs_goal - cur_obs_delta, axis=-1)
+        elif FLAGS.use_rep not in ["hilp_encoder", "hilp_subgoal_encoder"]:
+            dist = np.linalg.norm(cur_obs_goal[:, node_dim] - observation[:, node_dim], axis=-1)
+        h_step += 1
+
+        if config['use_keynode_in_eval_On']:
+            cos_distance, _, _, cur_obs_key_node = find_key_node(cur_obs_sub_goal)
+            cos_distance = np.asarray(cos_distance)
+            cur_obs_goal = np.where((cos_distance >= FLAGS.mapping_threshold)[:, None], np.asarray(cur_obs_key_node), cur_obs_goal)
+
+        action = np.asarray(policy_fn(observations=observation, goals=cur_obs_goal, low_dim_goals=True, temperature=eval_temperature))
+
+        for k in np.flatnonzero(slot_episode >= 0):
+            i = slot_episode[k]
+            next_observation, r, done, info = env_step(envs[k], env_name, action[k])
+            slot_steps[k] += 1
+            episode_dists[i].append(dist[k])
+            if config['use_keynode_in_eval_On']:
+                episode_cos_distances[i].append(cos_distance[k])
+
+            info['dists_mean'] = np.mean(episode_dists[i])
+            info['h_step_mean'] = np.mean(h_step[k])
+            transition = dict(
+                observation=observation[k],
+                next_observation=next_observation,
+                action=action[k],
+                reward=r,
+                done=done,
+                info=info,
+            )
+            add_to(trajectories[i], transition)
+            add_to(stats, flatten(info))
+            observations[k] = next_observation
+
+            # Render
+            if i >= num_episodes and slot_steps[k] % 3 == 0:
+                renders[i].append(render_frame(envs[k], env_name))
+
+            if done:
+                if 'calvin' in env_name:
+                    info['return'] = sum(trajectories[i]['reward'])
+                add_to(stats, flatten(info, parent_key="final"))
+                if i >= num_episodes and rep_eval:
+                    rep_trajectories[i] = cur_obs_delta[k]
+                pbar.update(1)
+                if next_episode < total_episodes:
+                    start_episode(k)
+                else:
+                    slot_episode[k] = -1
+    pbar.close()
+
+    for k, v in stats.items():
+        stats[k] = np.mean(v)
+
+    renders = [np.array(render) for render in renders[num_episodes:]]
+    rep_trajectories = [rep for rep in rep_trajectories[num_episodes:] if rep is not None]
+    return stats, trajectories, renders, rep_trajectories, episode_cos_distances[-1]
+
 class EpisodeMonitor(gym.ActionWrapper):
     """A class that computes episode returns and lengths."""
     def __init__(self, env: gym.Env):
@@ -37,10 +37,11 @@ class MLP(nn.Module):
     activations: Callable[[jnp.ndarray], jnp.ndarray] = nn.relu
     activate_final: int = False
     kernel_init: Callable[[PRNGKey, Shape, Dtype], Array] = default_init()
+    dtype: Dtype = jnp.float32  # computation dtype; params stay float32
 
     def setup(self):
         self.layers = [
-            nn.Dense(size, kernel_init=self.kernel_init) for size in self.hidden_dims
+            nn.Dense(size, kernel_init=self.kernel_init, dtype=self.dtype) for size in self.hidden_dims
         ]
     def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
         for i, layer in enumerate(self.layers):
@@ -118,6 +119,7 @@ class Policy(nn.Module):
     tanh_squash_distribution: bool = False
     state_dependent_std: bool = True
     final_fc_init_scale: float = 1e-2
+    dtype: Dtype = jnp.float32  # computation dtype of the MLP; the distribution is always float32
 
     @nn.compact
     def __call__(
@@ -126,15 +128,16 @@ class Policy(nn.Module):
         outputs = MLP(
             self.hidden_dims,
             activate_final=True,
+            dtype=self.dtype,
         )(observations)
 
         means = nn.Dense(
-            self.action_dim, kernel_init=default_init(self.final_fc_init_scale)
-        )(outputs)
+            self.action_dim, kernel_init=default_init(self.final_fc_init_scale), dtype=self.dtype
+        )(outputs).astype(jnp.float32)
         if self.state_dependent_std:
             log_stds = nn.Dense(
-                self.action_dim, kernel_init=default_init(self.final_fc_init_scale)
-            )(outputs)
+                self.action_dim, kernel_init=default_init(self.final_fc_init_scale), dtype=self.dtype
+            )(outputs).astype(jnp.float32)
         else:
             log_stds = self.param("log_stds", nn.initializers.zeros, (self.action_dim,))
 
@@ -23,12 +23,16 @@ import tensorflow as tf
 from absl import app, flags
 from functools import partial
 from src.agents import ask as learner
-from src.gc_dataset import GCSDataset
+from src.gc_dataset import GCSDataset, PrefetchSampler
+from src.ask_policy import ASKPolicy
+from jaxrl_m.dataset import CompactDataset
+from jaxrl_m.common import trace_counts, shard_batch
+from flax import jax_utils
 from ml_collections import config_flags
 from src.utils import record_video, CsvLogger
 from jaxrl_m.wandb import setup_wandb, default_wandb_config
-from src import d4rl_utils, d4rl_ant, ant_diagnostics, viz_utils, keynode_utils
-from jaxrl_m.evaluation import supply_rng, evaluate_with_trajectories, EpisodeMonitor
+from src import d4rl_utils, d4rl_ant, ant_diagnostics, viz_utils, keynode_utils, dataset_cache, checkpoint_utils
+from jaxrl_m.evaluation import supply_rng, evaluate_with_trajectories, evaluate_with_trajectories_vectorized, EpisodeMonitor
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string('save_dir', f'experiment_output/', '')
@@ -43,12 +47,18 @@ flags.DEFINE_integer('batch_size', 1024, '')
 flags.DEFINE_integer('pretrain_steps', 500002, '')
 flags.DEFINE_integer('eval_interval', 100000, '')
 flags.DEFINE_integer('save_interval', 100000, '')
+flags.DEFINE_integer('checkpoint_keep', 3, '') # 최근 K개 checkpoint만 유지 (>= 1)
+flags.DEFINE_integer('checkpoint_compress_On', 0, '') # 1: array별 npz 압축 저장 (0: npy)
+flags.DEFINE_string('resume_dir', '', '') # 이전 run의 checkpoints 경로, 가장 최근 checkpoint에서 이어서 학습 ('': 처음부터)
 flags.DEFINE_integer('log_interval', 1000, '')
 flags.DEFINE_integer('eval_episodes', 50, '')
 flags.DEFINE_integer('num_video_episodes', 2, '')
+flags.DEFINE_integer('eval_num_envs', 1, '') # N>1: N개의 env copy를 lockstep으로 돌리는 batched evaluation (antmaze / kitchen)
+flags.DEFINE_integer('fused_policy_On', 0, '') # 1: evaluation step 전체 (encoder, subgoal refresh, key node, action)를 하나의 jit 함수로 (ASKPolicy, key node는 exact search, eval_num_envs=1만)
 
 flags.DEFINE_integer('way_steps', 25, '')
 flags.DEFINE_integer('use_layer_norm', 1, '')
+flags.DEFINE_string('compute_dtype', 'float32', '') # network activation / matmul dtype: float32 / bfloat16 (params, LayerNorm, loss는 float32)
 flags.DEFINE_integer('value_hidden_dim', 512, '')
 flags.DEFINE_integer('value_num_layers', 3, '')
 flags.DEFINE_integer('geom_sample', 1, '')
@@ -81,6 +91,18 @@ flags.DEFINE_integer('use_keynode_in_eval_On', 1, '')
 
 flags.DEFINE_integer('relative_dist_in_eval_On', 1, '')
 flags.DEFINE_string('mapping_method', 'nearest', '') # nearest, triple, center
+flags.DEFINE_string('keynode_index', 'exact', '') # exact (brute force) / ivf / hnsw (faiss CPU index) - key node 탐색 방식
+flags.DEFINE_integer('keynode_index_nprobe', 8, '') # ivf index에서 탐색할 cluster 수
+flags.DEFINE_integer('keynode_chunk_size', 65536, '') # dataset -> key node mapping을 chunk 단위로 수행 (memory 상한)
+flags.DEFINE_integer('keynode_reuse_labels_On', 0, '') # 1: 가능하면 k-means에서 구한 faiss labels를 key node mapping에 재사용
+flags.DEFINE_integer('keynode_incremental_On', 0, '') # 1: eval_interval마다 key node를 이전 centroid에서 warm start (graph / 시각화 생략)
+flags.DEFINE_integer('keynode_incremental_iters', 5, '')
+flags.DEFINE_integer('keynode_incremental_batch', 100000, '')
+flags.DEFINE_string('kmeans_backend', 'faiss', '') # faiss (faiss.Kmeans, gpu) / minibatch (numpy mini-batch k-means, src/kmeans_utils.py)
+flags.DEFINE_integer('kmeans_iters', 100, '') # minibatch backend iteration 수
+flags.DEFINE_integer('kmeans_batch_size', 4096, '') # minibatch backend batch size
+flags.DEFINE_integer('graph_plan_in_eval_On', 0, '') # 1: key node transition graph의 최단경로 다음 node를 eval subgoal로 사용 (도달 불가면 high policy subgoal), eval_num_envs=1 / hiql은 rep_type=state만
+flags.DEFINE_string('keynode_edge_weight', 'steps', '') # steps / hops
 
 flags.DEFINE_integer('hilp_skill_dim', 32, '')
 
@@ -94,6 +116,16 @@ flags.DEFINE_string('rep_type', 'state', '') # 'state' / 'concat'
 flags.DEFINE_float('spherical_On', 0.0, '') # 0:Euclidean Distance // 1: Cosine Similarity
 flags.DEFINE_float('mapping_threshold', 0.0, '')
 
+flags.DEFINE_string('dataset_cache_dir', '', '') # 전처리된 dataset cache 경로 ('': cache 사용 안함)
+flags.DEFINE_integer('compact_dataset_On', 0, '') # 1: next_observations를 따로 저장하지 않고 observations[i+1]로 복원 (CompactDataset)
+
+flags.DEFINE_integer('device_sampler_On', 0, '') # 1: batch 샘플링을 pretrain_update와 같은 jit 안에서 수행 (DeviceGCSDataset)
+flags.DEFINE_integer('prefetch_On', 0, '') # 1: background thread에서 batch를 미리 샘플링 + device_put (PrefetchSampler)
+flags.DEFINE_integer('updates_per_dispatch', 1, '') # K>1: K번의 update를 lax.scan으로 묶어 한번에 dispatch (pretrain_update_many), log / eval / save step에서는 끊음
+flags.DEFINE_integer('num_seeds', 1, '') # N>1: seed, seed+1, ..., seed+N-1 agent를 stack해서 vmap으로 같이 학습 (dataset / key node는 공유, use_rep='' + relative_dist_in_eval_On=0만)
+flags.DEFINE_integer('data_parallel_On', 0, '') # 1: 모든 local device에 agent 복제 + batch 분할 (pmap), gradient all-reduce (device_sampler_On / updates_per_dispatch > 1과 같이 사용 불가)
+flags.DEFINE_string('compilation_cache_dir', '', '') # XLA persistent compilation cache 경로 ('': 사용 안함), run 사이에 컴파일 결과 재사용
+
 wandb_config = default_wandb_config()
 wandb_config.update({
     'project': f'ASK_{project}',
@@ -147,7 +179,7 @@ def get_traj_v(agent, trajectory):
     
     observations = trajectory['observations']
     
-    if agent.config['use_rep'] == "hiql_goal_encoder":
+    if agent.config['use_rep'] in ["", "hiql_goal_encoder"]:
         all_values = jax.vmap(jax.vmap(get_v, in_axes=(None, 0)), in_axes=(0, None))(observations, observations)
         
     elif agent.config['use_rep'] == "vae_encoder":
@@ -170,6 +202,23 @@ def get_traj_v(agent, trajectory):
 
 def main(_):
     g_start_time = time.strftime('%m-%d_%H-%M')
+    if FLAGS.compilation_cache_dir:
+        jax.config.update('jax_compilation_cache_dir', FLAGS.compilation_cache_dir)
+    if FLAGS.data_parallel_On:
+        # host에서 샘플링한 batch를 device 수로 나눠서 pmap (prefetch_On은 사용 가능)
+        assert not (FLAGS.device_sampler_On or FLAGS.updates_per_dispatch > 1), \
+            'data_parallel_On does not support device_sampler_On or updates_per_dispatch > 1'
+    if FLAGS.num_seeds > 1:
+        # rep / key node는 seed 0 agent 하나로만 만들어서 공유하므로 학습된 rep을 쓰는 경우에는 seed별 replicate가 되지 않음
+        assert not FLAGS.use_rep, 'num_seeds > 1 supports use_rep="" only (key nodes in observation space)'
+        # use_rep=""에는 value_goal encoder가 없어서 relative distance를 구할 수 없음
+        assert not FLAGS.relative_dist_in_eval_On, 'num_seeds > 1 needs relative_dist_in_eval_On=0'
+        # use_rep=""의 key node는 학습 전에만 만들어짐 (post_training이면 eval에서 쓸 key node가 없음)
+        assert FLAGS.build_keynode_time in ["pre_training", "during_training"] or not FLAGS.use_keynode_in_eval_On, \
+            'num_seeds > 1 with use_keynode_in_eval_On needs build_keynode_time=pre_training or during_training'
+        # seed별 batch는 host에서 따로 샘플링 (device sampler / prefetch / lax.scan 경로 미지원)
+        assert not (FLAGS.device_sampler_On or FLAGS.prefetch_On or FLAGS.updates_per_dispatch > 1), \
+            'num_seeds > 1 does not support device_sampler_On, prefetch_On or updates_per_dispatch > 1'
 
     exp_name = ''
     exp_name += f'{FLAGS.wandb["name"]}'
@@ -247,7 +296,9 @@ def main(_):
         else:
             env = d4rl_utils.make_env(env_name)
             env.seed(FLAGS.seed)   
-        dataset, episode_index = d4rl_utils.get_dataset(env, FLAGS.env_name, flag=FLAGS)
+        dataset, episode_index = dataset_cache.load_or_create(
+            FLAGS.dataset_cache_dir, lambda: d4rl_utils.get_dataset(env, FLAGS.env_name, flag=FLAGS),
+            FLAGS.env_name, source_path=dataset_cache.dataset_source_path(env), flag=FLAGS)
         dataset = dataset.copy({'rewards': dataset['rewards'] - 1.0})
         env.render(mode='rgb_array', width=500, height=500)
         if 'large' in FLAGS.env_name:
@@ -272,7 +323,9 @@ def main(_):
     elif 'kitchen' in FLAGS.env_name:
         env = d4rl_utils.make_env(FLAGS.env_name)
         env.seed(FLAGS.seed)
-        dataset, episode_index = d4rl_utils.get_dataset(env, FLAGS.env_name, filter_terminals=True)
+        dataset, episode_index = dataset_cache.load_or_create(
+            FLAGS.dataset_cache_dir, lambda: d4rl_utils.get_dataset(env, FLAGS.env_name, filter_terminals=True, flag=FLAGS),
+            FLAGS.env_name, source_path=dataset_cache.dataset_source_path(env), flag=FLAGS, filter_terminals=True)
         dataset = dataset.copy({'observations': dataset['observations'][:, :30], 'next_observations': dataset['next_observations'][:, :30]})
     elif 'calvin' in FLAGS.env_name:
         from src.envs.calvin import CalvinEnv
@@ -295,46 +348,67 @@ def main(_):
             return_state=False,
         )
         env = wrap_env(env, cfg)
-        data = pickle.load(gzip.open(os.path.dirname(os.path.realpath(__file__)) + '/data/calvin.gz', "rb")) # 현재 실행되는 파일 위치에서 calvin 파일 찾음
-        ds = []
-        episode_index = 0
-        for i, d in enumerate(data):
-            if len(d['obs']) < len(d['dones']):
-                continue  # Skip incomplete trajectories.
-            # Only use the first 21 states of non-floating objects.
-            d['obs'] = d['obs'][:, :21]
-            new_d = dict(
-                observations=d['obs'][:-1],
-                next_observations=d['obs'][1:],
-                actions=d['actions'][:-1],
-                episodes = [episode_index]*len(d['obs'][:-1])
-            )
-            num_steps = new_d['observations'].shape[0]
-            new_d['rewards'] = np.zeros(num_steps)
-            new_d['terminals'] = np.zeros(num_steps, dtype=bool)
-            new_d['terminals'][-1] = True
-            ds.append(new_d)
-            episode_index +=1
-        dataset = dict()
-        for key in ds[0].keys():
-            dataset[key] = np.concatenate([d[key] for d in ds], axis=0)
-        dataset, episode_index = d4rl_utils.get_dataset(env, FLAGS.env_name, dataset=dataset, flags=FLAGS)
+        calvin_path = os.path.dirname(os.path.realpath(__file__)) + '/data/calvin.gz' # 현재 실행되는 파일 위치에서 calvin 파일 찾음
+        def load_calvin_dataset():
+            data = pickle.load(gzip.open(calvin_path, "rb"))
+            ds = []
+            episode_index = 0
+            for i, d in enumerate(data):
+                if len(d['obs']) < len(d['dones']):
+                    continue  # Skip incomplete trajectories.
+                # Only use the first 21 states of non-floating objects.
+                d['obs'] = d['obs'][:, :21]
+                new_d = dict(
+                    observations=d['obs'][:-1],
+                    next_observations=d['obs'][1:],
+                    actions=d['actions'][:-1],
+                    episodes = [episode_index]*len(d['obs'][:-1])
+                )
+                num_steps = new_d['observations'].shape[0]
+                new_d['rewards'] = np.zeros(num_steps)
+                new_d['terminals'] = np.zeros(num_steps, dtype=bool)
+                new_d['terminals'][-1] = True
+                ds.append(new_d)
+                episode_index +=1
+            dataset = dict()
+            for key in ds[0].keys():
+                dataset[key] = np.concatenate([d[key] for d in ds], axis=0)
+            return d4rl_utils.get_dataset(env, FLAGS.env_name, dataset=dataset, flag=FLAGS)
+        dataset, episode_index = dataset_cache.load_or_create(
+            FLAGS.dataset_cache_dir, load_calvin_dataset, FLAGS.env_name, source_path=calvin_path, flag=FLAGS)
     else:
         raise NotImplementedError
 
+    if FLAGS.compact_dataset_On:
+        dataset = CompactDataset.compress(dataset)
+
     total_steps = FLAGS.pretrain_steps
     example_observation = dataset['observations'][0, np.newaxis]
     example_action = dataset['actions'][0, np.newaxis]
 
-    agent = learner.create_learner(FLAGS.seed,
-                                   example_observation,
-                                   example_action,
-                                   use_layer_norm=FLAGS.use_layer_norm,
-                                   flag=FLAGS,
-                                   **FLAGS.config)
+    def make_agent(seed):
+        return learner.create_learner(seed,
+                                      example_observation,
+                                      example_action,
+                                      use_layer_norm=FLAGS.use_layer_norm,
+                                      compute_dtype=FLAGS.compute_dtype,
+                                      flag=FLAGS,
+                                      **FLAGS.config)
+
+    init_agent = agent = make_agent(FLAGS.seed)
+    start_step = 1
+    checkpoint = None
+    if FLAGS.resume_dir:
+        # rep / key node / GCSDataset을 만들기 전에 agent (params, optimizer state, rng, key_nodes) 복원
+        resume_manager = checkpoint_utils.CheckpointManager(FLAGS.resume_dir)
+        checkpoint, checkpoint_metadata = resume_manager.restore()
+        resume_manager.close()
+        agent = flax.serialization.from_state_dict(agent, checkpoint['agent'])
+        start_step = checkpoint_metadata['step'] + 1
+        print(f'Resuming from step {checkpoint_metadata["step"]} ({FLAGS.resume_dir})')
     
     if FLAGS.use_rep == "hiql_goal_encoder":
-        encoder_fn = jax.jit(jax.vmap(agent.get_value_goal))
+        encoder_fn = partial(learner.batched_value_goal, agent)
         # 0610 승호수정 spherical
         if FLAGS.rep_type == 'concat':
             rep_observations = d4rl_utils.get_rep_observation_spherical(encoder_fn, dataset, FLAGS)
@@ -343,12 +417,14 @@ def main(_):
         dataset = d4rl_utils.add_data(dataset, rep_observations)
         
     elif FLAGS.use_rep == "vae_encoder":
-        encoder_fn = jax.jit(jax.vmap(agent.get_vae_state_rep))
+        # during_training이 아니면 vae rep은 학습 전 encoder로 한번만 만들어지므로 resume시에도 초기 agent 사용
+        rep_agent = agent if FLAGS.config['build_keynode_time'] == "during_training" else init_agent
+        encoder_fn = partial(learner.batched_vae_state_rep, rep_agent)
         rep_observations = d4rl_utils.get_rep_observation(encoder_fn, dataset, FLAGS)
         dataset = d4rl_utils.add_data(dataset, rep_observations)
             
     elif FLAGS.use_rep in ["hilp_subgoal_encoder", "hilp_encoder"]:
-        encoder_fn = jax.jit(jax.vmap(agent.get_hilp_phi))
+        encoder_fn = partial(learner.batched_hilp_phi, agent)
         rep_observations = d4rl_utils.get_hilp_rep_observation(encoder_fn, dataset, FLAGS)
         if FLAGS.kmean_weight_type == 'hilbert_td':
             dataset = d4rl_utils.hilp_add_data(dataset, rep_observations)
@@ -356,12 +432,15 @@ def main(_):
             dataset = d4rl_utils.add_data(dataset, rep_observations)
             
         
-    if FLAGS.config['build_keynode_time'] in ["pre_training", "during_training"]:       
-        key_nodes, sparse_data_index = keynode_utils.build_keynodes(dataset, flags=FLAGS, episode_index= episode_index)
+    # resume시에는 checkpoint의 key node를 그대로 복원 (k-means 생략, rep / labels만 다시 계산)
+    resume_centroids = checkpoint.get('key_node') if checkpoint is not None else None
+    if FLAGS.config['build_keynode_time'] in ["pre_training", "during_training"] or resume_centroids is not None:
+        key_nodes, sparse_data_index = keynode_utils.build_keynodes(dataset, flags=FLAGS, episode_index= episode_index,
+                                                                    centroids=None if FLAGS.use_rep else resume_centroids)
         if FLAGS.use_rep in ["hiql_goal_encoder", "vae_encoder", "hilp_subgoal_encoder", "hilp_encoder"]:
             # 0610 승호수정 spherical
-            key_nodes.construct_nodes(rep_observations=rep_observations, spherical_On=FLAGS.spherical_On)
-        find_key_node = jax.jit(key_nodes.find_closest_node)
+            key_nodes.construct_nodes(rep_observations=rep_observations, spherical_On=FLAGS.spherical_On, centroids=resume_centroids)
+        find_key_node = key_nodes.finder()
         agent = agent.replace(key_nodes = key_nodes.pos)
     else:
         key_nodes, find_key_node = None, None
@@ -369,7 +448,39 @@ def main(_):
     if FLAGS.sparse_data:
         dataset = d4rl_utils.sparse_data(dataset, sparse_data_index=sparse_data_index)
 
-    pretrain_dataset = GCSDataset(dataset, find_key_node=find_key_node, **FLAGS.gcdataset.to_dict())
+    def assign_key_nodes(dataset, key_nodes):
+        # keynode_ratio 사용시 dataset 전체의 key node를 chunk 단위로 미리 계산 (GCSDataset에서 한번에 계산하지 않도록)
+        if not FLAGS.keynode_ratio or key_nodes is None:
+            return None
+        use_rep_observations = 'rep_observations' in dataset and dataset['rep_observations'] is not None
+        data = dataset['rep_observations'] if use_rep_observations else dataset['observations']
+        labels = key_nodes.rep_labels if use_rep_observations else key_nodes.labels
+        if not (FLAGS.keynode_reuse_labels_On and key_nodes.labels_reusable and labels is not None and len(labels) == len(data)):
+            labels = None
+        return key_nodes.assign_nodes(data, chunk_size=FLAGS.keynode_chunk_size, labels=labels)
+
+    pretrain_dataset = GCSDataset(dataset, find_key_node=find_key_node, key_node=assign_key_nodes(dataset, key_nodes), **FLAGS.gcdataset.to_dict())
+
+    def build_key_node_graph(key_nodes, dataset):
+        # key node labels (dataset row 순서)과 episode 경계로 transition graph + 최단경로 계산
+        labels = key_nodes.rep_labels if key_nodes.rep_labels is not None else key_nodes.labels
+        dones = dataset['dones_float']
+        if len(dones) != len(labels):
+            dones = dones[sparse_data_index]
+        key_nodes.build_transition_graph(labels, dones, weight_type=FLAGS.keynode_edge_weight)
+
+    def build_samplers(pretrain_dataset, batch_sampler=None, step=0):
+        # pretrain_dataset이 바뀔 때마다 device sampler / prefetch sampler 재생성
+        if batch_sampler is not None:
+            batch_sampler.close()
+        device_dataset = pretrain_dataset.to_device() if FLAGS.device_sampler_On else None
+        if FLAGS.prefetch_On and not FLAGS.device_sampler_On:
+            batch_sampler = PrefetchSampler(pretrain_dataset, FLAGS.batch_size, seed=FLAGS.seed + step, num_steps=FLAGS.updates_per_dispatch)
+        else:
+            batch_sampler = None
+        return device_dataset, batch_sampler
+
+    device_dataset, batch_sampler = build_samplers(pretrain_dataset, step=start_step - 1)
 
         
     encoder_fn = None
@@ -401,21 +512,124 @@ def main(_):
         goal = np.array([0.25, 0.15, 0, 0.088, 1, 1])
         obs_goal = base_observation.copy()
         obs_goal[15:21] = goal
+
+    def make_eval_envs(num_envs):
+        # 기존 env + (num_envs - 1)개의 in-process copy. render 카메라는 env와 동일하게 맞춤
+        eval_envs = [env]
+        for k in range(1, num_envs):
+            if 'antmaze' in FLAGS.env_name and 'ultra' in FLAGS.env_name:
+                import gym
+                eval_env = EpisodeMonitor(gym.make(env_name))
+            elif 'antmaze' in FLAGS.env_name or 'kitchen' in FLAGS.env_name:
+                eval_env = d4rl_utils.make_env(env_name)
+            else:
+                raise NotImplementedError('eval_num_envs > 1 supports antmaze and kitchen only')
+            eval_env.seed(FLAGS.seed + k)
+            if 'antmaze' in FLAGS.env_name:
+                eval_env.render(mode='rgb_array', width=500, height=500)
+                eval_env.viewer.cam.lookat[:] = env.viewer.cam.lookat
+                eval_env.viewer.cam.distance = env.viewer.cam.distance
+                eval_env.viewer.cam.elevation = env.viewer.cam.elevation
+            eval_envs.append(eval_env)
+        return eval_envs
+
+    eval_envs = make_eval_envs(FLAGS.eval_num_envs) if FLAGS.eval_num_envs > 1 else None
+    assert not (FLAGS.fused_policy_On and eval_envs is not None), 'fused_policy_On and eval_num_envs > 1 are exclusive'
+    assert not (FLAGS.graph_plan_in_eval_On and eval_envs is not None), 'graph_plan_in_eval_On and eval_num_envs > 1 are exclusive'
+    # hiql concat rep은 way_steps 뒤의 state가 필요해서 eval 중의 state / goal을 key node와 같은 공간으로 embedding 할 수 없음
+    assert not (FLAGS.graph_plan_in_eval_On and FLAGS.use_rep == "hiql_goal_encoder" and FLAGS.rep_type != 'state'), \
+        'graph_plan_in_eval_On with hiql_goal_encoder needs rep_type=state'
+    # run 전체에서 하나만 만들고 eval마다 agent / key node만 교체 (jit 재컴파일 없음)
+    ask_policy = ASKPolicy(FLAGS.env_name, flags=FLAGS, config=FLAGS.config) if FLAGS.fused_policy_On else None
     
     train_logger = CsvLogger(os.path.join(FLAGS.save_dir, 'train.csv'))
     eval_logger = CsvLogger(os.path.join(FLAGS.save_dir, 'eval.csv'))
     first_time = time.time()
     last_time = time.time()
 
-    for i in tqdm.tqdm(range(1, total_steps + 1),
+    replicated_agent = None
+    if FLAGS.data_parallel_On:
+        # CPU에서는 XLA_FLAGS=--xla_force_host_platform_device_count=N 으로 device 여러개 사용 가능
+        assert FLAGS.batch_size % jax.local_device_count() == 0, f'batch_size must be divisible by {jax.local_device_count()} devices'
+        print(f'Data-parallel training on {jax.local_device_count()} devices')
+        replicated_agent = jax_utils.replicate(agent)
+
+    seed_agents = None
+    if FLAGS.num_seeds > 1:
+        # observation 공간의 key node를 모든 seed가 공유
+        assert not FLAGS.data_parallel_On, 'num_seeds > 1 and data_parallel_On are exclusive'
+        seed_agents = learner.stack_agents([agent] + [make_agent(FLAGS.seed + k).replace(key_nodes=agent.key_nodes) for k in range(1, FLAGS.num_seeds)])
+        seed_train_loggers = [CsvLogger(os.path.join(FLAGS.save_dir, f'train_seed{k}.csv')) for k in range(FLAGS.num_seeds)]
+        print(f'Training {FLAGS.num_seeds} seeds with vmap')
+
+    checkpoint_manager = checkpoint_utils.CheckpointManager(os.path.join(FLAGS.save_dir, 'checkpoints'), keep=FLAGS.checkpoint_keep, compress=bool(FLAGS.checkpoint_compress_On))
+    if checkpoint is not None:
+        # seed별 agent와 numpy RNG 복원 (key node 생성 등 학습 전 준비가 끝난 뒤)
+        if FLAGS.num_seeds > 1:
+            seed_agents = learner.stack_agents([agent] + [flax.serialization.from_state_dict(learner.unstack_agent(seed_agents, k), checkpoint[f'agent_seed{k}'])
+                                                          for k in range(1, FLAGS.num_seeds)])
+        np.random.set_state(('MT19937', checkpoint['numpy_rng'], *checkpoint_metadata['numpy_rng_state']))
+
+    def steps_to_boundary(i):
+        # i부터 다음 log / eval / save step까지 (포함) 남은 step 수 (i == 1은 eval step)
+        if i == 1:
+            return 1
+        return min(interval - (i - 1) % interval for interval in (FLAGS.log_interval, FLAGS.eval_interval, FLAGS.save_interval))
+
+    updated_through = start_step - 1 # 이 step까지 update가 끝남 (updates_per_dispatch > 1)
+    for i in tqdm.tqdm(range(start_step, total_steps + 1),
                    desc="main_train",
                    smoothing=0.1,
                    dynamic_ncols=True):
-        pretrain_batch = pretrain_dataset.sample(FLAGS.batch_size)
-        agent, update_info = supply_rng(agent.pretrain_update)(pretrain_batch)
+        vae_rebuild = FLAGS.use_rep=="vae_encoder" and FLAGS.config['build_keynode_time']=="during_training"
+        needs_agent = i % FLAGS.log_interval == 0 or i == 1 or i % FLAGS.eval_interval == 0 or vae_rebuild
+        if FLAGS.data_parallel_On:
+            pretrain_batch = next(batch_sampler) if batch_sampler is not None else pretrain_dataset.sample(FLAGS.batch_size)
+            replicated_agent, update_info = learner.pretrain_update_pmap(replicated_agent, shard_batch(pretrain_batch))
+            update_info = jax_utils.unreplicate(update_info)
+            if needs_agent:
+                # device 0의 agent를 log / eval / key node 생성에 사용
+                agent = jax_utils.unreplicate(replicated_agent)
+        elif FLAGS.num_seeds > 1:
+            # seed별 batch를 같은 dataset에서 따로 샘플링
+            pretrain_batches = [pretrain_dataset.sample(FLAGS.batch_size) for _ in range(FLAGS.num_seeds)]
+            pretrain_batch = pretrain_batches[0]
+            seed_agents, update_info = learner.pretrain_update_vmap(seed_agents, jax.tree_map(lambda *xs: np.stack(xs), *pretrain_batches))
+            if needs_agent:
+                # seed 0 agent로 key node 생성 / debug statistics
+                agent = learner.unstack_agent(seed_agents, 0)
+        elif i > updated_through:
+            # 다음 log / eval / save step에서 끊어서 그 step의 agent가 정확히 i번 update된 상태가 되도록 함
+            num_steps = min(FLAGS.updates_per_dispatch, total_steps - i + 1, steps_to_boundary(i))
+            updated_through = i + num_steps - 1
+            if num_steps > 1:
+                if FLAGS.device_sampler_On:
+                    agent, update_info = agent.pretrain_update_many(sampler=device_dataset, num_steps=num_steps, batch_size=FLAGS.batch_size)
+                elif batch_sampler is not None and num_steps == FLAGS.updates_per_dispatch:
+                    agent, update_info = agent.pretrain_update_many(next(batch_sampler), num_steps=num_steps)
+                else:
+                    pretrain_batches = [pretrain_dataset.sample(FLAGS.batch_size) for _ in range(num_steps)]
+                    pretrain_batches = jax.tree_map(lambda *xs: np.stack(xs), *pretrain_batches)
+                    agent, update_info = agent.pretrain_update_many(pretrain_batches, num_steps=num_steps)
+            elif FLAGS.device_sampler_On:
+                agent, update_info = agent.pretrain_update_on_device(device_dataset, batch_size=FLAGS.batch_size)
+            else:
+                if batch_sampler is not None and FLAGS.updates_per_dispatch == 1:
+                    pretrain_batch = next(batch_sampler)
+                else:
+                    pretrain_batch = pretrain_dataset.sample(FLAGS.batch_size)
+                agent, update_info = supply_rng(agent.pretrain_update)(pretrain_batch)
 
         if i % FLAGS.log_interval == 0:
+            if not FLAGS.data_parallel_On and (FLAGS.device_sampler_On or FLAGS.updates_per_dispatch > 1):
+                pretrain_batch = pretrain_dataset.sample(FLAGS.batch_size)
             debug_statistics = get_debug_statistics(agent, pretrain_batch)
+            if FLAGS.num_seeds > 1:
+                for k in range(FLAGS.num_seeds):
+                    seed_metrics = {f'training/{key}': v[k] for key, v in update_info.items()}
+                    seed_train_loggers[k].log(seed_metrics, step=i)
+                    wandb.log({f'seed{k}/{key}': v for key, v in seed_metrics.items()}, step=i)
+                update_info = jax.tree_map(lambda x: x.mean(0), update_info) # seed 평균
             train_metrics = {f'training/{k}': v for k, v in update_info.items()}
             train_metrics.update({f'pretraining/debug/{k}': v for k, v in debug_statistics.items()})
             train_metrics['time/epoch_time'] = (time.time() - last_time) / FLAGS.log_interval
@@ -425,37 +639,45 @@ def main(_):
             train_logger.log(train_metrics, step=i)
                 
         if FLAGS.use_rep=="vae_encoder" and FLAGS.config['build_keynode_time']=="during_training" and not(i % FLAGS.eval_interval == 0) :
-            encoder_fn = jax.jit(jax.vmap(agent.get_vae_state_rep))
+            encoder_fn = partial(learner.batched_vae_state_rep, agent)
             rep_observations = d4rl_utils.get_rep_observation(encoder_fn, dataset, FLAGS)
             dataset = d4rl_utils.add_data(dataset, rep_observations)
-            key_nodes.construct_nodes(rep_observations=rep_observations)                
-            find_key_node = jax.jit(key_nodes.find_closest_node)
-            pretrain_dataset = GCSDataset(dataset, find_key_node = find_key_node, encoder_fn=encoder_fn, **FLAGS.gcdataset.to_dict())
+            key_nodes.construct_nodes(rep_observations=rep_observations, incremental=bool(FLAGS.keynode_incremental_On))
+            find_key_node = key_nodes.finder()
+            pretrain_dataset = GCSDataset(dataset, find_key_node = find_key_node, key_node=assign_key_nodes(dataset, key_nodes), encoder_fn=encoder_fn, **FLAGS.gcdataset.to_dict())
+            device_dataset, batch_sampler = build_samplers(pretrain_dataset, batch_sampler, step=i)
 
         if i == 1 or i % FLAGS.eval_interval == 0:
             if FLAGS.use_rep in ["hilp_subgoal_encoder", "hilp_encoder"]:
-                encoder_fn = jax.jit(jax.vmap(agent.get_hilp_phi))
+                encoder_fn = partial(learner.batched_hilp_phi, agent)
                 rep_observations = d4rl_utils.get_hilp_rep_observation(encoder_fn, dataset, FLAGS)
             elif FLAGS.use_rep == "hiql_goal_encoder":
-                encoder_fn = jax.jit(jax.vmap(agent.get_value_goal))
+                encoder_fn = partial(learner.batched_value_goal, agent)
                 # 0610 승호수정 spherical
                 if FLAGS.rep_type == 'concat':
                     rep_observations = d4rl_utils.get_rep_observation_spherical(encoder_fn, dataset, FLAGS)
                 elif FLAGS.rep_type == 'state':
                     rep_observations = d4rl_utils.get_rep_observation_goal_only(encoder_fn, dataset, FLAGS)
         
-            if FLAGS.kmean_weight_type == 'hilbert_td' :
-                dataset = d4rl_utils.hilp_add_data(dataset, rep_observations)
-            elif FLAGS.kmean_weight_type in ['rtg_discount', 'rtg_uniform']:
-                dataset = d4rl_utils.add_data(dataset, rep_observations)
+            if FLAGS.use_rep: # use_rep=""은 observation 공간 key node라 rep column 없음
+                if FLAGS.kmean_weight_type == 'hilbert_td' :
+                    dataset = d4rl_utils.hilp_add_data(dataset, rep_observations)
+                elif FLAGS.kmean_weight_type in ['rtg_discount', 'rtg_uniform']:
+                    dataset = d4rl_utils.add_data(dataset, rep_observations)
                     
             if FLAGS.use_rep in ["hiql_goal_encoder", "hilp_subgoal_encoder", "hilp_encoder"]:
-                key_nodes, sparse_data_index = keynode_utils.build_keynodes(dataset, flags=FLAGS, episode_index= episode_index)
-                # 0610 승호수정 spherical
-                key_nodes.construct_nodes(rep_observations=rep_observations, spherical_On=FLAGS.spherical_On)
-                find_key_node = jax.jit(key_nodes.find_closest_node)
+                if FLAGS.keynode_incremental_On and key_nodes is not None:
+                    # 이전 key node에서 warm start, png 재생성 생략
+                    key_nodes.construct_nodes(rep_observations=rep_observations, spherical_On=FLAGS.spherical_On, incremental=True,
+                                              values=dataset['returns'] if FLAGS.kmean_weight_On else None)
+                else:
+                    key_nodes, sparse_data_index = keynode_utils.build_keynodes(dataset, flags=FLAGS, episode_index= episode_index)
+                    # 0610 승호수정 spherical
+                    key_nodes.construct_nodes(rep_observations=rep_observations, spherical_On=FLAGS.spherical_On)
+                find_key_node = key_nodes.finder()
                 agent = agent.replace(key_nodes = key_nodes.pos)
-                pretrain_dataset = GCSDataset(dataset, find_key_node = find_key_node, **FLAGS.gcdataset.to_dict())
+                pretrain_dataset = GCSDataset(dataset, find_key_node = find_key_node, key_node=assign_key_nodes(dataset, key_nodes), **FLAGS.gcdataset.to_dict())
+                device_dataset, batch_sampler = build_samplers(pretrain_dataset, batch_sampler, step=i)
             
             eval_episodes = 1 if i == 1 else FLAGS.eval_episodes
             num_video_episodes = 0 if i == 1 else FLAGS.num_video_episodes
@@ -463,15 +685,26 @@ def main(_):
             policy_fn = partial(supply_rng(agent.sample_actions))
             high_policy_fn = partial(supply_rng(agent.sample_high_actions))
             base_observation = jax.tree_map(lambda arr: arr[0], pretrain_dataset.dataset['observations'])
+            # class-level jit 함수를 그대로 사용 (agent가 인자라서 eval마다 재컴파일하지 않음)
             if FLAGS.use_rep=="hiql_goal_encoder":
-                value_goal_fn = jax.jit(agent.get_value_goal)
+                value_goal_fn = agent.get_value_goal
             elif FLAGS.use_rep=="vae_encoder":
-                encoder_fn = jax.jit(agent.get_vae_state_rep)
-                decoder_fn = jax.jit(agent.get_vae_rep_state)
-                value_goal_fn = jax.jit(agent.get_value_goal)
-
-            eval_info, trajs, renders, rep_trajectories, cos_distances = evaluate_with_trajectories(
-                    policy_fn=policy_fn, high_policy_fn=high_policy_fn, encoder_fn=encoder_fn, decoder_fn=decoder_fn, value_goal_fn=value_goal_fn, env=env,
+                encoder_fn = agent.get_vae_state_rep
+                decoder_fn = agent.get_vae_rep_state
+                value_goal_fn = agent.get_value_goal
+
+            graph_plan = FLAGS.graph_plan_in_eval_On and key_nodes is not None
+            if graph_plan:
+                build_key_node_graph(key_nodes, dataset)
+            key_node_arrays = key_nodes.lookup_arrays if key_nodes is not None else None
+            if eval_envs is not None:
+                evaluate_fn = partial(evaluate_with_trajectories_vectorized, envs=eval_envs)
+            elif ask_policy is not None:
+                evaluate_fn = partial(evaluate_with_trajectories, env=env, ask_policy=ask_policy.bind(agent, key_node_arrays, seed=FLAGS.seed + i))
+            else:
+                evaluate_fn = partial(evaluate_with_trajectories, env=env, plan_subgoal=key_nodes.planner() if graph_plan else None)
+            eval_info, trajs, renders, rep_trajectories, cos_distances = evaluate_fn(
+                    policy_fn=policy_fn, high_policy_fn=high_policy_fn, encoder_fn=encoder_fn, decoder_fn=decoder_fn, value_goal_fn=value_goal_fn,
                     env_name=FLAGS.env_name, num_episodes=eval_episodes,
                     base_observation=base_observation, num_video_episodes=num_video_episodes,
                     eval_temperature=0,
@@ -481,6 +714,22 @@ def main(_):
                 )
             
             eval_metrics = {f'evaluation/{k}': v for k, v in eval_info.items()}
+            if FLAGS.num_seeds > 1:
+                for k in range(1, FLAGS.num_seeds):
+                    seed_agent = learner.unstack_agent(seed_agents, k).replace(key_nodes=agent.key_nodes)
+                    if ask_policy is not None:
+                        ask_policy.bind(seed_agent, key_node_arrays, seed=FLAGS.seed + i + k)
+                    seed_eval_info = evaluate_fn(
+                        policy_fn=supply_rng(seed_agent.sample_actions), high_policy_fn=supply_rng(seed_agent.sample_high_actions),
+                        encoder_fn=None, decoder_fn=None, value_goal_fn=None,
+                        env_name=FLAGS.env_name, num_episodes=eval_episodes,
+                        base_observation=base_observation, num_video_episodes=0,
+                        eval_temperature=0,
+                        config=FLAGS.config,
+                        find_key_node=find_key_node,
+                        FLAGS=FLAGS
+                    )[0]
+                    eval_metrics.update({f'seed{k}/evaluation/{key}': v for key, v in seed_eval_info.items()})
             if FLAGS.num_video_episodes > 0 and len(renders):
                 video = record_video('Video', i, renders=renders)
                 eval_metrics['video'] = video
@@ -503,38 +752,47 @@ def main(_):
                 )
                 eval_metrics['v'] = wandb.Image(image_v)
 
-            save_dict = dict(
-                agent=flax.serialization.to_state_dict(agent),
-                config=FLAGS.config.to_dict()
-            )
             if i == 1 or i % FLAGS.save_interval == 0:
-                rep_trajectory_fname = os.path.join(FLAGS.save_dir, f'rep_trajectories_{i}.pkl')
-                with open(rep_trajectory_fname, 'wb') as f:
-                    pickle.dump(np.array(rep_trajectories), f)
-                all_state_fname = os.path.join(FLAGS.save_dir, f'all_state_{i}.pkl')
-                with open(all_state_fname, 'wb') as f:
-                    pickle.dump(np.array(rep_observations), f)
-                key_node_fname = os.path.join(FLAGS.save_dir, f'key_node_{i}.pkl')
-                with open(key_node_fname, 'wb') as f:
-                    pickle.dump(np.array(key_nodes.pos), f)
-                
-                cos_distances_path = os.path.join(FLAGS.save_dir, f'cos_distances_{i}.pkl')
-                with open(cos_distances_path, 'wb') as f:
-                    pickle.dump(np.array(cos_distances), f)
-                
-                fname = os.path.join(FLAGS.save_dir, f'params_{i}.pkl')
-                print(f'Saving to {fname}')
-                with open(fname, "wb") as f:
-                    pickle.dump(save_dict, f)         
+                # device -> host 복사만 training thread에서 하고 파일 쓰기는 background thread (CheckpointManager)
+                rng_name, rng_keys, rng_pos, rng_has_gauss, rng_cached_gaussian = np.random.get_state()
+                checkpoint = dict(
+                    agent=flax.serialization.to_state_dict(agent),
+                    rep_trajectories=np.array(rep_trajectories),
+                    cos_distances=np.array(cos_distances),
+                    numpy_rng=rng_keys,
+                )
+                if FLAGS.use_rep:
+                    checkpoint['all_state'] = rep_observations
+                if key_nodes is not None:
+                    checkpoint['key_node'] = key_nodes.pos
+                for k in range(1, FLAGS.num_seeds):
+                    checkpoint[f'agent_seed{k}'] = flax.serialization.to_state_dict(learner.unstack_agent(seed_agents, k))
+                print(f'Saving checkpoint {i} to {checkpoint_manager.directory}')
+                checkpoint_manager.save(i, checkpoint, metadata=dict(
+                    config=FLAGS.config.to_dict(), numpy_rng_state=[rng_pos, rng_has_gauss, rng_cached_gaussian]))
             if 'calvin' in FLAGS.env_name:
                 score = eval_metrics['evaluation/final.return']
             else:
                 score = eval_metrics['evaluation/episode.return']
+            # 함수별 trace(=compile) 횟수: eval 간격마다 늘어나면 재컴파일이 발생하는 것
+            eval_metrics.update({f'compile/{k}': v for k, v in trace_counts.items()})
+            print('Trace counts:', dict(trace_counts))
             wandb.log(eval_metrics, step=i)
             eval_logger.log(eval_metrics, step=i)
+            if FLAGS.data_parallel_On:
+                # eval 중 key_nodes가 바뀐 agent를 다시 복제
+                replicated_agent = jax_utils.replicate(agent)
+            if FLAGS.num_seeds > 1 and agent.key_nodes is not None:
+                seed_agents = seed_agents.replace(key_nodes=jnp.stack([agent.key_nodes] * FLAGS.num_seeds))
             
+    if batch_sampler is not None:
+        batch_sampler.close()
     train_logger.close()
     eval_logger.close()
+    checkpoint_manager.close()
+    if FLAGS.num_seeds > 1:
+        for seed_train_logger in seed_train_loggers:
+            seed_train_logger.close()
 
 if __name__ == '__main__':
     import random
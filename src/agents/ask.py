@@ -6,7 +6,7 @@ import jax
 import jax.numpy as jnp
 import numpy as np
 import optax
-from jaxrl_m.common import TrainState, target_update
+from jaxrl_m.common import TrainState, target_update, count_traces
 from jaxrl_m.networks import Policy, Critic, ensemblize, DiscretePolicy
 from jaxrl_m.evaluation import supply_rng
 from functools import partial
@@ -25,29 +25,70 @@ def expectile_loss(adv, diff, expectile=0.7):
     weight = jnp.where(adv >= 0, expectile, (1 - expectile))
     return weight * (diff**2)
 
-def compute_actor_loss(agent, batch, network_params):
-    if agent.config['use_rep'] == "vae_encoder":
-        cur_goals, _, _ = agent.network(batch['low_goals'], method='vae_state_encoder', params=network_params)
-        observations, _, _ = agent.network(batch['observations'], method='vae_state_encoder', params=network_params)
-        next_observations, _, _ = agent.network(batch['next_observations'], method='vae_state_encoder', params=network_params)        
-        
-    elif agent.config['use_rep'] == "hilp_encoder":
-        cur_goals = agent.network(batch['low_goals'], method='hilp_phi')
-        observations = agent.network(batch['observations'], method='hilp_phi')
-        next_observations = agent.network(batch['next_observations'], method='hilp_phi')
-        
-    elif agent.config['use_rep'] == "hilp_subgoal_encoder":
-        cur_goals = agent.network(batch['low_goals'], method='hilp_phi')
-        observations = batch['observations']
-        next_observations = batch['next_observations'] 
+def split_rows(x, sizes):
+    return jnp.split(x, np.cumsum(sizes)[:-1])
+
+def shared_forward(agent, inputs, method='value', params=None):
+    """
+    One `agent.network(observations, goals, method=method)` call over the row-wise concatenation of
+    `inputs` ([(observations, goals), ...]), split back into per-input outputs. Every network here is
+    row-independent, so this equals calling it once per input. Outputs must be row-major ((v1, v2) of
+    `value` / `target_value`, not the (ensemble, rows) array of `hilp_value`).
+    """
+    sizes = [len(observations) for observations, _ in inputs]
+    observations = jnp.concatenate([observations for observations, _ in inputs], axis=0)
+    goals = jnp.concatenate([goals for _, goals in inputs], axis=0)
+    outputs, treedef = jax.tree_util.tree_flatten(agent.network(observations, goals, method=method, params=params))
+    outputs = [split_rows(x, sizes) for x in outputs]
+    return [treedef.unflatten([x[i] for x in outputs]) for i in range(len(inputs))]
+
+def encode_batch(agent, batch, network_params, keys):
+    """
+    Encodes every batch key in `keys` with one encoder forward pass, shared by all loss terms of an update.
 
+    vae_encoder: the encoder runs with `network_params`, so every loss still backpropagates into it;
+        the `mean` / `std` of `observations` are kept for the reconstruction loss.
+    hilp_encoder: phi of every key with the current params (no gradient, as `hilp_phi` without `params`).
+    hilp_subgoal_encoder: phi of the goals only, plus `high_targets_phi` (high actor target).
+    """
+    use_rep = agent.config['use_rep']
+    reps = {k: batch[k] for k in keys}
+    if use_rep in ["vae_encoder", "hilp_encoder"]:
+        encode_keys = list(keys)
+    elif use_rep == "hilp_subgoal_encoder":
+        encode_keys = [k for k in keys if k in ('goals', 'low_goals', 'high_goals', 'high_targets')]
     else:
-        cur_goals = batch['low_goals']
-        observations = batch['observations']
-        next_observations = batch['next_observations']
-        
-    v1, v2 = agent.network(observations, cur_goals, method='value')
-    nv1, nv2 = agent.network(next_observations, cur_goals, method='value')
+        return reps
+    if not encode_keys:
+        return reps
+
+    sizes = [len(batch[k]) for k in encode_keys]
+    inputs = jnp.concatenate([batch[k] for k in encode_keys], axis=0)
+    if use_rep == "vae_encoder":
+        z, mean, std = agent.network(inputs, method='vae_state_encoder', params=network_params)
+        reps.update(zip(encode_keys, split_rows(z, sizes)))
+        if 'observations' in encode_keys:
+            i = encode_keys.index('observations')
+            reps['observations_mean'] = split_rows(mean, sizes)[i]
+            reps['observations_std'] = split_rows(std, sizes)[i]
+    else:
+        phi = dict(zip(encode_keys, split_rows(agent.network(inputs, method='hilp_phi'), sizes)))
+        if use_rep == "hilp_subgoal_encoder":
+            reps['high_targets_phi'] = phi.pop('high_targets', None)
+        reps.update(phi)
+    return reps
+
+def compute_actor_loss(agent, batch, network_params, reps=None, values=None):
+    # reps: encode_batch 결과, values: shared_forward로 미리 계산한 ((v1, v2), (nv1, nv2))
+    if reps is None:
+        reps = encode_batch(agent, batch, network_params, ('low_goals', 'observations', 'next_observations'))
+    cur_goals = reps['low_goals']
+    observations = reps['observations']
+    next_observations = reps['next_observations']
+
+    if values is None:
+        values = shared_forward(agent, [(observations, cur_goals), (next_observations, cur_goals)])
+    (v1, v2), (nv1, nv2) = values
     v = (v1 + v2) / 2
     nv = (nv1 + nv2) / 2
 
@@ -67,30 +108,19 @@ def compute_actor_loss(agent, batch, network_params):
         'mse': jnp.mean((dist.mode() - batch['actions'])**2),
     }
 
-def compute_high_actor_loss(agent, batch, network_params):
-    if agent.config['use_rep'] == "vae_encoder":
-        cur_goals, _, _ = agent.network(batch['high_goals'], method='vae_state_encoder', params=network_params)
-        observations, _, _ = agent.network(batch['observations'], method='vae_state_encoder', params=network_params)
-        #if agent.config['keynode_ratio']:
-        #    length = int(len(observations)*agent.config['keynode_ratio'])
-        #    batch['high_targets'] = jnp.concatenate([batch['high_targets'][:length], batch['key_node'][length:]], axis=0)
-        high_targets, _, _ = agent.network(batch['high_targets'], method='vae_state_encoder', params=network_params)
-        
-    elif agent.config['use_rep'] == "hilp_encoder":
-        cur_goals = agent.network(batch['high_goals'], method='hilp_phi')
-        observations = agent.network(batch['observations'], method='hilp_phi')
-        high_targets = agent.network(batch['high_targets'] , method='hilp_phi')
-    elif agent.config['use_rep'] == "hilp_subgoal_encoder":
-        cur_goals = agent.network(batch['high_goals'], method='hilp_phi')
-        observations = batch['observations']
-        high_targets = batch['high_targets']
-    else:
-        cur_goals = batch['high_goals']
-        observations = batch['observations']
-        high_targets = batch['high_targets']
-    
-    v1, v2 = agent.network(observations, cur_goals, method='value')
-    nv1, nv2 = agent.network(high_targets, cur_goals, method='value')
+def compute_high_actor_loss(agent, batch, network_params, reps=None, values=None):
+    if reps is None:
+        reps = encode_batch(agent, batch, network_params, ('high_goals', 'observations', 'high_targets'))
+    #if agent.config['keynode_ratio']:
+    #    length = int(len(observations)*agent.config['keynode_ratio'])
+    #    batch['high_targets'] = jnp.concatenate([batch['high_targets'][:length], batch['key_node'][length:]], axis=0)
+    cur_goals = reps['high_goals']
+    observations = reps['observations']
+    high_targets = reps['high_targets']
+
+    if values is None:
+        values = shared_forward(agent, [(observations, cur_goals), (high_targets, cur_goals)])
+    (v1, v2), (nv1, nv2) = values
     v = (v1 + v2) / 2
     nv = (nv1 + nv2) / 2
 
@@ -106,7 +136,7 @@ def compute_high_actor_loss(agent, batch, network_params):
     elif agent.config['use_rep'] == "hilp_encoder":
         target = high_targets 
     elif agent.config['use_rep'] == "hilp_subgoal_encoder":
-        target = agent.network(observations=high_targets, method='hilp_phi')
+        target = reps['high_targets_phi']
     else:
         target = high_targets - observations
     
@@ -122,38 +152,24 @@ def compute_high_actor_loss(agent, batch, network_params):
         'high_scale': dist.scale_diag.mean(),
     }
 
-def compute_value_loss(agent, batch, network_params):
+def compute_value_loss(agent, batch, network_params, reps=None):
     batch['masks'] = 1.0 - batch['rewards']
     batch['rewards'] = batch['rewards'] - 1.0
-    if agent.config['use_rep'] == "vae_encoder":
-        observations, _, _ = agent.network(batch['observations'], method='vae_state_encoder', params=network_params)
-        next_observations, _, _ = agent.network(batch['next_observations'], method='vae_state_encoder', params=network_params)
-        # 질문 왜 vae만 하는지여부
-        #if agent.config['keynode_ratio']:
-        #    length = int(agent.config['keynode_ratio']*len(observations))
-        #    batch['goals'] = jnp.concatenate([batch['goals'][:length], batch['key_node'][length:]], axis=0)
-        cur_goals, _, _ = agent.network(batch['goals'], method='vae_state_encoder', params=network_params)
-    
-    elif agent.config['use_rep'] == "hilp_encoder":
-        cur_goals = agent.network(batch['goals'], method='hilp_phi')
-        observations = agent.network(batch['observations'], method='hilp_phi')
-        next_observations = agent.network(batch['next_observations'], method='hilp_phi')
-        
-    elif agent.config['use_rep'] == "hilp_subgoal_encoder":
-        cur_goals = agent.network(batch['goals'], method='hilp_phi')
-        observations = batch['observations']
-        next_observations = batch['next_observations']
-
-    else:
-        cur_goals = batch['goals']
-        observations = batch['observations']
-        next_observations = batch['next_observations']
-    
-    (next_v1, next_v2) = agent.network(next_observations, cur_goals, method='target_value')
+    if reps is None:
+        reps = encode_batch(agent, batch, network_params, ('goals', 'observations', 'next_observations'))
+    # 질문 왜 vae만 하는지여부
+    #if agent.config['keynode_ratio']:
+    #    length = int(agent.config['keynode_ratio']*len(observations))
+    #    batch['goals'] = jnp.concatenate([batch['goals'][:length], batch['key_node'][length:]], axis=0)
+    cur_goals = reps['goals']
+    observations = reps['observations']
+    next_observations = reps['next_observations']
+
+    # target value는 next / current를 한번에 계산
+    (next_v1, next_v2), (v1_t, v2_t) = shared_forward(agent, [(next_observations, cur_goals), (observations, cur_goals)], method='target_value')
     next_v = jnp.minimum(next_v1, next_v2)
     q = batch['rewards'] + agent.config['discount'] * batch['masks'] * next_v
 
-    (v1_t, v2_t) = agent.network(observations, cur_goals, method='target_value')
     v_t = (v1_t + v2_t) / 2
     adv = q - v_t
 
@@ -208,7 +224,7 @@ def hilp_compute_value_loss(agent, batch, network_params):
         'accept prob': (adv >= 0).mean(),
     }
     
-def vae_recon_loss(agent, batch, network_params):
+def vae_recon_loss(agent, batch, network_params, reps=None):
     """
     ELBO: E_p[log(x)] - KL(d||q), where p ~ Be(0.5) and q ~ N(0,1)
     KL(p, q) = H(p, q) - H(p) = -\int p(x)log(q(x))dx - -\int p(x)log(p(x))dx
@@ -216,7 +232,9 @@ def vae_recon_loss(agent, batch, network_params):
             = 0.5 * [-log(|s1|) - 1 + tr(s1) + m1^2] (if m2 = 0, s2 = 1)
     """
     observations = batch['observations']
-    z, mean, std = agent.network(observations, method = 'vae_state_encoder', params=network_params)
+    if reps is None:
+        reps = encode_batch(agent, batch, network_params, ('observations',))
+    z, mean, std = reps['observations'], reps['observations_mean'], reps['observations_std']
     output = agent.network(z, method = 'vae_state_decoder', params=network_params)
     var = jnp.square(std)
     rc_loss = -jnp.mean(jnp.square(observations - output), axis=-1)
@@ -236,14 +254,34 @@ class JointTrainAgent(iql.IQLAgent):
     network: TrainState = None
     key_nodes : dict = None
     
-    def pretrain_update(agent, pretrain_batch, seed=None, value_update=True, actor_update=True, high_actor_update=True):
+    def pretrain_update(agent, pretrain_batch, seed=None, value_update=True, actor_update=True, high_actor_update=True, pmap_axis=None):
         def loss_fn(network_params):
             info = {}
             a = 0
             b=0
+            # 각 batch key의 encoder 출력을 한번만 계산해서 모든 loss에서 공유
+            keys = []
+            if value_update:
+                keys += ['goals', 'observations', 'next_observations']
+            if actor_update:
+                keys += ['low_goals', 'observations', 'next_observations']
+            if high_actor_update:
+                keys += ['high_goals', 'observations', 'high_targets']
+            if agent.config['use_rep'] == "vae_encoder":
+                keys += ['observations']
+            reps = encode_batch(agent, pretrain_batch, network_params, tuple(dict.fromkeys(keys)))
+
+            # actor / high actor의 advantage용 value (params 없음)를 한번에 계산
+            value_inputs = []
+            if actor_update:
+                value_inputs += [(reps['observations'], reps['low_goals']), (reps['next_observations'], reps['low_goals'])]
+            if high_actor_update:
+                value_inputs += [(reps['observations'], reps['high_goals']), (reps['high_targets'], reps['high_goals'])]
+            values = shared_forward(agent, value_inputs) if value_inputs else []
+
             # Value
             if value_update:
-                value_loss, value_info = compute_value_loss(agent, pretrain_batch, network_params)
+                value_loss, value_info = compute_value_loss(agent, pretrain_batch, network_params, reps=reps)
                 for k, v in value_info.items():
                     info[f'value/{k}'] = v
             else:
@@ -251,7 +289,7 @@ class JointTrainAgent(iql.IQLAgent):
 
             # Actor
             if actor_update:
-                actor_loss, actor_info = compute_actor_loss(agent, pretrain_batch, network_params)
+                actor_loss, actor_info = compute_actor_loss(agent, pretrain_batch, network_params, reps=reps, values=values[:2])
                 for k, v in actor_info.items():
                     info[f'actor/{k}'] = v
             else:
@@ -259,7 +297,7 @@ class JointTrainAgent(iql.IQLAgent):
 
             # High Actor
             if high_actor_update:
-                high_actor_loss, high_actor_info = compute_high_actor_loss(agent, pretrain_batch, network_params)
+                high_actor_loss, high_actor_info = compute_high_actor_loss(agent, pretrain_batch, network_params, reps=reps, values=values[-2:])
                 for k, v in high_actor_info.items():
                     info[f'high_actor/{k}'] = v
             else:
@@ -275,7 +313,7 @@ class JointTrainAgent(iql.IQLAgent):
                 
             # VAE-Reconstrunction
             if agent.config['use_rep'] == "vae_encoder":
-                rc_loss, rc_info = vae_recon_loss(agent, pretrain_batch, network_params)
+                rc_loss, rc_info = vae_recon_loss(agent, pretrain_batch, network_params, reps=reps)
                 for k, v in rc_info.items():
                     info[f'recon/{k}'] = v
             else:
@@ -286,7 +324,8 @@ class JointTrainAgent(iql.IQLAgent):
             return loss, info
         
         # HIQL/HILP/VAE update (기울기 구한 것만 (params=network_params))
-        new_network, info = agent.network.apply_loss_fn(loss_fn=loss_fn, has_aux=True)
+        # pmap_axis: gradient / info를 device 평균 -> 모든 device의 params, target EMA가 동일하게 유지됨
+        new_network, info = agent.network.apply_loss_fn(loss_fn=loss_fn, has_aux=True, pmap_axis=pmap_axis)
         
         # HIQL update
         if value_update:
@@ -316,7 +355,34 @@ class JointTrainAgent(iql.IQLAgent):
             new_network = new_network.replace(params=freeze(params))
             
         return agent.replace(network=new_network), info
-    pretrain_update = jax.jit(pretrain_update, static_argnames=('value_update', 'actor_update', 'high_actor_update', 'use_rep'))
+    pretrain_update = jax.jit(count_traces('pretrain_update')(pretrain_update), static_argnames=('value_update', 'actor_update', 'high_actor_update', 'use_rep', 'pmap_axis'))
+
+    def pretrain_update_on_device(agent, sampler, batch_size=1024, value_update=True, actor_update=True, high_actor_update=True):
+        # sampler: DeviceGCSDataset (batch 샘플링까지 하나의 jit 안에서 수행, agent.rng로 인덱스 샘플링)
+        rng, sample_key = jax.random.split(agent.rng)
+        pretrain_batch = sampler.sample(sample_key, batch_size)
+        new_agent, info = agent.pretrain_update(pretrain_batch, value_update=value_update, actor_update=actor_update, high_actor_update=high_actor_update)
+        return new_agent.replace(rng=rng), info
+    pretrain_update_on_device = jax.jit(pretrain_update_on_device, static_argnames=('batch_size', 'value_update', 'actor_update', 'high_actor_update'))
+
+    def pretrain_update_many(agent, pretrain_batches=None, sampler=None, num_steps=1, batch_size=1024, info_reduce='mean', value_update=True, actor_update=True, high_actor_update=True):
+        # num_steps번의 update를 하나의 lax.scan으로 수행
+        # pretrain_batches: leading axis가 num_steps인 stacked batch // sampler: DeviceGCSDataset (pretrain_batches가 None일 때)
+        assert (pretrain_batches is None) != (sampler is None), 'Pass exactly one of pretrain_batches or sampler'
+        def update_step(agent, pretrain_batch):
+            if pretrain_batch is None:
+                return agent.pretrain_update_on_device(sampler, batch_size=batch_size, value_update=value_update, actor_update=actor_update, high_actor_update=high_actor_update)
+            return agent.pretrain_update(pretrain_batch, value_update=value_update, actor_update=actor_update, high_actor_update=high_actor_update)
+
+        agent, infos = jax.lax.scan(update_step, agent, pretrain_batches, length=num_steps)
+        if info_reduce == 'mean':
+            info = jax.tree_map(lambda x: x.mean(axis=0), infos)
+        elif info_reduce == 'last':
+            info = jax.tree_map(lambda x: x[-1], infos)
+        else:
+            raise ValueError(f"Unsupported info_reduce: {info_reduce}")
+        return agent, info
+    pretrain_update_many = jax.jit(pretrain_update_many, static_argnames=('num_steps', 'batch_size', 'info_reduce', 'value_update', 'actor_update', 'high_actor_update'))
 
     def sample_actions(agent,
                        observations: np.ndarray,
@@ -333,7 +399,7 @@ class JointTrainAgent(iql.IQLAgent):
             actions = dist.sample(seed=seed, sample_shape=num_samples)
         actions = jnp.clip(actions, -1, 1)
         return actions
-    sample_actions = jax.jit(sample_actions, static_argnames=('num_samples', 'low_dim_goals'))
+    sample_actions = jax.jit(count_traces('sample_actions')(sample_actions), static_argnames=('num_samples', 'low_dim_goals'))
 
     def sample_high_actions(agent,
                             observations: np.ndarray,
@@ -348,7 +414,7 @@ class JointTrainAgent(iql.IQLAgent):
         else:
             actions = dist.sample(seed=seed, sample_shape=num_samples)
         return actions
-    sample_high_actions = jax.jit(sample_high_actions, static_argnames=('num_samples',))
+    sample_high_actions = jax.jit(count_traces('sample_high_actions')(sample_high_actions), static_argnames=('num_samples',))
 
     @jax.jit
     def get_policy_rep(agent,
@@ -360,12 +426,14 @@ class JointTrainAgent(iql.IQLAgent):
 
     # HILP 
     @jax.jit
+    @count_traces('get_hilp_phi')
     def get_hilp_phi(agent,
                             *,
                             observations: jnp.ndarray) -> jnp.ndarray:
         return agent.network(observations=observations, method='hilp_phi')
     
     @jax.jit
+    @count_traces('get_value_goal')
     def get_value_goal(agent,
                             *,
                             targets: np.ndarray,
@@ -375,17 +443,60 @@ class JointTrainAgent(iql.IQLAgent):
     
     # VAE    
     @jax.jit
+    @count_traces('get_vae_state_rep')
     def get_vae_state_rep(agent,
                             *,
                             observation: jnp.ndarray) -> jnp.ndarray:
         return agent.network(targets=observation, method='vae_state_encoder')
     @jax.jit
+    @count_traces('get_vae_rep_state')
     def get_vae_rep_state(agent,
                             *,
                             latent: np.ndarray,
                             ) -> jnp.ndarray:
         return agent.network(targets=latent, method='vae_state_decoder')
-        
+
+@partial(jax.pmap, axis_name='devices')
+@count_traces('pretrain_update_pmap')
+def pretrain_update_pmap(agent, pretrain_batch):
+    """
+    Data-parallel `pretrain_update` over all local devices. `agent` is replicated (`flax.jax_utils.replicate`)
+    and `pretrain_batch` split with `jaxrl_m.common.shard_batch`; returns the replicated agent and info.
+    """
+    return agent.pretrain_update(pretrain_batch, pmap_axis='devices')
+
+def stack_agents(agents):
+    """Stacks agents of the same config along a new leading (seed) axis; static fields come from the first one."""
+    treedef = jax.tree_util.tree_structure(agents[0])
+    leaves = [jax.tree_util.tree_leaves(agent) for agent in agents]
+    return jax.tree_util.tree_unflatten(treedef, [jnp.stack(xs) for xs in zip(*leaves)])
+
+def unstack_agent(agents, index):
+    return jax.tree_map(lambda x: x[index], agents)
+
+@jax.jit
+@count_traces('pretrain_update_vmap')
+def pretrain_update_vmap(agents, pretrain_batches):
+    """`pretrain_update` of N stacked agents (`stack_agents`) on N stacked batches, vectorized over the seed axis."""
+    return jax.vmap(lambda agent, pretrain_batch: agent.pretrain_update(pretrain_batch))(agents, pretrain_batches)
+
+# Batched encoders over a whole dataset. Module-level with the agent as an explicit argument, so they are
+# traced once per input shape per run (not once per `jax.jit(jax.vmap(agent.method))` wrapper).
+@jax.jit
+@count_traces('batched_hilp_phi')
+def batched_hilp_phi(agent, *, observations):
+    return jax.vmap(lambda observation: agent.get_hilp_phi(observations=observation))(observations)
+
+@jax.jit
+@count_traces('batched_value_goal')
+def batched_value_goal(agent, *, targets, bases=None):
+    return jax.vmap(lambda target, base: agent.get_value_goal(targets=target, bases=base))(targets, bases)
+
+@jax.jit
+@count_traces('batched_vae_state_rep')
+def batched_vae_state_rep(agent, *, targets):
+    return jax.vmap(lambda target: agent.get_vae_state_rep(observation=target))(targets)
+
 def create_learner(
         seed: int,
         observations: jnp.ndarray,
@@ -403,6 +514,7 @@ def create_learner(
         rep_dim: int = 10,
         use_layer_norm: int = 1,
         key_nodes : Any = None,
+        compute_dtype: str = 'float32',
         flag : Any =None,
         **kwargs):
         print('Extra kwargs:', kwargs)
@@ -420,36 +532,42 @@ def create_learner(
         high_policy_state_encoder = None # img
         high_policy_goal_encoder = None # img
                 
-        value_def = MonolithicVF(hidden_dims=value_hidden_dims, use_layer_norm=use_layer_norm)
+        # compute_dtype: activation / matmul dtype (float32, bfloat16). params, LayerNorm, network outputs는 float32 유지
+        # float16은 loss scaling / overflow 처리가 없어서 지원하지 않음 (bfloat16은 float32와 exponent 범위가 같음)
+        if compute_dtype not in ('float32', 'bfloat16'):
+            raise ValueError(f"Unsupported compute_dtype: {compute_dtype} (float32 / bfloat16)")
+        dtype = jnp.dtype(compute_dtype)
+        
+        value_def = MonolithicVF(hidden_dims=value_hidden_dims, use_layer_norm=use_layer_norm, dtype=dtype)
         action_dim = actions.shape[-1]
-        actor_def = Policy(actor_hidden_dims, action_dim=action_dim, log_std_min=-5.0, state_dependent_std=False, tanh_squash_distribution=False)
+        actor_def = Policy(actor_hidden_dims, action_dim=action_dim, log_std_min=-5.0, state_dependent_std=False, tanh_squash_distribution=False, dtype=dtype)
         
         def make_encoder(bottleneck):
             # 0610 승호수정 goal only
             if bottleneck:
-                return RelativeRepresentation(rep_dim=rep_dim, hidden_dims=(*value_hidden_dims, rep_dim), layer_norm=use_layer_norm, bottleneck=flag.rep_normalizing_On, rep_type=flag.rep_type)
+                return RelativeRepresentation(rep_dim=rep_dim, hidden_dims=(*value_hidden_dims, rep_dim), layer_norm=use_layer_norm, bottleneck=flag.rep_normalizing_On, rep_type=flag.rep_type, dtype=dtype)
             else:
-                return RelativeRepresentation(rep_dim=value_hidden_dims[-1], hidden_dims=(*value_hidden_dims, value_hidden_dims[-1]), layer_norm=use_layer_norm, bottleneck=False, rep_type=flag.rep_type)
+                return RelativeRepresentation(rep_dim=value_hidden_dims[-1], hidden_dims=(*value_hidden_dims, value_hidden_dims[-1]), layer_norm=use_layer_norm, bottleneck=False, rep_type=flag.rep_type, dtype=dtype)
         
         if flag.use_rep == 'hiql_goal_encoder':
             value_goal_encoder = make_encoder(bottleneck=True)
         
         elif flag.use_rep in ['hilp_subgoal_encoder', 'hilp_encoder']: 
-            hilp_value_goal_encoder = HILP_GoalConditionedPhiValue(hidden_dims=(512, 512, 512), use_layer_norm=use_layer_norm, ensemble=True, skill_dim=flag.hilp_skill_dim, encoder=False)
+            hilp_value_goal_encoder = HILP_GoalConditionedPhiValue(hidden_dims=(512, 512, 512), use_layer_norm=use_layer_norm, ensemble=True, skill_dim=flag.hilp_skill_dim, encoder=False, dtype=dtype)
             
         elif flag.use_rep == "vae_encoder":
             value_goal_encoder = make_encoder(bottleneck=True)
-            vae_state_encoder = Vae_Encoder(rep_dim=rep_dim, hidden_dim=state_hidden_dims, layer_norm=use_layer_norm)
-            vae_state_decoder = Vae_Decoder(hidden_dim=state_hidden_dims[::-1], layer_norm=use_layer_norm, output_shape=observations.shape[-1])
+            vae_state_encoder = Vae_Encoder(rep_dim=rep_dim, hidden_dim=state_hidden_dims, layer_norm=use_layer_norm, dtype=dtype)
+            vae_state_decoder = Vae_Decoder(hidden_dim=state_hidden_dims[::-1], layer_norm=use_layer_norm, output_shape=observations.shape[-1], dtype=dtype)
         
         if flag.use_rep in ["hilp_subgoal_encoder", "hilp_encoder"]:
             high_action_dim = flag.hilp_skill_dim
         elif flag.use_rep in ["hiql_goal_encoder", "vae_encoder"]:
             high_action_dim = rep_dim
         else:
-            observations.shape[-1]
+            high_action_dim = observations.shape[-1]
             
-        high_actor_def = Policy(actor_hidden_dims, action_dim=high_action_dim, log_std_min=-5.0, state_dependent_std=False, tanh_squash_distribution=False)
+        high_actor_def = Policy(actor_hidden_dims, action_dim=high_action_dim, log_std_min=-5.0, state_dependent_std=False, tanh_squash_distribution=False, dtype=dtype)
 
         network_def = HierarchicalActorCritic(
             encoders={                
@@ -486,6 +604,7 @@ def create_learner(
             discount=discount, temperature=temperature, high_temperature=high_temperature,
             target_update_rate=tau, pretrain_expectile=pretrain_expectile, way_steps=way_steps, keynode_ratio=flag.keynode_ratio, 
             env_name=kwargs['env_name'], use_rep=flag.use_rep, vae_recon_coe=flag.vae_recon_coe, vae_kl_coe=flag.vae_kl_coe,
+            compute_dtype=dtype.name,
         ))
 
         return JointTrainAgent(rng, network=network, critic=None, value=None, target_value=None, actor=None, config=config, key_nodes=key_nodes)
@@ -0,0 +1,163 @@
+from typing import *
+
+import jax
+import jax.numpy as jnp
+import flax
+from jax import lax
+
+from jaxrl_m.common import count_traces
+from jaxrl_m.evaluation import eval_goal_schedule
+
+
+class ASKPolicyState(flax.struct.PyTreeNode):
+    """Per-episode state carried between `ASKPolicy` steps."""
+    obs_goal: Any  # (encoded) final goal
+    cur_obs_goal: Any  # goal given to the low-level policy (subgoal, possibly snapped to a key node)
+    cur_obs_sub_goal: Any  # last subgoal from the high-level policy
+    h_step: Any
+    dist: Any
+    init_dist: Any
+    rng: Any
+
+
+class ASKPolicy:
+    """
+    Hierarchical evaluation policy whose whole step is a single jitted function.
+
+    One call covers the observation encoder, the subgoal refresh (`lax.cond` on `h_step == interval`
+    or the relative-distance criterion), key-node snapping, the optional key-node graph plan
+    (`graph_plan_in_eval_On`) and the low-level action, matching the per-step
+    logic of `evaluate_with_trajectories`. The small per-episode state is an `ASKPolicyState` pytree.
+
+    Build one per run: the agent and the key nodes (`KeyNodeArrays`, exact search) are jit arguments that
+    `bind` swaps in before each evaluation, so re-clustering or evaluating another seed does not recompile.
+
+    Example:
+        ask_policy = ASKPolicy(FLAGS.env_name, flags=FLAGS, config=FLAGS.config)
+        ask_policy.bind(agent, key_nodes.lookup_arrays, seed=i)
+        state = ask_policy.reset(observation, obs_goal)
+        action, state, info = ask_policy(state, observation)
+    """
+
+    def __init__(self, env_name, flags=None, config=None, temperature=0.):
+        self.flags = flags
+        self.use_keynode = bool(config['use_keynode_in_eval_On'])
+        self.graph_plan = bool(flags.graph_plan_in_eval_On)
+        self.temperature = temperature
+        self.node_dim, self.interval = eval_goal_schedule(env_name)
+        self.agent = None
+        self.key_node_arrays = None
+        self.rng = jax.random.PRNGKey(0)
+        self._encode_goal = jax.jit(count_traces("ask_policy_encode_goal")(self.encode_goal))
+        self._step = jax.jit(count_traces("ask_policy_step")(self.step))
+
+    def bind(self, agent, key_node_arrays=None, seed=0):
+        """Sets the agent / key nodes used by `reset` and `__call__`."""
+        self.agent = agent
+        self.key_node_arrays = key_node_arrays
+        self.rng = jax.random.PRNGKey(seed)
+        return self
+
+    def encode_goal(self, agent, obs_goal):
+        if self.flags.use_rep == "vae_encoder":
+            obs_goal, _, _ = agent.get_vae_state_rep(observation=obs_goal)
+        elif self.flags.use_rep in ["hilp_subgoal_encoder", "hilp_encoder"]:
+            obs_goal = agent.get_hilp_phi(observations=obs_goal)
+        return obs_goal
+
+    def encode_observation(self, agent, observation, obs_goal):
+        """Returns the observation fed to the policies and its representation used for the distance checks."""
+        use_rep = self.flags.use_rep
+        if use_rep == "vae_encoder":
+            observation, _, _ = agent.get_vae_state_rep(observation=observation)
+        elif use_rep == "hilp_encoder":
+            observation = agent.get_hilp_phi(observations=observation)
+
+        if use_rep == "hilp_encoder":
+            cur_obs_delta = observation
+        elif use_rep == "hilp_subgoal_encoder":
+            cur_obs_delta = agent.get_hilp_phi(observations=observation)
+        elif use_rep in ["hiql_goal_encoder", "vae_encoder"] or self.flags.relative_dist_in_eval_On:
+            cur_obs_delta = agent.get_value_goal(bases=observation, targets=obs_goal)
+        else:
+            cur_obs_delta = None
+        return observation, cur_obs_delta
+
+    def subgoal(self, agent, observation, obs_goal, seed):
+        cur_obs_subgoal = agent.sample_high_actions(observations=observation, goals=obs_goal, seed=seed, temperature=self.temperature)
+        if self.flags.use_rep in ["hiql_goal_encoder", "vae_encoder"]:
+            if self.flags.rep_normalizing_On:
+                cur_obs_subgoal = cur_obs_subgoal / jnp.linalg.norm(cur_obs_subgoal, axis=-1, keepdims=True) * jnp.sqrt(cur_obs_subgoal.shape[-1])
+            else:
+                cur_obs_subgoal = observation + cur_obs_subgoal
+        elif self.flags.use_rep not in ["hilp_encoder", "hilp_subgoal_encoder"]:
+            cur_obs_subgoal = observation + cur_obs_subgoal
+        return cur_obs_subgoal
+
+    def step(self, agent, key_node_arrays, state: ASKPolicyState, observation):
+        rng, high_key, low_key = jax.random.split(state.rng, 3)
+        observation, cur_obs_delta = self.encode_observation(agent, observation, state.obs_goal)
+
+        def refresh(_):
+            cur_obs_subgoal = self.subgoal(agent, observation, state.obs_goal, high_key)
+            if self.flags.relative_dist_in_eval_On:
+                init_dist = jnp.linalg.norm(cur_obs_subgoal - cur_obs_delta)
+            else:
+                init_dist = state.init_dist
+            return cur_obs_subgoal, cur_obs_subgoal, jnp.zeros_like(state.h_step), init_dist
+
+        def keep(_):
+            return state.cur_obs_goal, state.cur_obs_sub_goal, state.h_step, state.init_dist
+
+        cur_obs_goal, cur_obs_sub_goal, h_step, init_dist = lax.cond(
+            (state.h_step == self.interval) | (state.dist < state.init_dist * 0.5), refresh, keep, None)
+
+        if self.flags.use_rep in ["hiql_goal_encoder", "vae_encoder"]:
+            dist = jnp.linalg.norm(cur_obs_goal - cur_obs_delta)
+        elif self.flags.use_rep in ["hilp_encoder", "hilp_subgoal_encoder"]:
+            dist = state.dist
+        else:
+            dist = jnp.linalg.norm(cur_obs_goal[self.node_dim] - observation[self.node_dim])
+        h_step = h_step + 1
+
+        info = dict(observation=observation, cur_obs_delta=cur_obs_delta, h_step=h_step, dist=dist)
+        if self.use_keynode and key_node_arrays is not None:
+            cos_distance, _, _, cur_obs_key_node = key_node_arrays.find_node_pos(cur_obs_sub_goal)
+            cur_obs_goal = jnp.where(cos_distance >= self.flags.mapping_threshold, cur_obs_key_node, cur_obs_goal)
+            info['cos_distance'] = cos_distance
+
+        if self.graph_plan and key_node_arrays is not None and key_node_arrays.next_hop is not None:
+            # key node와 같은 공간에서의 현재 state / goal (hiql은 rep_type == 'state'의 value_goal(x, x))
+            if self.flags.use_rep == "hiql_goal_encoder":
+                state_rep = agent.get_value_goal(bases=observation, targets=observation)
+                goal_rep = agent.get_value_goal(bases=state.obs_goal, targets=state.obs_goal)
+            elif self.flags.use_rep == "hilp_subgoal_encoder":
+                state_rep, goal_rep = cur_obs_delta, state.obs_goal
+            else:
+                state_rep, goal_rep = observation, state.obs_goal
+            planned, planned_subgoal = key_node_arrays.plan_subgoal(state_rep, goal_rep)
+            cur_obs_goal = jnp.where(planned, planned_subgoal, cur_obs_goal)
+
+        action = agent.sample_actions(observations=observation, goals=cur_obs_goal, low_dim_goals=True, seed=low_key, temperature=self.temperature)
+        state = state.replace(cur_obs_goal=cur_obs_goal, cur_obs_sub_goal=cur_obs_sub_goal, h_step=h_step, dist=dist, init_dist=init_dist, rng=rng)
+        return action, state, info
+
+    def reset(self, observation, obs_goal) -> ASKPolicyState:
+        """Initial state for a new episode; the first step always draws a fresh subgoal."""
+        self.rng, rng = jax.random.split(self.rng)
+        obs_goal = self._encode_goal(self.agent, obs_goal)
+        subgoal_shape = jax.eval_shape(
+            lambda: self.subgoal(self.agent, self.encode_observation(self.agent, observation, obs_goal)[0], obs_goal, rng))
+        empty_subgoal = jnp.zeros(subgoal_shape.shape, subgoal_shape.dtype)
+        return ASKPolicyState(
+            obs_goal=obs_goal,
+            cur_obs_goal=empty_subgoal,
+            cur_obs_sub_goal=empty_subgoal,
+            h_step=jnp.asarray(self.interval, dtype=jnp.int32),
+            dist=jnp.asarray(0., dtype=jnp.float32),
+            init_dist=jnp.asarray(1e5 if self.flags.relative_dist_in_eval_On else 0., dtype=jnp.float32),
+            rng=rng,
+        )
+
+    def __call__(self, state: ASKPolicyState, observation):
+        return self._step(self.agent, self.key_node_arrays, state, observation)
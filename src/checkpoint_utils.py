@@ -0,0 +1,151 @@
+import os
+import json
+import queue
+import shutil
+import tempfile
+import threading
+import numpy as np
+import jax
+from flax import traverse_util
+
+CHECKPOINT_PREFIX = 'checkpoint_'
+TMP_PREFIX = '.tmp_'
+
+
+def write_tree(directory, tree, compress=False):
+    """Writes every array leaf of a nested dict as its own `.npy` (`.npz` when compressed) plus a manifest entry."""
+    os.makedirs(os.path.join(directory, 'arrays'), exist_ok=True)
+    entries = []
+    for n, (path, leaf) in enumerate(traverse_util.flatten_dict(tree, keep_empty_nodes=True).items()):
+        entry = {'path': list(path)}
+        if leaf is traverse_util.empty_node:
+            entry['kind'] = 'empty'
+        elif leaf is None or isinstance(leaf, (bool, int, float, str)):
+            entry['kind'] = 'value'
+            entry['value'] = leaf
+        else:
+            leaf = np.asarray(leaf)
+            if leaf.dtype == object:
+                # read_tree loads without pickle, so only numeric arrays are written
+                raise TypeError(f"Cannot checkpoint non-numeric array at {'/'.join(map(str, path))}")
+            entry['kind'] = 'array'
+            entry['file'] = os.path.join('arrays', f'{n}.npz' if compress else f'{n}.npy')
+            if compress:
+                np.savez_compressed(os.path.join(directory, entry['file']), data=leaf)
+            else:
+                np.save(os.path.join(directory, entry['file']), leaf)
+        entries.append(entry)
+    return entries
+
+
+def read_tree(directory, entries, mmap_mode=None):
+    flat = {}
+    for entry in entries:
+        path = tuple(entry['path'])
+        if entry['kind'] == 'empty':
+            flat[path] = traverse_util.empty_node
+        elif entry['kind'] == 'value':
+            flat[path] = entry['value']
+        elif entry['file'].endswith('.npz'):
+            with np.load(os.path.join(directory, entry['file'])) as f:
+                flat[path] = f['data']
+        else:
+            flat[path] = np.load(os.path.join(directory, entry['file']), mmap_mode=mmap_mode)
+    return traverse_util.unflatten_dict(flat)
+
+
+class CheckpointManager(object):
+    """
+    Non-blocking checkpoint writer with keep-last-K rotation.
+
+    `save` copies the whole tree to host with a single `jax.device_get` on the caller's thread and queues it;
+    a worker thread writes it (one file per array, `manifest.json`) into a temporary directory that is renamed
+    to `checkpoint_{step}` when complete, so a checkpoint directory is either complete or absent. Older
+    checkpoints beyond `keep` are then removed. `save` only blocks when `max_pending` writes are queued.
+
+    Example:
+        manager = CheckpointManager(os.path.join(save_dir, 'checkpoints'), keep=3)
+        manager.save(i, dict(agent=flax.serialization.to_state_dict(agent)), metadata=dict(config=config))
+        tree, metadata = manager.restore()  # latest
+        manager.close()
+    """
+
+    def __init__(self, directory, keep=3, compress=False, max_pending=2):
+        self.directory = directory
+        assert keep >= 1, "keep must be at least 1"
+        self.keep = keep
+        self.compress = compress
+        os.makedirs(directory, exist_ok=True)
+        # partial writes left behind by a run that was killed mid-checkpoint
+        for name in os.listdir(directory):
+            if name.startswith(TMP_PREFIX):
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def checkpoint_path(self, step):
+        return os.path.join(self.directory, f'{CHECKPOINT_PREFIX}{step}')
+
+    def all_steps(self):
+        steps = []
+        for name in os.listdir(self.directory):
+            if name.startswith(CHECKPOINT_PREFIX) and os.path.exists(os.path.join(self.directory, name, 'manifest.json')):
+                steps.append(int(name[len(CHECKPOINT_PREFIX):]))
+        return sorted(steps)
+
+    def latest_step(self):
+        steps = self.all_steps()
+        return steps[-1] if steps else None
+
+    def save(self, step, tree, metadata=None):
+        """Queues `tree` (nested dict of arrays / scalars) for writing; `metadata` must be JSON-serializable."""
+        if self.error is not None:
+            raise self.error
+        self.queue.put((step, jax.device_get(tree), metadata or {}))
+
+    def _write(self, step, tree, metadata):
+        tmp_dir = tempfile.mkdtemp(dir=self.directory, prefix=TMP_PREFIX)
+        manifest = dict(step=step, metadata=metadata, entries=write_tree(tmp_dir, tree, compress=self.compress))
+        with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, default=str)
+        path = self.checkpoint_path(step)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_dir, path)
+        for old_step in self.all_steps()[:-self.keep]:
+            shutil.rmtree(self.checkpoint_path(old_step), ignore_errors=True)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self._write(*item)
+            except Exception as e:  # raised on the next save / wait
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def restore(self, step=None, mmap_mode=None):
+        """Returns `(tree, metadata)` of checkpoint `step` (default: the latest)."""
+        step = self.latest_step() if step is None else step
+        if step is None:
+            raise FileNotFoundError(f'No checkpoint in {self.directory}')
+        path = self.checkpoint_path(step)
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        return read_tree(path, manifest['entries'], mmap_mode=mmap_mode), dict(manifest['metadata'], step=manifest['step'])
+
+    def wait(self):
+        """Blocks until every queued checkpoint is written."""
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.worker.join()
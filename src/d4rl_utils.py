@@ -2,9 +2,11 @@ import gym
 import d4rl
 import numpy as np
 
-from jaxrl_m.dataset import Dataset
+from jaxrl_m.dataset import Dataset, CompactDataset
 from jaxrl_m.evaluation import EpisodeMonitor
+from src import episode_utils
 
+import jax
 import jax.numpy as jnp
 
 
@@ -46,14 +48,9 @@ def get_dataset(env: gym.Env,
 
         if 'antmaze' in env_name:
             # antmaze: terminals are incorrect for GCRL
-            dones_float = np.zeros_like(dataset['rewards'])
             dataset['terminals'][:] = 0.
-            for i in range(len(dones_float) - 1):
-                if np.linalg.norm(dataset['observations'][i + 1] - dataset['next_observations'][i]) > 1e-6:
-                    dones_float[i] = 1
-                else:
-                    dones_float[i] = 0
-            dones_float[-1] = 1
+            episodes = episode_utils.from_discontinuities(dataset['observations'], dataset['next_observations'])
+            dones_float = episodes.dones_float
             dataset['rewards'], goal_info = relabel_ant(env, env_name, dataset, flag) # flags.use_goal_info_On 일때만, goal_info 반환하고 나머지는 None
         elif 'calvin' in env_name:
             dataset['rewards'] = relabel_calvin(env, env_name, dataset, flag)
@@ -73,7 +70,7 @@ def get_dataset(env: gym.Env,
                 returns, episode_index = None, None
             
         elif 'kitchen' in env_name:
-            returns, episode_index = calc_return_to_go_kitchen(dataset)
+            returns, episode_index = calc_return_to_go_kitchen(dataset, flag)
         elif 'calvin' in env_name:
             returns, episode_index = calc_return_to_go_calvin(dataset, flag)
         return Dataset.create(
@@ -100,43 +97,40 @@ def relabel_ant(env, env_name, dataset, flags):
         goal_info = goal_pos.reshape(999*1000, 2)
     elif 'ultra' in env_name:
         unique_goal_pos = np.array([[12,0], [40,0], [52,0], [0,16], [0,28], [32,36], [52,0], [52,16], [52,36]])
-        for idx, obs_pos in enumerate(observation_pos):
-            distance = np.linalg.norm(unique_goal_pos - obs_pos, axis=1)
-            index = np.where(distance <= 0.5, 1, 0)
-            if any(index) and np.linalg.norm(observation_pos[1000*(idx//1000)] - unique_goal_pos[index]) > 20: # 코드 잘못되었음 (추후 수정해야함)
-                new_rewards[idx] = 1.0
+        num_hits = count_goal_hits(observation_pos, unique_goal_pos, radius=0.5)
+        # 기존 코드와 동일한 결과 유지: 1000 step 단위 episode의 시작 위치와 unique_goal_pos[index] (index는 0/1 hit 배열) 사이의 norm
+        # (코드 잘못되었음 (추후 수정해야함)) => norm^2 = num_hits * |s - g1|^2 + (G - num_hits) * |s - g0|^2
+        start_pos = observation_pos[(np.arange(len(observation_pos)) // 1000) * 1000]
+        d0 = np.sum((start_pos - unique_goal_pos[0]) ** 2, axis=-1)
+        d1 = np.sum((start_pos - unique_goal_pos[1]) ** 2, axis=-1)
+        start_dist = np.sqrt(num_hits * d1 + (len(unique_goal_pos) - num_hits) * d0)
+        new_rewards[(num_hits > 0) & (start_dist > 20)] = 1.0
     elif 'large' in env_name:
         unique_goal_pos = np.array([[0,0],[0,12], [0,24], [12,22], [12,8], [20,16], [36,0], [32.75,24.75], [32,16]])
-        for idx, obs_pos in enumerate(observation_pos):
-            distance = np.linalg.norm(unique_goal_pos - obs_pos, axis=1)
-            index = np.where(distance <= 1, 1, 0)
-            if any(index):
-                new_rewards[idx] = 1.0
+        new_rewards[count_goal_hits(observation_pos, unique_goal_pos, radius=1) > 0] = 1.0
     elif 'medium' in env_name:
         unique_goal_pos = np.array([[20.5, 20.5]])
-        for idx, obs_pos in enumerate(observation_pos):
-            distance = np.linalg.norm(unique_goal_pos - obs_pos, axis=1)
-            index = np.where(distance <= 1, 1, 0)
-            if any(index):
-                new_rewards[idx] = 1.0 
+        new_rewards[count_goal_hits(observation_pos, unique_goal_pos, radius=1) > 0] = 1.0
     return new_rewards, goal_info
 
+def count_goal_hits(positions, goal_positions, radius):
+    # 각 position에 대해 radius 안에 들어오는 goal 개수 (goal 단위 loop => (N,) 크기 메모리만 사용)
+    num_hits = np.zeros(len(positions), dtype=np.int64)
+    for goal_pos in goal_positions:
+        num_hits += np.linalg.norm(positions - goal_pos, axis=1) <= radius
+    return num_hits
+
 # 질문: 승호 나중에 코드 체크
 def relabel_calvin(env, env_name, dataset, flags):
-    t = -1
-    for i, d in enumerate(dataset['observations'][:,15:21]):
-        if dataset['episodes'][i] != t:
-            t = dataset['episodes'][i] 
-            start_door, start_drawer, _, _, start_lightbulb, start_led = d
-        door, drawer, _, _, lightbulb, led = d
-        if abs(start_drawer - drawer) > 0.12:
-            dataset['rewards'][i] +=1
-        if start_lightbulb != lightbulb:
-            dataset['rewards'][i] +=1
-        if abs(start_door - door) > 0.15:
-            dataset['rewards'][i] +=1
-        if start_led != led:
-            dataset['rewards'][i] +=1
+    episodes = episode_utils.from_episode_ids(dataset['episodes'])
+    scene_state = dataset['observations'][:, 15:21]
+    start_state = scene_state[episodes.starts[episodes.episode_ids]]
+    door, drawer, lightbulb, led = (scene_state[:, k] for k in (0, 1, 4, 5))
+    start_door, start_drawer, start_lightbulb, start_led = (start_state[:, k] for k in (0, 1, 4, 5))
+    dataset['rewards'] += np.abs(start_drawer - drawer) > 0.12
+    dataset['rewards'] += start_lightbulb != lightbulb
+    dataset['rewards'] += np.abs(start_door - door) > 0.15
+    dataset['rewards'] += start_led != led
     return dataset['rewards']
 
 def calc_return_to_go_ant_trajectory(dataset):
@@ -158,179 +152,138 @@ def calc_return_to_go_ant_trajectory(dataset):
 
 def calc_return_to_go_ant(dataset):
     gamma=0.998
-    rewards = dataset['rewards'].reshape(999, -1) # ultra:(999,1000)
-    terminals = dataset['rewards'].reshape(999, -1) 
-    return_to_go = np.zeros(rewards.shape, dtype=np.float32)
-    prev_return = 0    
-    for i in range(return_to_go.shape[1]):
-        return_to_go[:,-i-1] = rewards[:,-i-1] + gamma * prev_return * (1 - terminals[:,-i-1])
-        prev_return = return_to_go[:,-i-1]
-    return return_to_go.reshape(-1), np.arange(len(dataset['observations'])).reshape(999,-1)
+    rewards = dataset['rewards']
+    # ultra:(999,1000) => 1000 step 단위 episode, reward를 받은 step에서 return 초기화 (terminals = rewards)
+    episodes = episode_utils.from_dones(np.arange(len(rewards)) % 1000 == 999)
+    return_to_go = episode_utils.discounted_return_to_go(rewards, episodes, gamma, terminals=rewards)
+    return return_to_go, np.arange(len(dataset['observations'])).reshape(999,-1)
 
 def calc_return_to_go_kitchen(dataset, flags):
-    def find_episode_index():
-        episode_index = []
-        expert_episode_index = []
-        tmp_episode = []
-        threshold = 3 if flags.expert_data_On else 1
-        for i, r in enumerate(dataset['rewards']):
-            tmp_episode.append(i)
-            if dataset['terminals'][i]:
-                if dataset['rewards'][i] >= threshold:
-                    expert_episode_index.append(np.array(tmp_episode))
-                episode_index.append(np.array(tmp_episode))
-                tmp_episode = []
-        return np.array(expert_episode_index) if flags.expert_data_On else np.array(episode_index)
     gamma=0.9
-    rewards = dataset['rewards']
-    terminals = dataset['terminals']
-    return_to_go = np.zeros(rewards.shape, dtype=np.float32)
-    episode_index = find_episode_index() 
-    prev_return = 0
-    for e in episode_index:
-        for i in e[::-1]:
-            return_to_go[i] = rewards[i] + gamma * prev_return * (1 - terminals[i])
-            prev_return = return_to_go[i] 
-    return return_to_go, episode_index
+    episodes = episode_utils.from_terminals(dataset['terminals'])
+    if flags.expert_data_On:
+        # 마지막 reward가 threshold 이상인 episode만 사용
+        selected = dataset['rewards'][episodes.ends] >= 3
+    else:
+        selected = np.ones(episodes.num_episodes, dtype=bool)
+    return_to_go = episode_utils.discounted_return_to_go(dataset['rewards'], episodes, gamma, terminals=dataset['terminals'])
+    return_to_go[~selected[episodes.episode_ids]] = 0.
+    return return_to_go, episodes.episode_index()[selected]
 
 # 질문: 승호 나중에 코드 체크
 def calc_return_to_go_calvin(dataset, flags):
     gamma=0.9
-    rewards = dataset['rewards']
-    terminals = dataset['terminals']
-    return_to_go = np.zeros(rewards.shape, dtype=np.float32)
-    def find_episode_index():
-        episode_index = []
-        expert_episode_index = []
-        tmp_episode = []
-        t = -1
-        for i, r in enumerate(dataset['rewards']):
-            if t != dataset['episodes'][i]:
-                if t != -1 and dataset['rewards'][i-1] >=4:
-                    expert_episode_index.append(np.array(tmp_episode))
-                episode_index.append(np.array(tmp_episode))
-                tmp_episode = []
-                t = dataset['episodes'][i]
-            tmp_episode.append(i)
-        
-        if flags.expert_data_On or dataset['rewards'][-1] >= 4:
-            expert_episode_index.append(np.array(tmp_episode))
-        episode_index.append(np.array(tmp_episode))
-
-        if episode_index and len(episode_index[0]) == 0:
-            episode_index.pop(0)
-            
-        return episode_index, expert_episode_index
-    def change_reward_sparse():
-        sparse_reward = [0]
-        for i, r in enumerate(dataset['rewards'][1:]):
-            if dataset['rewards'][i]==dataset['rewards'][i-1]:
-                sparse_reward.append(0)
-            else:
-                sparse_reward.append(1)
-        return sparse_reward
-    # sparse reward 적용시 reward -> sparse_reward로 변경
-    # reward = change_reward_sparse() # reward를 1번씩만 받도록 변경
-    episode_index, expert_episode_index = find_episode_index() # reward가 3이상인 episode의 index를 찾음
-    prev_return = 0
-    for e in expert_episode_index:
-        for i in e[::-1]:
-            return_to_go[i] = rewards[i] + gamma * prev_return * (1 - terminals[i])
-            prev_return = return_to_go[i]
-    return return_to_go.astype(np.float32), episode_index
+    episodes = episode_utils.from_episode_ids(dataset['episodes'])
+    # reward가 4이상인 episode의 index를 찾음 (expert_data_On이면 마지막 episode는 항상 포함)
+    expert = dataset['rewards'][episodes.ends] >= 4
+    if flags.expert_data_On:
+        expert[-1] = True
+    # sparse reward 적용시 reward -> sparse_reward로 변경 (reward를 1번씩만 받도록 변경)
+    # rewards = np.concatenate([[0], (dataset['rewards'][1:] != dataset['rewards'][:-1])])
+    return_to_go = episode_utils.discounted_return_to_go(dataset['rewards'], episodes, gamma, terminals=dataset['terminals'])
+    return_to_go[~expert[episodes.episode_ids]] = 0.
+    return return_to_go, list(episodes.episode_index())
 
 def sparse_data(dataset, sparse_data_index=None):
+    # CompactDataset이면 선택된 row의 next_observations만 복원하고 결과도 다시 compact하게 저장
+    next_observations = dataset['next_observations'][sparse_data_index]
     if 'rep_observations' in dataset and 'rep_next_observations' in dataset:
-        return Dataset.create(
+        sparse = Dataset.create(
             observations=dataset['observations'][sparse_data_index],
-            actions=dataset['actions'][sparse_data_index].astype(np.float32),
-            rewards=dataset['rewards'][sparse_data_index].astype(np.float32),
-            masks=1.0 - dataset['dones_float'][sparse_data_index].astype(np.float32),
-            dones_float=dataset['dones_float'][sparse_data_index].astype(np.float32),
-            next_observations=dataset['next_observations'][sparse_data_index],
+            actions=dataset['actions'][sparse_data_index].astype(np.float32, copy=False),
+            rewards=dataset['rewards'][sparse_data_index].astype(np.float32, copy=False),
+            masks=1.0 - dataset['dones_float'][sparse_data_index].astype(np.float32, copy=False),
+            dones_float=dataset['dones_float'][sparse_data_index].astype(np.float32, copy=False),
+            next_observations=next_observations,
             returns = dataset['returns'][sparse_data_index],
             goal_info = dataset['goal_info'],
             rep_observations = dataset['rep_observations'][sparse_data_index],
             rep_next_observations = dataset['rep_next_observations'][sparse_data_index]
         )
     else:
-        return Dataset.create(
+        sparse = Dataset.create(
             observations=dataset['observations'][sparse_data_index],
-            actions=dataset['actions'][sparse_data_index].astype(np.float32),
-            rewards=dataset['rewards'][sparse_data_index].astype(np.float32),
-            masks=1.0 - dataset['dones_float'][sparse_data_index].astype(np.float32),
-            dones_float=dataset['dones_float'][sparse_data_index].astype(np.float32),
-            next_observations=dataset['next_observations'][sparse_data_index],
+            actions=dataset['actions'][sparse_data_index].astype(np.float32, copy=False),
+            rewards=dataset['rewards'][sparse_data_index].astype(np.float32, copy=False),
+            masks=1.0 - dataset['dones_float'][sparse_data_index].astype(np.float32, copy=False),
+            dones_float=dataset['dones_float'][sparse_data_index].astype(np.float32, copy=False),
+            next_observations=next_observations,
             returns = dataset['returns'][sparse_data_index],
             goal_info = dataset['goal_info']
         )
+    if isinstance(dataset, CompactDataset):
+        return CompactDataset.compress(sparse)
+    return sparse
         
 def add_data(dataset, rep_observations=None, rep_next_observations=None):
-    return Dataset.create(
-            observations=dataset['observations'],
-            actions=dataset['actions'].astype(np.float32),
-            rewards=dataset['rewards'].astype(np.float32),
-            masks=1.0 - dataset['dones_float'].astype(np.float32),
-            dones_float=dataset['dones_float'].astype(np.float32),
-            next_observations=dataset['next_observations'],
-            returns = dataset['returns'],
-            goal_info = dataset['goal_info'],
-            rep_observations = rep_observations,
-            rep_next_observations = rep_next_observations
-        )
+    # 기존 column (observations, actions, next_observations, ...)은 복사 없이 공유하고 rep column만 추가
+    return dataset.copy({'rep_observations': rep_observations, 'rep_next_observations': rep_next_observations})
     
+def encode_dataset(encoder_fn, num_rows, chunk_size=50000, out=None, **inputs):
+    """
+    Streams `encoder_fn(**inputs)` over `num_rows` rows and writes the result into `out`.
+
+    Each input is an array (N, ...) or a callable `f(slice) -> array` that builds the rows lazily (e.g.
+    gathered targets). Every chunk is padded to `chunk_size` rows, so `encoder_fn` compiles once. Chunk
+    j + 1 is gathered and transferred while chunk j is still being encoded, and then chunk j is copied
+    into `out`. `out` can be a preallocated array, a path for a `.npy` memory map, or None, in which case
+    a float32 array is allocated from the first result.
+    """
+    chunk_size = min(chunk_size, num_rows)
+    pending = None
+
+    def write(start, valid, result):
+        nonlocal out
+        result = np.asarray(result)
+        if out is None or isinstance(out, str):
+            shape, path = (num_rows, *result.shape[1:]), out
+            out = np.empty(shape, dtype=np.float32) if path is None else np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape)
+        out[start:start + valid] = result[:valid]
+
+    for start in range(0, num_rows, chunk_size):
+        rows = slice(start, min(start + chunk_size, num_rows))
+        chunk = {k: np.asarray(v(rows) if callable(v) else v[rows]) for k, v in inputs.items()}
+        valid = rows.stop - rows.start
+        if valid < chunk_size:
+            chunk = {k: np.concatenate([v, np.repeat(v[-1:], chunk_size - valid, axis=0)]) for k, v in chunk.items()}
+        result = encoder_fn(**jax.device_put(chunk))
+        if pending is not None:
+            write(*pending)
+        pending = (start, valid, result)
+    write(*pending)
+    return out
+
 def get_rep_observation(encoder_fn, dataset, FLAGS, goal=None):
-    mini_batch = 50000
-    size = len(dataset['observations']) // mini_batch
-    rep_observations = np.zeros((len(dataset['observations']), FLAGS.rep_dim), dtype=np.float32)
+    observations = dataset['observations']
     if 'ant' in FLAGS.env_name:
-        goal = dataset['observations'].copy()
-        goal[:,:2] = dataset['goal_info'] # 현재 flags.use_goal_info_On 일때만, goal_info 반환하고 나머지는 None임으로 주의
+        def goal(rows):
+            goal = np.array(observations[rows])
+            goal[:,:2] = dataset['goal_info'][rows] # 현재 flags.use_goal_info_On 일때만, goal_info 반환하고 나머지는 None임으로 주의
+            return goal
     # 질문: 대충 goal 하나 설정 (kitchen 수정 필요)
     elif 'kitchen' in FLAGS.env_name:
-        goal = dataset['observations'][0]
-        goal = np.repeat(goal[np.newaxis,:], len(dataset['observations']), axis=0)
-    for i in range(size+1):
-        if goal is not None:
-            rep_observations[mini_batch*i:mini_batch*(i+1)] = encoder_fn(bases=dataset['observations'][mini_batch*i:mini_batch*(i+1)], targets=goal[mini_batch*i:mini_batch*(i+1)])
-        else:
-            rep_observations[mini_batch*i:mini_batch*(i+1)] = encoder_fn(targets=dataset['observations'][mini_batch*i:mini_batch*(i+1)])
-    return rep_observations 
+        goal = lambda rows: np.repeat(observations[:1], rows.stop - rows.start, axis=0)
+    if goal is not None:
+        return encode_dataset(encoder_fn, len(observations), bases=observations, targets=goal)
+    return encode_dataset(encoder_fn, len(observations), targets=observations)
 
 # 0610 승호수정 goal only
 def get_rep_observation_goal_only(encoder_fn, dataset, FLAGS):
-    mini_batch = 50000
-    size = len(dataset['observations']) // mini_batch
-    rep_observations = np.zeros((len(dataset['observations']), FLAGS.rep_dim), dtype=np.float32)
-    for i in range(size+1):
-        rep_observations[mini_batch*i:mini_batch*(i+1)] = encoder_fn(bases=dataset['observations'][mini_batch*i:mini_batch*(i+1)], targets=dataset['observations'][mini_batch*i:mini_batch*(i+1)])
-    return rep_observations 
+    observations = dataset['observations']
+    return encode_dataset(encoder_fn, len(observations), bases=observations, targets=observations)
 
 # 0610 승호수정 spherical
 def get_rep_observation_spherical(encoder_fn, dataset, FLAGS):
-    observations = dataset['observations'].reshape(-1, 1000, dataset['observations'].shape[-1])  # antmaze 기준 (999, 1000, 29)
-    rep_observations = np.zeros((observations.shape[0] * observations.shape[1], FLAGS.rep_dim), dtype=np.float32)
-
-    bases_indx = np.arange(1000)  # 0부터 999까지의 인덱스
-    
-    # 각 트레젝토리에 대해 연산 수행 (배치 처리)
-    for traj_index in range(len(observations)):
-        traj = observations[traj_index]
-        bases=traj[bases_indx]   
-        targets = np.array([traj[min(i + FLAGS.way_steps, 999)] for i in bases_indx])  # targets 배열 생성
-        
-        rep_observations_batch = encoder_fn(bases=bases, targets=targets)
-        rep_observations[traj_index*1000 : traj_index*1000+len(bases_indx)] = rep_observations_batch
-    
-    return rep_observations
+    # antmaze 기준 1000 step trajectory: target = 같은 trajectory에서 way_steps 뒤의 state (마지막 state에서 clip)
+    observations = dataset['observations']
+    indx = np.arange(len(observations))
+    step = indx % 1000
+    target_indx = indx - step + np.minimum(step + FLAGS.way_steps, 999)
+    return encode_dataset(encoder_fn, len(observations), bases=observations, targets=lambda rows: observations[target_indx[rows]])
 
 def get_hilp_rep_observation(encoder_fn, dataset, FLAGS, goal=None):
-    mini_batch = 50000
-    size = len(dataset['observations']) // mini_batch
-    rep_observations = np.zeros((len(dataset['observations']), FLAGS.rep_dim), dtype=np.float32)
-    for i in range(size+1):
-        rep_observations[mini_batch*i:mini_batch*(i+1)] = encoder_fn(observations=dataset['observations'][mini_batch*i:mini_batch*(i+1)])
-    return rep_observations 
+    observations = dataset['observations']
+    return encode_dataset(encoder_fn, len(observations), observations=observations)
 
 def hilp_add_data(dataset, rep_observations):
     reshape_obs = rep_observations.reshape(999, 1000, rep_observations.shape[-1])
@@ -341,13 +294,7 @@ def hilp_add_data(dataset, rep_observations):
     td_value = -jnp.sqrt(jnp.maximum(squared_dist, 1e-6))
     td_value = np.asarray(td_value.reshape(-1).astype(jnp.float32))
     
-    return Dataset.create(
-            observations=dataset['observations'],
-            actions=dataset['actions'].astype(np.float32),
-            rewards=dataset['rewards'].astype(np.float32),
-            masks=1.0 - dataset['dones_float'].astype(np.float32),
-            dones_float=dataset['dones_float'].astype(np.float32),
-            next_observations=dataset['next_observations'],
-            returns = td_value,
-            goal_info = dataset['goal_info'],
-        )
\ No newline at end of file
+    # rep column은 제외하고 returns만 td_value로 교체 (나머지 column은 복사 없이 공유)
+    fields = {k: v for k, v in dataset.items() if k not in ['rep_observations', 'rep_next_observations']}
+    fields['returns'] = td_value
+    return type(dataset)(fields)
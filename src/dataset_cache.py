@@ -0,0 +1,154 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+from jaxrl_m.dataset import MemmapDataset
+
+# Bump whenever get_dataset preprocessing changes so stale caches are not reused.
+CACHE_VERSION = 2
+PREPROCESS_FLAGS = ('use_goal_info_On', 'kmean_weight_type', 'expert_data_On')
+
+
+def file_hash(path, chunk_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def source_hash(path, cache_dir):
+    """
+    `file_hash(path)`, memoized in `<cache_dir>/source_hashes.json` by absolute path, size and mtime, so the
+    multi-GB source is only re-hashed when it changes (not on every launch / seed).
+    """
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    fingerprint = [stat.st_size, stat.st_mtime_ns]
+    memo_path = os.path.join(cache_dir, 'source_hashes.json')
+    memo = {}
+    if os.path.exists(memo_path):
+        try:
+            with open(memo_path) as f:
+                memo = json.load(f)
+        except ValueError:
+            memo = {}
+    entry = memo.get(path)
+    if entry is not None and entry['fingerprint'] == fingerprint:
+        return entry['sha1']
+    digest = file_hash(path)
+    memo[path] = {'fingerprint': fingerprint, 'sha1': digest}
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.tmp_')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(memo, f)
+    os.replace(tmp_path, memo_path)
+    return digest
+
+
+def dataset_source_path(env):
+    """Path of the raw d4rl file behind `env`, or None when it is unknown."""
+    try:
+        return env.dataset_filepath
+    except (AttributeError, ValueError, TypeError):
+        return None
+
+
+def cache_key(env_name, source_path=None, flag=None, cache_dir=None, **preprocess):
+    if source_path is None or not os.path.exists(source_path):
+        digest = None
+    elif cache_dir is None:
+        digest = file_hash(source_path)
+    else:
+        digest = source_hash(source_path, cache_dir)
+    spec = dict(
+        version=CACHE_VERSION,
+        env_name=env_name,
+        source_hash=digest,
+        **{k: getattr(flag, k, None) for k in PREPROCESS_FLAGS},
+        **preprocess,
+    )
+    return hashlib.sha1(json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def save(directory, dataset, episode_index=None):
+    """Writes every field as an uncompressed `.npy` (memory-mappable) plus a `meta.json`, atomically."""
+    parent = os.path.dirname(os.path.abspath(directory))
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent, prefix='.tmp_')
+    meta = {'none_fields': [k for k, v in dataset.items() if v is None]}
+    MemmapDataset.save(dataset, os.path.join(tmp_dir, 'fields'))
+
+    # episode_index: ant는 (999, 1000) array, kitchen은 object array, calvin은 list
+    if episode_index is None:
+        meta['episode_index_type'] = 'none'
+    elif isinstance(episode_index, np.ndarray) and episode_index.dtype != object:
+        meta['episode_index_type'] = 'array'
+        np.save(os.path.join(tmp_dir, 'episode_index.npy'), episode_index)
+    else:
+        meta['episode_index_type'] = 'list' if isinstance(episode_index, list) else 'object'
+        np.save(os.path.join(tmp_dir, 'episode_index_flat.npy'), np.concatenate(list(episode_index)) if len(episode_index) else np.zeros(0, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, 'episode_index_lengths.npy'), np.array([len(e) for e in episode_index], dtype=np.int64))
+
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp_dir, directory)
+    except OSError:
+        # Another process finished writing the same entry first.
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def load(directory, mmap_mode='r'):
+    with open(os.path.join(directory, 'meta.json')) as f:
+        meta = json.load(f)
+    dataset = MemmapDataset.load(os.path.join(directory, 'fields'), mmap_mode=mmap_mode)
+    for k in meta['none_fields']:
+        dataset = dataset.add_column(k, None)
+
+    episode_index_type = meta['episode_index_type']
+    if episode_index_type == 'none':
+        episode_index = None
+    elif episode_index_type == 'array':
+        episode_index = np.load(os.path.join(directory, 'episode_index.npy'))
+    else:
+        flat = np.load(os.path.join(directory, 'episode_index_flat.npy'))
+        lengths = np.load(os.path.join(directory, 'episode_index_lengths.npy'))
+        episodes = np.split(flat, np.cumsum(lengths)[:-1])
+        if episode_index_type == 'list':
+            episode_index = episodes
+        else:
+            episode_index = np.empty(len(episodes), dtype=object)
+            for e, idx in enumerate(episodes):
+                episode_index[e] = idx
+    return dataset, episode_index
+
+
+def load_or_create(cache_dir, create_fn, env_name, source_path=None, flag=None, **preprocess):
+    """
+    Content-addressed cache around a `(dataset, episode_index)` loader such as `d4rl_utils.get_dataset`.
+
+    The key covers env name, preprocessing flags, extra `preprocess` kwargs and the hash of the raw
+    source file (memoized by size / mtime in `source_hashes.json`). Cached fields are loaded as a `MemmapDataset`, so concurrent seeds share the page cache.
+    With an empty `cache_dir` this is just `create_fn()`.
+    """
+    if not cache_dir:
+        return create_fn()
+
+    def entry_dir():
+        return os.path.join(cache_dir, f'{env_name}-{cache_key(env_name, source_path, flag, cache_dir=cache_dir, **preprocess)}')
+
+    directory = entry_dir()
+    if os.path.exists(os.path.join(directory, 'meta.json')):
+        print(f'Loading preprocessed dataset from {directory}')
+        return load(directory)
+    dataset, episode_index = create_fn()
+    # create_fn may have just downloaded the source file; key the entry by its hash so later launches hit it.
+    directory = entry_dir()
+    if not os.path.exists(os.path.join(directory, 'meta.json')):
+        print(f'Saving preprocessed dataset to {directory}')
+        save(directory, dataset, episode_index)
+    return load(directory)
@@ -0,0 +1,97 @@
+from typing import NamedTuple
+
+import numpy as np
+
+
+class Episodes(NamedTuple):
+    """
+    Episode segmentation of a flat transition dataset.
+
+    dones_float: (N,) 1.0 at the last transition of every episode
+    starts: (E,) index of the first transition of every episode
+    ends: (E,) index of the last transition of every episode (inclusive)
+    episode_ids: (N,) episode id of every transition
+    """
+    dones_float: np.ndarray
+    starts: np.ndarray
+    ends: np.ndarray
+    episode_ids: np.ndarray
+
+    @property
+    def num_episodes(self):
+        return len(self.starts)
+
+    @property
+    def lengths(self):
+        return self.ends - self.starts + 1
+
+    def episode_index(self):
+        """Per-episode arrays of transition indices (ragged, as an object array)."""
+        episode_index = np.empty(self.num_episodes, dtype=object)
+        for e, (start, end) in enumerate(zip(self.starts, self.ends)):
+            episode_index[e] = np.arange(start, end + 1)
+        return episode_index
+
+
+def from_dones(dones) -> Episodes:
+    """Segments a dataset given a done flag per transition. The last transition always ends an episode."""
+    dones = np.asarray(dones) > 0
+    dones[-1] = True
+    ends = np.flatnonzero(dones)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    episode_ids = np.cumsum(dones) - dones
+    return Episodes(dones.astype(np.float32), starts, ends, episode_ids)
+
+
+def from_terminals(terminals) -> Episodes:
+    return from_dones(terminals)
+
+
+def from_episode_ids(episode_ids) -> Episodes:
+    """Segments a dataset that stores an episode id per transition (e.g. calvin `episodes`)."""
+    episode_ids = np.asarray(episode_ids)
+    dones = np.ones(len(episode_ids), dtype=bool)
+    dones[:-1] = episode_ids[1:] != episode_ids[:-1]
+    return from_dones(dones)
+
+
+def from_discontinuities(observations, next_observations, atol=1e-6, chunk_size=100000) -> Episodes:
+    """
+    Segments a dataset where `observations[i + 1] != next_observations[i]` marks an episode boundary
+    (d4rl antmaze, whose `terminals` are not usable for GCRL). Processed in chunks to bound memory.
+    """
+    dones = np.ones(len(observations), dtype=bool)
+    for start in range(0, len(observations) - 1, chunk_size):
+        end = min(start + chunk_size, len(observations) - 1)
+        gaps = observations[start + 1:end + 1] - next_observations[start:end]
+        dones[start:end] = np.linalg.norm(gaps, axis=-1) > atol
+    return from_dones(dones)
+
+
+def reverse_linear_scan(values, coefs):
+    """
+    Solves y_t = values_t + coefs_t * y_{t+1} (with y_N = 0) for every t.
+
+    Vectorized doubling scan: after the pass with shift s, (coefs_t, values_t) is the composition of
+    the affine maps over [t, t + 2s), so log2(N) array passes replace the Python loop over transitions.
+    """
+    values = np.array(values, dtype=np.float64)
+    coefs = np.array(coefs, dtype=np.float64)
+    shift = 1
+    while shift < len(values):
+        values[:-shift] = values[:-shift] + coefs[:-shift] * values[shift:]
+        coefs[:-shift] = coefs[:-shift] * coefs[shift:]
+        shift *= 2
+    return values
+
+
+def discounted_return_to_go(rewards, episodes: Episodes, gamma, terminals=None):
+    """
+    Discounted return-to-go over ragged episodes:
+    R_t = r_t + gamma * (1 - terminal_t) * R_{t+1}, restarting at the end of every episode.
+    """
+    coefs = np.full(len(rewards), gamma, dtype=np.float64)
+    if terminals is not None:
+        coefs *= 1 - np.asarray(terminals, dtype=np.float64)
+    coefs[episodes.ends] = 0.
+    return reverse_linear_scan(rewards, coefs).astype(np.float32)
@@ -1,7 +1,11 @@
-from jaxrl_m.dataset import Dataset
+from jaxrl_m.dataset import Dataset, CompactDataset
 from flax.core.frozen_dict import FrozenDict
 from flax.core import freeze
+from jaxrl_m.common import nonpytree_field
+import flax
 import dataclasses
+import threading
+import queue
 import numpy as np
 import jax
 import jax.numpy as jnp
@@ -37,13 +41,15 @@ class GCDataset:
     def __post_init__(self):
         self.terminal_locs, = np.nonzero(self.dataset[self.terminal_key] > 0)
         assert np.isclose(self.p_randomgoal + self.p_trajgoal + self.p_currgoal, 1.0)
-        if self.keynode_ratio:
+        if self.keynode_ratio and self.key_node is None:
             if 'rep_observations' in self.dataset.keys():
                 _,_,_, self.key_node = self.find_key_node(self.dataset['rep_observations'])
             else:
                 _,_,_, self.key_node = self.find_key_node(self.dataset['observations'])
 
-    def sample_goals(self, indx, p_randomgoal=None, p_trajgoal=None, p_currgoal=None):
+    def sample_goals(self, indx, p_randomgoal=None, p_trajgoal=None, p_currgoal=None, np_random=None):
+        if np_random is None:
+            np_random = np.random
         if p_randomgoal is None:
             p_randomgoal = self.p_randomgoal
         if p_trajgoal is None:
@@ -53,27 +59,29 @@ class GCDataset:
             
         batch_size = len(indx)
         # Random goals
-        goal_indx = np.random.randint(self.dataset.size, size=batch_size)
+        goal_indx = np_random.randint(self.dataset.size, size=batch_size)
         
         # Goals from the same trajectory
         final_state_indx = self.terminal_locs[np.searchsorted(self.terminal_locs, indx)]
-        distance = np.random.rand(batch_size)
+        distance = np_random.rand(batch_size)
         if self.geom_sample:
-            us = np.random.rand(batch_size)
+            us = np_random.rand(batch_size)
             middle_goal_indx = np.minimum(indx + np.ceil(np.log(1 - us) / np.log(self.discount)).astype(int), final_state_indx)
         else:
             middle_goal_indx = np.round((np.minimum(indx + 1, final_state_indx) * distance + final_state_indx * (1 - distance))).astype(int)
-        goal_indx = np.where(np.random.rand(batch_size) < p_trajgoal / (1.0 - p_currgoal), middle_goal_indx, goal_indx)
+        goal_indx = np.where(np_random.rand(batch_size) < p_trajgoal / (1.0 - p_currgoal), middle_goal_indx, goal_indx)
         
         # Goals at the current state
-        goal_indx = np.where(np.random.rand(batch_size) < p_currgoal, indx, goal_indx)
+        goal_indx = np.where(np_random.rand(batch_size) < p_currgoal, indx, goal_indx)
         return goal_indx
 
-    def sample(self, batch_size: int, indx=None):
+    def sample(self, batch_size: int, indx=None, np_random=None):
+        if np_random is None:
+            np_random = np.random
         if indx is None:
-            indx = np.random.randint(self.dataset.size-1, size=batch_size)
+            indx = np_random.randint(self.dataset.size-1, size=batch_size)
         batch = self.dataset.sample(batch_size, indx)
-        goal_indx = self.sample_goals(indx)
+        goal_indx = self.sample_goals(indx, np_random=np_random)
         success = (indx == goal_indx)
         batch['rewards'] = success.astype(float) * self.reward_scale + self.reward_shift
         if self.terminal:
@@ -103,13 +111,15 @@ class GCSDataset(GCDataset):
             'terminal': False,
         })
 
-    def sample(self, batch_size: int, indx=None):
+    def sample(self, batch_size: int, indx=None, np_random=None):
+        if np_random is None:
+            np_random = np.random
         if indx is None:
-            indx = np.random.randint(self.dataset.size-1, size=batch_size)
+            indx = np_random.randint(self.dataset.size-1, size=batch_size)
         
         batch = self.dataset.sample(batch_size, indx)
         # goal for value function training
-        goal_indx = self.sample_goals(indx)
+        goal_indx = self.sample_goals(indx, np_random=np_random)
         success = (indx == goal_indx)
         batch['rewards'] = success.astype(float) * self.reward_scale + self.reward_shift
 
@@ -125,16 +135,16 @@ class GCSDataset(GCDataset):
         final_state_indx = self.terminal_locs[np.searchsorted(self.terminal_locs, indx)]
         # subgoal sampled from its own trajectory for low level training
         way_indx = np.minimum(indx + self.way_steps, final_state_indx)
-        distance = np.random.rand(batch_size)
+        distance = np_random.rand(batch_size)
         # subgoal sampled from its own trajectory with distance ratio for high level training
         high_traj_goal_indx = np.round((np.minimum(indx + 1, final_state_indx) * distance + final_state_indx * (1 - distance))).astype(int)
         # subgoal sampled from its own trajectory for high level training 
         high_traj_target_indx = np.minimum(indx + self.way_steps, high_traj_goal_indx)
         # randaom goal sampled from 
-        high_random_goal_indx = np.random.randint(self.dataset.size, size=batch_size)
+        high_random_goal_indx = np_random.randint(self.dataset.size, size=batch_size)
         high_random_target_indx = np.minimum(indx + self.way_steps, final_state_indx)
 
-        pick_random = (np.random.rand(batch_size) < self.high_p_randomgoal)
+        pick_random = (np_random.rand(batch_size) < self.high_p_randomgoal)
         high_goal_idx = np.where(pick_random, high_random_goal_indx, high_traj_goal_indx)
         high_target_idx = np.where(pick_random, high_random_target_indx, high_traj_target_indx)
         
@@ -174,3 +184,207 @@ class GCSDataset(GCDataset):
             batch['next_observations'] = freeze(batch['next_observations'])
  
         return batch
+
+    def to_device(self):
+        """Returns a `DeviceGCSDataset` holding the arrays needed for training as device buffers."""
+        if isinstance(self.dataset, CompactDataset):
+            # next_observations는 device에서도 observations[i+1] + terminal successor로 복원
+            next_observations = None
+            successor_locs = jax.device_put(self.dataset['successor_locs'].astype(np.int32))
+            terminal_successors = jax.device_put(self.dataset['terminal_successors'])
+        else:
+            next_observations = jax.device_put(self.dataset['next_observations'])
+            successor_locs, terminal_successors = None, None
+        return DeviceGCSDataset(
+            observations=jax.device_put(self.dataset['observations']),
+            next_observations=next_observations,
+            successor_locs=successor_locs,
+            terminal_successors=terminal_successors,
+            actions=jax.device_put(self.dataset['actions']),
+            terminal_locs=jax.device_put(self.terminal_locs.astype(np.int32)),
+            key_node=None if self.key_node is None else jax.device_put(self.key_node),
+            p_trajgoal=self.p_trajgoal,
+            p_currgoal=self.p_currgoal,
+            geom_sample=self.geom_sample,
+            discount=self.discount,
+            reward_scale=self.reward_scale,
+            reward_shift=self.reward_shift,
+            terminal=self.terminal,
+            way_steps=self.way_steps,
+            high_p_randomgoal=self.high_p_randomgoal,
+            keynode_ratio=self.keynode_ratio,
+        )
+
+class DeviceGCSDataset(flax.struct.PyTreeNode):
+    """
+    Device-resident counterpart of `GCSDataset.sample`.
+
+    Every index (goals, waypoints, high-level goals/targets) is drawn with `jax.random`, so sampling
+    can be traced into the same jit as `JointTrainAgent.pretrain_update` and batches never leave the device.
+    Sampling semantics mirror `GCSDataset.sample` (`p_randomgoal` is implied by `p_trajgoal`/`p_currgoal`).
+    """
+    observations: Any
+    next_observations: Any
+    actions: Any
+    terminal_locs: Any
+    key_node: Any = None
+    successor_locs: Any = None
+    terminal_successors: Any = None
+    p_trajgoal: float = nonpytree_field(default=0.5)
+    p_currgoal: float = nonpytree_field(default=0.2)
+    geom_sample: int = nonpytree_field(default=0)
+    discount: float = nonpytree_field(default=0.99)
+    reward_scale: float = nonpytree_field(default=1.0)
+    reward_shift: float = nonpytree_field(default=0.0)
+    terminal: bool = nonpytree_field(default=False)
+    way_steps: int = nonpytree_field(default=None)
+    high_p_randomgoal: float = nonpytree_field(default=0.)
+    keynode_ratio: float = nonpytree_field(default=0.)
+
+    @property
+    def size(self):
+        return jax.tree_util.tree_leaves(self.observations)[0].shape[0]
+
+    def final_state_indx(self, indx):
+        return self.terminal_locs[jnp.searchsorted(self.terminal_locs, indx)]
+
+    def get_next_observations(self, indx):
+        if self.next_observations is not None:
+            return self.next_observations[indx]
+        # CompactDataset layout: observations[i + 1] except at successor_locs
+        pos = jnp.minimum(jnp.searchsorted(self.successor_locs, indx), self.successor_locs.shape[0] - 1)
+        is_terminal = self.successor_locs[pos] == indx
+        next_observations = self.observations[jnp.minimum(indx + 1, self.size - 1)]
+        return jnp.where(is_terminal[:, None], self.terminal_successors[pos], next_observations)
+
+    def sample_goals(self, rng, indx):
+        batch_size = indx.shape[0]
+        random_key, distance_key, geom_key, traj_key, curr_key = jax.random.split(rng, 5)
+        # Random goals
+        goal_indx = jax.random.randint(random_key, (batch_size,), 0, self.size)
+
+        # Goals from the same trajectory
+        final_state_indx = self.final_state_indx(indx)
+        distance = jax.random.uniform(distance_key, (batch_size,))
+        if self.geom_sample:
+            us = jax.random.uniform(geom_key, (batch_size,))
+            middle_goal_indx = jnp.minimum(indx + jnp.ceil(jnp.log(1 - us) / jnp.log(self.discount)).astype(jnp.int32), final_state_indx)
+        else:
+            middle_goal_indx = jnp.round((jnp.minimum(indx + 1, final_state_indx) * distance + final_state_indx * (1 - distance))).astype(jnp.int32)
+        goal_indx = jnp.where(jax.random.uniform(traj_key, (batch_size,)) < self.p_trajgoal / (1.0 - self.p_currgoal), middle_goal_indx, goal_indx)
+
+        # Goals at the current state
+        goal_indx = jnp.where(jax.random.uniform(curr_key, (batch_size,)) < self.p_currgoal, indx, goal_indx)
+        return goal_indx
+
+    def sample(self, rng, batch_size: int):
+        indx_key, goal_key, distance_key, high_random_key, pick_key = jax.random.split(rng, 5)
+        indx = jax.random.randint(indx_key, (batch_size,), 0, self.size - 1)
+        take = lambda tree, idx: jax.tree_map(lambda arr: arr[idx], tree)
+
+        batch = {
+            'observations': take(self.observations, indx),
+            'next_observations': self.get_next_observations(indx),
+            'actions': self.actions[indx],
+        }
+        # goal for value function training
+        goal_indx = self.sample_goals(goal_key, indx)
+        success = (indx == goal_indx)
+        batch['rewards'] = success.astype(jnp.float32) * self.reward_scale + self.reward_shift
+        if self.terminal:
+            batch['masks'] = (1.0 - success.astype(jnp.float32))
+        else:
+            batch['masks'] = jnp.ones(batch_size)
+        batch['goals'] = take(self.observations, goal_indx)
+
+        # final state in each trajectory
+        final_state_indx = self.final_state_indx(indx)
+        # subgoal sampled from its own trajectory for low level training
+        way_indx = jnp.minimum(indx + self.way_steps, final_state_indx)
+        distance = jax.random.uniform(distance_key, (batch_size,))
+        # subgoal sampled from its own trajectory with distance ratio for high level training
+        high_traj_goal_indx = jnp.round((jnp.minimum(indx + 1, final_state_indx) * distance + final_state_indx * (1 - distance))).astype(jnp.int32)
+        high_traj_target_indx = jnp.minimum(indx + self.way_steps, high_traj_goal_indx)
+        high_random_goal_indx = jax.random.randint(high_random_key, (batch_size,), 0, self.size)
+        high_random_target_indx = jnp.minimum(indx + self.way_steps, final_state_indx)
+
+        pick_random = (jax.random.uniform(pick_key, (batch_size,)) < self.high_p_randomgoal)
+        high_goal_idx = jnp.where(pick_random, high_random_goal_indx, high_traj_goal_indx)
+        high_target_idx = jnp.where(pick_random, high_random_target_indx, high_traj_target_indx)
+
+        batch['high_goals'] = take(self.observations, high_goal_idx)
+
+        if self.key_node is None or not self.keynode_ratio:
+            batch['low_goals'] = take(self.observations, way_indx)
+            batch['high_targets'] = take(self.observations, high_target_idx)
+        else:
+            index = int(self.keynode_ratio * batch_size)
+            batch['low_goals'] = jnp.concatenate([self.key_node[way_indx[:index]], self.observations[way_indx[index:]]])
+            batch['high_targets'] = jnp.concatenate([self.key_node[high_target_idx[:index]], self.observations[high_target_idx[index:]]])
+        if self.key_node is not None:
+            batch['key_node'] = self.key_node[indx]
+
+        return batch
+
+class PrefetchSampler:
+    """
+    Iterator over `GCSDataset.sample` batches that are prepared on a background thread.
+
+    A single worker owns a `np.random.RandomState(seed)` and fills a bounded queue (`buffer_size=2` is
+    double buffering) with batches that are already `jax.device_put`, so the next batch is indexed on the
+    host while `pretrain_update` runs. Using one worker keeps the batch sequence deterministic under `seed`.
+    With `num_steps > 1` each item is a stack of `num_steps` batches for `pretrain_update_many`.
+
+    Example:
+        sampler = PrefetchSampler(pretrain_dataset, batch_size=1024, seed=0)
+        pretrain_batch = next(sampler)
+        sampler.close()
+    """
+
+    def __init__(self, dataset: GCSDataset, batch_size: int, seed: int = 0, buffer_size: int = 2, num_steps: int = 1):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.num_steps = num_steps
+        self.np_random = np.random.RandomState(seed)
+        self.queue = queue.Queue(maxsize=buffer_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._worker, daemon=True)
+        self.thread.start()
+
+    def _sample(self):
+        if self.num_steps == 1:
+            batch = self.dataset.sample(self.batch_size, np_random=self.np_random)
+        else:
+            batches = [self.dataset.sample(self.batch_size, np_random=self.np_random) for _ in range(self.num_steps)]
+            batch = jax.tree_map(lambda *xs: np.stack(xs), *batches)
+        return jax.device_put(batch)
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _worker(self):
+        try:
+            while not self.stop_event.is_set():
+                self._put(self._sample())
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        self.stop_event.set()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.thread.join()
@@ -1,4 +1,5 @@
 import argparse
+import dataclasses
 import numpy as np
 import faiss
 import numpy as np
@@ -6,8 +7,17 @@ import networkx as nx
 import matplotlib.pyplot as plt
 import jax.numpy as jnp
 import jax
+import flax
+import weakref
+import itertools
+from typing import Any
+from functools import partial
 
-def build_keynodes(dataset, flags=None, episode_index= None):
+from jaxrl_m.common import nonpytree_field, count_traces
+from src import kmeans_utils
+
+def build_keynodes(dataset, flags=None, episode_index= None, centroids=None):
+    # centroids: observation 공간 key node (원래 스케일, 예: checkpoint에서 복원), 주어지면 k-means 생략
     obs = dataset['observations'] 
     if flags.specific_dim_On:
         if 'ant' in flags.env_name:
@@ -43,12 +53,250 @@ def build_keynodes(dataset, flags=None, episode_index= None):
         state_values = np.ones(obs.shape[0]).astype(np.float32) 
         nodes = KeyNode(obs=obs[data_index], values=state_values[data_index], flags=flags)
             
-    nodes.construct_nodes() 
+    nodes.construct_nodes(centroids=centroids) 
     nodes.visualize_key_nodes(flags)
     
     return nodes, data_index
 
-class KeyNode(object):
+def transition_edges(labels, dones, num_nodes, weight_type="steps"):
+    """
+    Sparse transition graph between key nodes from consecutive `labels` within episodes (CSR arrays).
+
+    Each episode is collapsed into runs of equal labels; an edge a -> b exists when a run of a is directly
+    followed by a run of b. weight_type "steps": the shortest run of a observed before moving to b
+    (environment steps spent in a); "hops": every edge costs 1.
+    """
+    labels = np.asarray(labels)
+    dones = np.asarray(dones) > 0
+    run_start = np.ones(len(labels), dtype=bool)
+    run_start[1:] = (labels[1:] != labels[:-1]) | dones[:-1]
+    starts = np.flatnonzero(run_start)
+    run_labels = labels[starts]
+    run_lengths = np.diff(np.append(starts, len(labels)))
+    episode_ids = np.cumsum(np.concatenate([[0], dones[:-1]]))[starts]
+
+    same_episode = episode_ids[1:] == episode_ids[:-1]
+    src, dst = run_labels[:-1][same_episode], run_labels[1:][same_episode]
+    weights = run_lengths[:-1][same_episode].astype(np.float32)
+    if weight_type == "hops":
+        weights = np.ones_like(weights)
+    elif weight_type != "steps":
+        raise ValueError(f"Unsupported weight_type: {weight_type}")
+
+    # (src, dst) 중복 edge는 최소 weight만 남김
+    edge_ids = src.astype(np.int64) * num_nodes + dst
+    order = np.lexsort((weights, edge_ids))
+    edge_ids, weights = edge_ids[order], weights[order]
+    first = np.ones(len(edge_ids), dtype=bool)
+    first[1:] = edge_ids[1:] != edge_ids[:-1]
+    edge_ids, weights = edge_ids[first], weights[first]
+
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(edge_ids // num_nodes, minlength=num_nodes))])
+    return indptr, edge_ids % num_nodes, weights
+
+@jax.jit
+def floyd_warshall(dist, next_hop):
+    """All-pairs shortest paths on device. `next_hop[i, j]`: node after i on the path to j (-1: unreachable)."""
+    def relax(k, carry):
+        dist, next_hop = carry
+        through_k = dist[:, k, None] + dist[None, k, :]
+        improved = through_k < dist
+        return jnp.where(improved, through_k, dist), jnp.where(improved, next_hop[:, k, None], next_hop)
+    return jax.lax.fori_loop(0, dist.shape[0], relax, (dist, next_hop))
+
+def all_pairs_shortest_paths(indptr, indices, weights):
+    num_nodes = len(indptr) - 1
+    sources = np.repeat(np.arange(num_nodes), np.diff(indptr))
+    dist = np.full((num_nodes, num_nodes), np.inf, dtype=np.float32)
+    next_hop = np.full((num_nodes, num_nodes), -1, dtype=np.int32)
+    dist[sources, indices] = weights
+    next_hop[sources, indices] = indices
+    dist[np.arange(num_nodes), np.arange(num_nodes)] = 0.
+    next_hop[np.arange(num_nodes), np.arange(num_nodes)] = np.arange(num_nodes)
+    return floyd_warshall(jnp.asarray(dist), jnp.asarray(next_hop))
+
+@dataclasses.dataclass
+class KeyNodeStore:
+    """
+    Array-native key-node storage: one row per key node, plus an optional CSR adjacency.
+
+    The networkx view is only built on demand (`to_networkx`, used for plotting).
+    """
+    pos: np.ndarray
+    weighted_values: np.ndarray
+    cluster_sizes: np.ndarray = None
+    indptr: np.ndarray = None  # CSR adjacency: neighbors of node i are indices[indptr[i]:indptr[i + 1]]
+    indices: np.ndarray = None
+    edge_weights: np.ndarray = None
+
+    @property
+    def num_nodes(self):
+        return len(self.pos)
+
+    @property
+    def has_edges(self):
+        return self.indptr is not None
+
+    def neighbors(self, node):
+        if not self.has_edges:
+            return np.zeros(0, dtype=np.int64)
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def to_networkx(self):
+        graph = nx.DiGraph()
+        for i in range(self.num_nodes):
+            graph.add_node(i, pos=self.pos[i], weighted_value=self.weighted_values[i])
+        if self.has_edges:
+            sources = np.repeat(np.arange(self.num_nodes), np.diff(self.indptr))
+            weights = self.edge_weights if self.edge_weights is not None else np.ones(len(self.indices))
+            graph.add_weighted_edges_from(zip(sources.tolist(), self.indices.tolist(), weights.tolist()))
+        return graph
+
+# faiss index는 jit 인자로 넘길 수 없어서 KeyNodeArrays.index_id (traced int)로 host callback에서 찾음
+_indexed_keynodes = weakref.WeakValueDictionary()
+_index_ids = itertools.count()
+
+def host_index_search(index_id, x, k=1, spherical_On=False):
+    D, I = _indexed_keynodes[int(index_id)].index.search(np.ascontiguousarray(x, dtype=np.float32), k)
+    if not spherical_On:
+        D = np.sqrt(np.maximum(D, 0)) # faiss L2는 squared distance
+    return D.astype(np.float32), I.astype(np.int32)
+
+class KeyNodeLookup(object):
+    """
+    Key-node lookup shared by `KeyNode` and `KeyNodeArrays`.
+
+    Expects `flags`, `env_name`, `spherical_On`, `normalized_pos`, `pos`, `nodes`, `scale_min` / `scale_max`
+    (euclidean only), `index_id` (None: exact search) and, for `plan_subgoal`, `next_hop`.
+    """
+
+    def normalize_input(self, input_obs):
+        node_dim = self.flags.keynode_dim # rep 은 모든 dim 사용
+        
+        # 0610 승호수정 spherical
+        if self.spherical_On:
+            input_pos = input_obs / jnp.sqrt(node_dim)
+        else:
+            input_pos = (input_obs - self.scale_min) / (self.scale_max - self.scale_min)       
+             
+        if self.flags.specific_dim_On:
+            if 'ant' in self.env_name:
+                input_pos = input_obs[:2] 
+            elif 'kitchen' in self.env_name:
+                input_pos = input_obs[:9] 
+            elif 'calvin' in self.env_name:
+                input_pos = input_obs[:15] 
+        return input_pos
+
+    @property
+    def search_k(self):
+        # triple은 가장 가까운 2개의 node만 필요 (전체 argsort 대신 top-k)
+        return 2 if self.flags.mapping_method == "triple" else 1
+
+    def exact_search(self, input_pos):
+        # 0610 승호수정 spherical
+        if self.spherical_On:
+            if self.flags.mapping_method not in ["nearest"]:
+                raise ValueError(f"Unsupported mapping_method: {self.flags.mapping_method}")
+            cosine_similarity = jnp.dot(self.normalized_pos, input_pos.T)
+            return jax.lax.top_k(cosine_similarity, self.search_k)
+        distance = jnp.linalg.norm(self.normalized_pos - input_pos, axis=1)
+        neg_distance, index = jax.lax.top_k(-distance, self.search_k)
+        return -neg_distance, index
+
+    def select_node(self, input_obs, distance, index):
+        """`distance` / `index`: the `search_k` nearest key nodes of `input_obs`, nearest first."""
+        node_dim = self.flags.keynode_dim
+        if self.flags.specific_dim_On:
+            if 'ant' in self.env_name:
+                node_dim = 2
+            elif 'kitchen' in self.env_name:
+                node_dim = 9
+            elif 'calvin' in self.env_name:
+                node_dim = 15
+
+        first = index[0]
+        if self.flags.mapping_method == "nearest":
+            cur_obs_key_node = self.pos[first]
+        elif self.flags.mapping_method == "center":
+            cur_obs_key_node = (self.pos[first] + input_obs) / 2
+        elif self.flags.mapping_method == "triple":
+            cur_obs_key_node = (self.pos[first] + self.pos[index[1]] + input_obs) / 3
+            
+        if (self.flags.use_rep not in ["hiql_goal_encoder", "hilp_subgoal_encoder", "hilp_encoder", "vae_encoder"]) and (self.flags.specific_dim_On):
+            cur_obs_key_node = jnp.concatenate([cur_obs_key_node, input_obs[node_dim:]])
+                            
+        return distance[0], self.nodes[first], self.pos[first], cur_obs_key_node  # 현재 코드에서는 4번쨰 closest_node_observations만 사용
+
+    def find_node_pos(self, input_obs):
+        distance, index = self.exact_search(self.normalize_input(input_obs))
+        return self.select_node(input_obs, distance, index)
+
+    def index_search(self, input_pos):
+        """Approximate search in the faiss index of `index_id` from inside jit (host callback). Distances match `exact_search`."""
+        if self.spherical_On and self.flags.mapping_method not in ["nearest"]:
+            raise ValueError(f"Unsupported mapping_method: {self.flags.mapping_method}")
+        k = self.search_k
+        result_shape = (jax.ShapeDtypeStruct((input_pos.shape[0], k), jnp.float32),
+                        jax.ShapeDtypeStruct((input_pos.shape[0], k), jnp.int32))
+        search = partial(host_index_search, k=k, spherical_On=bool(self.spherical_On))
+        return jax.pure_callback(search, result_shape, self.index_id, input_pos)
+
+    def find_nodes(self, input_obs_batch):
+        """`find_node_pos` for one observation or a batch; uses the faiss index when `index_id` is set."""
+        if self.index_id is None:
+            if len(input_obs_batch.shape) == 1:
+                return self.find_node_pos(input_obs_batch)
+            return jax.vmap(self.find_node_pos)(input_obs_batch)
+        batched = len(input_obs_batch.shape) > 1
+        input_obs = input_obs_batch if batched else input_obs_batch[None]
+        distance, index = self.index_search(jax.vmap(self.normalize_input)(input_obs))
+        result = jax.vmap(self.select_node)(input_obs, distance, index)
+        return result if batched else jax.tree_util.tree_map(lambda x: x[0], result)
+
+    def plan_subgoal(self, state_rep, goal_rep):
+        """
+        Next key node on the shortest path from the key node of `state_rep` to that of `goal_rep` (jit-able).
+        Returns `(valid, subgoal)`; `valid` is False when the goal node is unreachable or already reached.
+        """
+        _, cur_node, _, _ = self.find_node_pos(state_rep)
+        _, goal_node, _, _ = self.find_node_pos(goal_rep)
+        next_node = self.next_hop[cur_node, goal_node]
+        valid = (next_node >= 0) & (cur_node != goal_node)
+        subgoal = self.pos[jnp.maximum(next_node, 0)]
+        if (self.flags.use_rep not in ["hiql_goal_encoder", "hilp_subgoal_encoder", "hilp_encoder", "vae_encoder"]) and (self.flags.specific_dim_On):
+            subgoal = jnp.concatenate([subgoal, goal_rep[subgoal.shape[-1]:]])
+        return valid, subgoal
+
+class KeyNodeArrays(KeyNodeLookup, flax.struct.PyTreeNode):
+    """
+    Key-node arrays as an explicit jit argument (see `KeyNode.lookup_arrays`).
+
+    Passed as a pytree instead of being closed over, so `find_closest_node` / `plan_subgoal` are traced once
+    per input shape per run; re-clustering only swaps the arrays (and, for a faiss index, `index_id`).
+    """
+    normalized_pos: jnp.ndarray
+    pos: jnp.ndarray
+    nodes: jnp.ndarray
+    scale_min: jnp.ndarray = None
+    scale_max: jnp.ndarray = None
+    next_hop: jnp.ndarray = None
+    index_id: jnp.ndarray = None
+    flags: Any = nonpytree_field(default=None)
+    env_name: str = nonpytree_field(default=None)
+    spherical_On: bool = nonpytree_field(default=False)
+
+@jax.jit
+@count_traces("find_closest_node")
+def find_closest_node(key_node_arrays: KeyNodeArrays, input_obs_batch: jnp.ndarray):
+    return key_node_arrays.find_nodes(input_obs_batch)
+
+@jax.jit
+@count_traces("plan_subgoal")
+def plan_subgoal(key_node_arrays: KeyNodeArrays, state_rep, goal_rep):
+    return key_node_arrays.plan_subgoal(state_rep, goal_rep)
+
+class KeyNode(KeyNodeLookup):
     def __init__(self,
                  obs: np.ndarray,
                  values: np.ndarray,
@@ -64,42 +312,175 @@ class KeyNode(object):
         self.reduced_f_s = None  
         self.weighted_values = None
         self.labels = None  
-        self.graph = None  
+        self.rep_labels = None
+        self.cluster_sizes = None
+        self.cluster_value_std = None
+        self.cluster_value_max = None
+        self.cluster_spread = None
+        self.store = None
+        self._graph = None
+        self.path_dist = None
+        self.next_hop = None
+        self.index = None
+        self.index_id = None
+        self.pos = None
         
         self.kmean_weight_On = flags.kmean_weight_On
 
-        self.find_nodes = jax.jit(jax.vmap(self.find_node_pos))
-        self.find_node = jax.jit(self.find_node_pos)        
+        self.reset_finders()
+
+    def reset_finders(self):
+        # construct_nodes / build_transition_graph가 pos, scale, next_hop을 바꾸면 KeyNodeArrays를 다시 만듦 (jit cache는 그대로 재사용)
+        self._lookup_arrays = None
+
+    @property
+    def lookup_arrays(self):
+        if self._lookup_arrays is None:
+            euclidean = not self.spherical_On
+            self._lookup_arrays = KeyNodeArrays(
+                normalized_pos=jnp.asarray(self.normalized_pos),
+                pos=self.pos,
+                nodes=self.nodes,
+                scale_min=jnp.asarray(self.scale_min) if euclidean else None,
+                scale_max=jnp.asarray(self.scale_max) if euclidean else None,
+                next_hop=self.next_hop,
+                index_id=None if self.index_id is None else jnp.asarray(self.index_id, dtype=jnp.int32),
+                flags=self.flags,
+                env_name=self.env_name,
+                spherical_On=self.spherical_On,
+            )
+        return self._lookup_arrays
+
+    def finder(self):
+        """`find_closest_node` with the current key nodes bound; compiles once per input shape per run (exact or faiss index)."""
+        return partial(find_closest_node, self.lookup_arrays)
+
+    def planner(self):
+        """`plan_subgoal` with the current key nodes and shortest paths bound."""
+        return partial(plan_subgoal, self.lookup_arrays)
+
+    @property
+    def graph(self):
+        # networkx graph는 시각화할 때만 store에서 생성
+        if self._graph is None and self.store is not None:
+            self._graph = self.store.to_networkx()
+        return self._graph
+
+    def construct_nodes(self, rep_observations=None, spherical_On=0.0, incremental=False, values=None, centroids=None):
+        """
+        Clusters the (rep) observations into key nodes.
+
+        incremental: warm-start k-means from the current key nodes and run `flags.keynode_incremental_iters`
+            iterations on a random subset of `flags.keynode_incremental_batch` rows, instead of the
+            two full passes with nredo=10 (falls back to them when there are no compatible key nodes yet).
+        values: replaces the per-row values used for weighting (e.g. recomputed returns).
+        centroids: key nodes in the original scale (e.g. restored from a checkpoint); used as they are
+            instead of running k-means. Labels and cluster statistics are still computed from the data.
+        """
+        if values is not None:
+            self.values = values
+        f_s = self.f_s if rep_observations is None else np.array(rep_observations)
+        init_centroids = None
+        if incremental and self.pos is not None and self.pos.shape[-1] == f_s.shape[-1]:
+            init_centroids = np.asarray(self.pos)
 
-    def construct_nodes(self, rep_observations=None, spherical_On=0.0):
         if rep_observations is None:
             # 0610 승호수정 spherical
-            self.reduced_f_s, self.weighted_values, self.labels = self.sparse_node(f_s=self.f_s, values=self.values, keynode_num=self.keynode_num, spherical_On=spherical_On)
-            self.graph = self.create_nodes(reduced_f_s=self.reduced_f_s, weighted_values=self.weighted_values)
+            self.reduced_f_s, self.weighted_values, self.labels = self.sparse_node(f_s=f_s, values=self.values, keynode_num=self.keynode_num, spherical_On=spherical_On, init_centroids=init_centroids, centroids=centroids)
+            reduced_f_s = self.reduced_f_s
         else:
-            self.rep_f_s = np.array(rep_observations) 
+            self.rep_f_s = f_s
             # 0610 승호수정 spherical
-            self.rep_reduced_f_s, self.rep_weighted_values, self.rep_labels = self.sparse_node(f_s=self.rep_f_s, values=self.values, keynode_num = self.keynode_num, spherical_On=spherical_On)
-            self.graph = self.create_nodes(reduced_f_s=self.rep_reduced_f_s, weighted_values=self.weighted_values)
+            self.rep_reduced_f_s, self.rep_weighted_values, self.rep_labels = self.sparse_node(f_s=self.rep_f_s, values=self.values, keynode_num = self.keynode_num, spherical_On=spherical_On, init_centroids=init_centroids, centroids=centroids)
+            reduced_f_s = self.rep_reduced_f_s
+
+        self.store = self.create_nodes(reduced_f_s=reduced_f_s, weighted_values=self.weighted_values)
+        self.reset_finders()
+
+    def warm_start_kmeans(self, f_s, values, keynode_num, init_centroids):
+        # 이전 key node에서 시작해서 subset에 대해 적은 iteration만 수행
+        d = f_s.shape[1]
+        batch_index = np.random.choice(len(f_s), min(len(f_s), self.flags.keynode_incremental_batch), replace=False)
+        f_s_batch = np.ascontiguousarray(np.asarray(f_s)[batch_index], dtype=np.float32)
+        kmeans = faiss.Kmeans(d, keynode_num, niter=self.flags.keynode_incremental_iters, verbose=False, gpu=True, nredo=1, seed=self.flags.seed, spherical=self.spherical_On)
+        if self.kmean_weight_On:
+            kmeans.train(f_s_batch, np.asarray(values)[batch_index].astype(np.float32), init_centroids.astype(np.float32))
+        else:
+            kmeans.train(f_s_batch, init_centroids=init_centroids.astype(np.float32))
+        return kmeans
 
     def sparse_node(self,
                     f_s: np.ndarray,
                     values: np.ndarray,
                     keynode_num : int,
-                    spherical_On : float):
-        niter = 1  
-        verbose = True 
+                    spherical_On : float,
+                    init_centroids : np.ndarray = None,
+                    centroids : np.ndarray = None):
         d = f_s.shape[1]
 
         # 0610 승호수정 spherical
         self.spherical_On = bool(spherical_On) 
         if self.spherical_On:
-            f_s = f_s / jnp.sqrt(d)
+            normalize = lambda x: x / np.sqrt(d)
         else:
             f_s_max, f_s_min = np.max(f_s, axis=0),  np.min(f_s, axis=0)
-            f_s = (f_s - f_s_min) / (f_s_max - f_s_min)
+            normalize = lambda x: (x - f_s_min) / (f_s_max - f_s_min)
             self.scale_min, self.scale_max  = f_s_min, f_s_max
         
+        if init_centroids is not None:
+            # 이전 key node (원래 스케일)를 새 normalize 공간으로 옮겨서 warm start
+            init_centroids = normalize(init_centroids)
+
+        if centroids is not None:
+            # 주어진 key node를 그대로 사용 (k-means 생략), search / labels는 MiniBatchKMeans로 계산
+            kmeans = kmeans_utils.MiniBatchKMeans(d, len(centroids), spherical=self.spherical_On, transform=normalize)
+            kmeans.centroids = np.asarray(normalize(np.asarray(centroids, dtype=np.float32)), dtype=np.float32)
+        elif self.flags.kmeans_backend == "minibatch":
+            # normalize는 batch / chunk 단위로 적용 (normalized dataset copy를 만들지 않음)
+            niter = self.flags.kmeans_iters if init_centroids is None else self.flags.keynode_incremental_iters
+            kmeans = kmeans_utils.MiniBatchKMeans(d, keynode_num, niter=niter, batch_size=self.flags.kmeans_batch_size, seed=self.flags.seed,
+                                                  spherical=self.spherical_On, transform=normalize)
+            kmeans.train(f_s, values if self.kmean_weight_On else None, init_centroids)
+        elif init_centroids is not None:
+            f_s = normalize(f_s)
+            kmeans = self.warm_start_kmeans(f_s, values, keynode_num, init_centroids)
+        else:
+            f_s = normalize(f_s)
+            kmeans = self.full_kmeans(f_s, values, keynode_num, spherical_On)
+        
+        reduced_f_s = kmeans.centroids
+        self.normalized_pos = reduced_f_s # 이때의 reduced_f_s 자체는 normalized된 상태
+        self.index = self.build_index(self.normalized_pos)
+        self.index_id = None
+        if self.index is not None:
+            self.index_id = next(_index_ids)
+            _indexed_keynodes[self.index_id] = self
+        
+        
+        # 0610 승호수정 spherical
+        if self.spherical_On:
+            reduced_f_s = reduced_f_s * np.sqrt(d) # reduced_f_s 원래 스케일로 복원
+        else:
+            reduced_f_s = reduced_f_s * (f_s_max - f_s_min) + f_s_min # reduced_f_s 원래 스케일로 복원
+        if centroids is not None:
+            reduced_f_s = np.asarray(centroids, dtype=np.float32) # normalize 왕복 오차 없이 그대로
+        
+        D, I = kmeans.index.search(f_s, 1) 
+        labels = I[:, 0] # I: f_s의 각 요소(노드)에 대해 가장 가까운 centroid의 인덱스
+        stats = self.cluster_statistics(labels, values, distances=D[:, 0], num_clusters=len(reduced_f_s))
+        weighted_values = stats['weighted_values']
+        self.cluster_sizes = stats['cluster_sizes']
+        self.cluster_value_std = stats['cluster_value_std']
+        self.cluster_value_max = stats['cluster_value_max']
+        self.cluster_spread = stats['cluster_spread']
+        
+        print(f"Offline Dataset => Clustered Nodes  /   {len(f_s)} => {len(reduced_f_s)}")
+        return reduced_f_s, weighted_values, labels
+
+    def full_kmeans(self, f_s, values, keynode_num, spherical_On):
+        niter = 1  
+        verbose = True 
+        d = f_s.shape[1]
         # 0610 승호수정 spherical
         kmeans = faiss.Kmeans(d, int(np.sqrt(f_s.shape[-1]))*keynode_num, niter=niter, verbose=verbose, gpu=True, nredo=10, seed=self.flags.seed, spherical=self.spherical_On)
         kmeans.train(f_s, values) if self.kmean_weight_On else kmeans.train(f_s) # 질문 학습 전체 배치 한번에 수행하는거 아닌지? (배치단위로 수행한다하지 않았나?)
@@ -118,108 +499,133 @@ class KeyNode(object):
         kmeans = faiss.Kmeans(d, keynode_num, niter=niter, verbose=verbose, gpu=True, nredo=10, seed=self.flags.seed, spherical=bool(spherical_On))
         kmeans.train(f_s, values, initial_centroid) if self.kmean_weight_On else kmeans.train(f_s) # 질문 학습 전체 배치 한번에 수행하는거 아닌지? (배치단위로 수행한다하지 않았나?)
   
-        reduced_f_s = kmeans.centroids
-        self.normalized_pos = reduced_f_s # 이때의 reduced_f_s 자체는 normalized된 상태
-        
-        
-        # 0610 승호수정 spherical
-        if self.spherical_On:
-            reduced_f_s = reduced_f_s * np.sqrt(d) # reduced_f_s 원래 스케일로 복원
-        else:
-            reduced_f_s = reduced_f_s * (f_s_max - f_s_min) + f_s_min # reduced_f_s 원래 스케일로 복원
-        
-        _, I = kmeans.index.search(f_s, 1) 
-        labels = I[:, 0] # I: f_s의 각 요소(노드)에 대해 가장 가까운 centroid의 인덱스
-        weighted_values = self.calculate_weighted_values(labels, values)  
-        
-        print(f"Offline Dataset => Clustered Nodes  /   {len(f_s)} => {len(reduced_f_s)}")
-        return reduced_f_s, weighted_values, labels
+        return kmeans
+
+    def cluster_statistics(self,
+                           labels: np.ndarray,
+                           values: np.ndarray,
+                           distances: np.ndarray = None,
+                           num_clusters: int = None):
+        """
+        Per-cluster statistics in one pass over `labels` (every array has one entry per key node).
+
+        weighted_values: mean value, cluster_sizes: number of rows, cluster_value_std / cluster_value_max:
+        spread and best value, cluster_spread: mean search distance to the centroid (squared L2, or inner
+        product when spherical). Empty clusters get 0 everywhere.
+        """
+        num_clusters = self.keynode_num if num_clusters is None else num_clusters
+        values = np.asarray(values, dtype=np.float64)
+        cluster_sizes = np.bincount(labels, minlength=num_clusters)
+        counts = np.maximum(cluster_sizes, 1)
+        value_mean = np.bincount(labels, weights=values, minlength=num_clusters) / counts
+        value_sq_mean = np.bincount(labels, weights=values ** 2, minlength=num_clusters) / counts
+        value_max = np.full(num_clusters, -np.inf)
+        np.maximum.at(value_max, labels, values)
+        value_max[cluster_sizes == 0] = 0.
+        stats = dict(
+            weighted_values=value_mean,
+            cluster_sizes=cluster_sizes,
+            cluster_value_std=np.sqrt(np.maximum(value_sq_mean - value_mean ** 2, 0.)),
+            cluster_value_max=value_max,
+            cluster_spread=None,
+        )
+        if distances is not None:
+            stats['cluster_spread'] = np.bincount(labels, weights=np.asarray(distances, dtype=np.float64), minlength=num_clusters) / counts
+        return stats
 
     def calculate_weighted_values(self,
                                   labels: np.ndarray,
                                   values: np.ndarray):
-        unique_labels = np.unique(labels)
-        weighted_values = np.zeros(len(labels)) 
-        
-        # 질문 이 코드대로라면 weighted_values에는 0인값이 대부분채워질텐데? 이렇게 사용하는것을 추구한게 맞나? (딕셔너리로 구현하는게 맞지 않을까?)
-        for i, unique_label in enumerate(unique_labels):
-            cluster_values_sum = np.sum(values[labels == unique_label])  
-            cluster_size = np.sum(labels == unique_label)  
-            weighted_values[unique_label] = cluster_values_sum / cluster_size  
-
-        return weighted_values
+        # cluster별 평균 value (key node 수 크기)
+        return self.cluster_statistics(labels, values)['weighted_values']
     
     def create_nodes(self,
                      reduced_f_s: np.ndarray,
                      weighted_values: np.ndarray):
-        graph = nx.DiGraph()
-        for i, pos in enumerate(reduced_f_s):
-            graph.add_node(i, pos=pos, weighted_value=weighted_values[i])  
-        nodes = []
-        pos = []
-        for node, data in graph.nodes(data=True):
-            nodes.append(node)
-            pos.append(data['pos'])
-        self.nodes = jnp.array(nodes)
-        self.pos = jnp.array(pos)
-        
-        return graph    
+        store = KeyNodeStore(pos=np.asarray(reduced_f_s), weighted_values=np.asarray(weighted_values), cluster_sizes=self.cluster_sizes)
+        self._graph = None
+        self.path_dist, self.next_hop = None, None
+        self.nodes = jnp.arange(store.num_nodes)
+        self.pos = jnp.asarray(store.pos)
+        return store
     
-    def find_node_pos(self, input_obs):
-        node_dim = self.flags.keynode_dim # rep 은 모든 dim 사용
-        
-        # 0610 승호수정 spherical
-        if self.spherical_On:
-            input_pos = input_obs / jnp.sqrt(node_dim)
-        else:
-            input_pos = (input_obs - self.scale_min) / (self.scale_max - self.scale_min)       
-             
-        if self.flags.specific_dim_On:
-            if 'ant' in self.env_name:
-                input_pos = input_obs[:2] 
-                node_dim = 2
-            elif 'kitchen' in self.env_name:
-                input_pos = input_obs[:9] 
-                node_dim = 9
-            elif 'calvin' in self.env_name:
-                input_pos = input_obs[:15] 
-                node_dim = 15
+    def build_transition_graph(self, labels, dones, weight_type="steps"):
+        """Adds transition edges (from `labels` of consecutive dataset rows) and all-pairs shortest paths."""
+        self.store.indptr, self.store.indices, self.store.edge_weights = transition_edges(labels, dones, self.store.num_nodes, weight_type=weight_type)
+        self.path_dist, self.next_hop = all_pairs_shortest_paths(self.store.indptr, self.store.indices, self.store.edge_weights)
+        self._graph = None
+        self.reset_finders()
+        print(f"Key node graph: {self.store.num_nodes} nodes, {len(self.store.indices)} edges")
 
-        # 0610 승호수정 spherical
-        if self.spherical_On:
-            cosine_similarity = jnp.dot(self.normalized_pos, input_pos.T)
-            if self.flags.mapping_method in ["nearest"]:
-                index = jnp.argmax(cosine_similarity)
-                distance=cosine_similarity
-            else:
-                raise ValueError(f"Unsupported mapping_method: {self.flags.mapping_method}")
+    def build_index(self, normalized_pos):
+        # keynode_index: exact (brute force, jnp) / ivf / hnsw (faiss CPU index, normalized_pos 기준)
+        self.index_type = self.flags.keynode_index
+        if self.index_type == "exact":
+            return None
+        d = normalized_pos.shape[1]
+        normalized_pos = np.ascontiguousarray(normalized_pos, dtype=np.float32)
+        metric = faiss.METRIC_INNER_PRODUCT if self.spherical_On else faiss.METRIC_L2
+        if self.index_type == "ivf":
+            nlist = max(1, int(np.sqrt(len(normalized_pos))))
+            quantizer = faiss.IndexFlatIP(d) if self.spherical_On else faiss.IndexFlatL2(d)
+            index = faiss.IndexIVFFlat(quantizer, d, nlist, metric)
+            index.train(normalized_pos)
+            index.nprobe = min(nlist, self.flags.keynode_index_nprobe)
+        elif self.index_type == "hnsw":
+            index = faiss.IndexHNSWFlat(d, 32, metric)
         else:
-            distance = jnp.linalg.norm(self.normalized_pos - input_pos, axis=1)
-            if self.flags.mapping_method in ["nearest", "center"]:
-                index = jnp.argmin(distance)
-            elif self.flags.mapping_method in ["triple"]:
-                index = jnp.argsort(distance)
-                first, second = index[:2]
-        
-        if self.flags.mapping_method == "nearest":
-            cur_obs_key_node = self.pos[index]
-        elif self.flags.mapping_method == "center":
-            cur_obs_key_node = (self.pos[index] + input_obs) / 2
-        elif self.flags.mapping_method == "triple":
-            cur_obs_key_node = (self.pos[first] + self.pos[second] + input_obs) / 3
-            
-        if (self.flags.use_rep not in ["hiql_goal_encoder", "hilp_subgoal_encoder", "hilp_encoder", "vae_encoder"]) and (self.flags.specific_dim_On):
-            cur_obs_key_node = jnp.concatenate([cur_obs_key_node, input_obs[node_dim:]])
-                            
-        return distance[index], self.nodes[index], self.pos[index], cur_obs_key_node  # 현재 코드에서는 4번쨰 closest_node_observations만 사용
+            raise ValueError(f"Unsupported keynode_index: {self.index_type}")
+        index.add(normalized_pos)
+        return index
 
     def find_closest_node(self, input_obs_batch: jnp.ndarray):
-        if len(input_obs_batch.shape) == 1:
-            closest_distances, closest_nodes, closest_node_positions, closest_node_observations = self.find_node(input_obs_batch)
-        else:
-            closest_distances, closest_nodes, closest_node_positions, closest_node_observations = self.find_nodes(input_obs_batch)
+        closest_distances, closest_nodes, closest_node_positions, closest_node_observations = find_closest_node(self.lookup_arrays, input_obs_batch)
         return closest_distances, closest_nodes, closest_node_positions, closest_node_observations # 현재 코드에서는 4번쨰 closest_node_observations만 사용
         
+    @property
+    def labels_reusable(self):
+        # faiss labels == find_closest_node 결과인 경우: nearest mapping, euclidean, node dim 그대로 (specific_dim concat 없음)
+        return self.flags.mapping_method == "nearest" and not self.spherical_On and not self.flags.specific_dim_On
+
+    def assign_nodes(self, input_obs, chunk_size=65536, labels=None):
+        """
+        Key-node observation (4th output of `find_closest_node`) for every row of `input_obs`.
+
+        Rows are processed in fixed-size chunks (the last one padded), so only one (chunk_size x keynode_num)
+        distance block is live and the jitted finder compiles once. The next chunk is dispatched before the
+        previous result is copied into the preallocated output. With `labels` (faiss labels of exactly these
+        rows, see `labels_reusable`) no search is run at all.
+        """
+        if labels is not None:
+            assert self.labels_reusable and len(labels) == len(input_obs)
+            return np.asarray(self.pos)[labels]
+
+        num_rows = len(input_obs)
+        chunk_size = min(chunk_size, num_rows)
+        key_node = None
+        pending = None
+        finder = self.finder()
+
+        def write(start, valid, result):
+            nonlocal key_node
+            result = np.asarray(result)
+            if key_node is None:
+                key_node = np.empty((num_rows, *result.shape[1:]), dtype=result.dtype)
+            key_node[start:start + valid] = result[:valid]
+
+        for start in range(0, num_rows, chunk_size):
+            chunk = np.asarray(input_obs[start:start + chunk_size])
+            valid = len(chunk)
+            if valid < chunk_size:
+                chunk = np.concatenate([chunk, np.repeat(chunk[-1:], chunk_size - valid, axis=0)])
+            _, _, _, result = finder(jnp.asarray(chunk))
+            if pending is not None:
+                write(*pending)
+            pending = (start, valid, result)
+        if pending is not None:
+            write(*pending)
+        return key_node
+
     def visualize_key_nodes(self, flags, node_colors="value_color", figsize=(27, 21), node_size=500, label_size=2, dpi=300 ):
         import time
         t = time.strftime('%m-%d_%H:%M')
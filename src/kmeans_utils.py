@@ -0,0 +1,131 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class MiniBatchKMeans(object):
+    """
+    Weighted mini-batch k-means (Sculley, 2010) with k-means++ initialization, in NumPy.
+
+    Mirrors the part of the `faiss.Kmeans` API that `KeyNode` uses (`train`, `centroids`, `index.search`),
+    so it can replace faiss on hosts without faiss-gpu. Data is read in mini-batches / fixed-size chunks
+    and `transform` (e.g. the KeyNode normalization) is applied per chunk, so no normalized copy of the
+    dataset is held. Nearest-centroid search over chunks runs on a thread pool (NumPy releases the GIL).
+
+    spherical: centroids are kept at unit L2 norm and points are assigned by inner product.
+
+    Example:
+        kmeans = MiniBatchKMeans(d, 1000, niter=100, seed=0, transform=normalize)
+        kmeans.train(f_s, weights=values)
+        D, I = kmeans.index.search(f_s, 1)
+    """
+
+    def __init__(self, d, k, niter=100, batch_size=4096, seed=0, spherical=False, transform=None,
+                 chunk_size=65536, num_threads=None, init_size=None):
+        self.d = d
+        self.k = k
+        self.niter = niter
+        self.batch_size = batch_size
+        self.spherical = spherical
+        self.transform = transform
+        self.chunk_size = chunk_size
+        self.num_threads = num_threads or os.cpu_count()
+        self.init_size = init_size or max(3 * k, batch_size)
+        self.np_random = np.random.RandomState(seed)
+        self.centroids = None
+        self.index = self
+
+    def _prepare(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self.transform is not None:
+            x = np.asarray(self.transform(x), dtype=np.float32)
+        return x
+
+    def _normalize_centroids(self):
+        if self.spherical:
+            self.centroids /= np.maximum(np.linalg.norm(self.centroids, axis=1, keepdims=True), 1e-12)
+
+    def _distances(self, x):
+        """Squared L2 distance (or negated inner product when spherical) of each row of `x` to every centroid."""
+        scores = x @ self.centroids.T
+        if self.spherical:
+            return -scores
+        return np.maximum((x ** 2).sum(1, keepdims=True) - 2 * scores + (self.centroids ** 2).sum(1)[None], 0)
+
+    def _assign(self, x):
+        distances = self._distances(x)
+        labels = distances.argmin(1)
+        return labels, distances[np.arange(len(x)), labels]
+
+    def kmeans_plus_plus(self, x, weights=None):
+        """Weighted k-means++ seeding (D^2 sampling) on `x`."""
+        weights = np.ones(len(x), dtype=np.float64) if weights is None else np.asarray(weights, dtype=np.float64)
+        probs = weights / weights.sum()
+        centroids = np.empty((self.k, x.shape[1]), dtype=np.float32)
+        centroids[0] = x[self.np_random.choice(len(x), p=probs)]
+        closest = ((x - centroids[0]) ** 2).sum(1)
+        for c in range(1, self.k):
+            potential = weights * closest
+            if potential.sum() <= 0:
+                centroids[c] = x[self.np_random.choice(len(x), p=probs)]
+            else:
+                centroids[c] = x[self.np_random.choice(len(x), p=potential / potential.sum())]
+            closest = np.minimum(closest, ((x - centroids[c]) ** 2).sum(1))
+        return centroids
+
+    def train(self, x, weights=None, init_centroids=None):
+        n = len(x)
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64)
+            # k-means weights must be positive; rows with zero weight still need to be reachable by sampling
+            weights = np.maximum(weights, 1e-6 * max(weights.max(), 1e-12))
+
+        if init_centroids is not None:
+            self.centroids = np.array(init_centroids, dtype=np.float32)
+        else:
+            init_index = np.sort(self.np_random.choice(n, min(n, self.init_size), replace=False))
+            self.centroids = self.kmeans_plus_plus(self._prepare(x[init_index]), None if weights is None else weights[init_index])
+        self._normalize_centroids()
+
+        counts = np.zeros(self.k, dtype=np.float64)
+        for _ in range(self.niter):
+            batch_index = np.sort(self.np_random.choice(n, min(n, self.batch_size), replace=False))
+            batch = self._prepare(x[batch_index])
+            batch_weights = np.ones(len(batch_index)) if weights is None else weights[batch_index]
+            labels, _ = self._assign(batch)
+
+            # per-centroid weighted sums of the batch, then a step of size (batch weight / total weight seen)
+            batch_counts = np.bincount(labels, weights=batch_weights, minlength=self.k)
+            batch_sums = np.zeros((self.k, self.d), dtype=np.float64)
+            np.add.at(batch_sums, labels, batch * batch_weights[:, None])
+            counts += batch_counts
+            updated = batch_counts > 0
+            step = (batch_counts[updated] / counts[updated])[:, None]
+            batch_means = batch_sums[updated] / batch_counts[updated][:, None]
+            self.centroids[updated] = ((1 - step) * self.centroids[updated] + step * batch_means).astype(np.float32)
+            self._normalize_centroids()
+        return self
+
+    def search(self, x, k=1):
+        """Nearest `k` centroids of every row of `x`, as `(D, I)` like a faiss index (D: squared L2 / inner product)."""
+        n = len(x)
+        D = np.empty((n, k), dtype=np.float32)
+        I = np.empty((n, k), dtype=np.int64)
+
+        def search_chunk(start):
+            chunk = self._prepare(x[start:start + self.chunk_size])
+            distances = self._distances(chunk)
+            if k == 1:
+                index = distances.argmin(1)[:, None]
+            else:
+                index = np.argpartition(distances, k - 1, axis=1)[:, :k]
+                order = np.take_along_axis(distances, index, axis=1).argsort(1)
+                index = np.take_along_axis(index, order, axis=1)
+            distance = np.take_along_axis(distances, index, axis=1)
+            D[start:start + len(chunk)] = -distance if self.spherical else distance
+            I[start:start + len(chunk)] = index
+
+        with ThreadPoolExecutor(self.num_threads) as executor:
+            list(executor.map(search_chunk, range(0, n, self.chunk_size)))
+        return D, I
@@ -8,39 +8,43 @@ class LayerNormMLP(nn.Module):
     activations: Callable[[jnp.ndarray], jnp.ndarray] = nn.gelu
     activate_final: int = False
     kernel_init: Callable[[PRNGKey, Shape, Dtype], Array] = default_init()
+    dtype: Dtype = jnp.float32
 
     @nn.compact
     def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
         for i, size in enumerate(self.hidden_dims):
-            x = nn.Dense(size, kernel_init=self.kernel_init)(x)
+            x = nn.Dense(size, kernel_init=self.kernel_init, dtype=self.dtype)(x)
             if i + 1 < len(self.hidden_dims) or self.activate_final:                
                 x = self.activations(x)
-                x = nn.LayerNorm()(x)
+                # LayerNorm 통계는 float32로 계산
+                x = nn.LayerNorm(dtype=jnp.float32)(x).astype(self.dtype)
         return x
     
 class LayerNormRepresentation(nn.Module):
     hidden_dims: tuple = (256, 256)
     activate_final: bool = True
     ensemble: bool = True
+    dtype: Dtype = jnp.float32
 
     @nn.compact
     def __call__(self, observations):
         module = LayerNormMLP
         if self.ensemble:
             module = ensemblize(module, 2)
-        return module(self.hidden_dims, activate_final=self.activate_final)(observations)
+        return module(self.hidden_dims, activate_final=self.activate_final, dtype=self.dtype)(observations).astype(jnp.float32)
 
 class Representation(nn.Module):
     hidden_dims: tuple = (256, 256)
     activate_final: bool = True
     ensemble: bool = True
+    dtype: Dtype = jnp.float32
 
     @nn.compact
     def __call__(self, observations):
         module = MLP
         if self.ensemble:
             module = ensemblize(module, 2)
-        return module(self.hidden_dims, activate_final=self.activate_final, activations=nn.gelu)(observations)
+        return module(self.hidden_dims, activate_final=self.activate_final, activations=nn.gelu, dtype=self.dtype)(observations).astype(jnp.float32)
     
 class RelativeRepresentation(nn.Module):
     rep_dim: int = 256
@@ -50,6 +54,7 @@ class RelativeRepresentation(nn.Module):
     layer_norm: bool = False
     rep_type: str = 'concat' 
     bottleneck: bool = True  # Meaning that we're using this representation for high-level actions
+    dtype: Dtype = jnp.float32
 
     @nn.compact
     def __call__(self, targets, bases=None):
@@ -68,9 +73,10 @@ class RelativeRepresentation(nn.Module):
         if self.visual:
             inputs = self.module()(inputs)
         if self.layer_norm:
-            rep = LayerNormMLP(self.hidden_dims, activate_final=not self.bottleneck, activations=nn.gelu)(inputs)
+            rep = LayerNormMLP(self.hidden_dims, activate_final=not self.bottleneck, activations=nn.gelu, dtype=self.dtype)(inputs)
         else:
-            rep = MLP(self.hidden_dims, activate_final=not self.bottleneck, activations=nn.gelu)(inputs)
+            rep = MLP(self.hidden_dims, activate_final=not self.bottleneck, activations=nn.gelu, dtype=self.dtype)(inputs)
+        rep = rep.astype(jnp.float32)
 
         if self.bottleneck:
             rep = rep / jnp.linalg.norm(rep, axis=-1, keepdims=True) * jnp.sqrt(self.rep_dim)
@@ -83,10 +89,11 @@ class MonolithicVF(nn.Module):
     use_layer_norm: bool = True
     # rep_dim: int = None
     obs_rep: int = 0
+    dtype: Dtype = jnp.float32
 
     def setup(self) -> None:
         repr_class = LayerNormRepresentation if self.use_layer_norm else Representation
-        self.value_net = repr_class((*self.hidden_dims, 1), activate_final=False)
+        self.value_net = repr_class((*self.hidden_dims, 1), activate_final=False, dtype=self.dtype)
 
     def __call__(self, observations, goals=None, info=False):
         phi = observations
@@ -107,10 +114,11 @@ class HILP_GoalConditionedPhiValue(nn.Module):
     use_layer_norm: bool = True
     ensemble: bool = True
     encoder: nn.Module = None # False
+    dtype: Dtype = jnp.float32
 
     def setup(self) -> None:
         repr_class = LayerNormRepresentation if self.use_layer_norm else Representation
-        phi = repr_class((*self.hidden_dims, self.skill_dim), activate_final=False, ensemble=self.ensemble)
+        phi = repr_class((*self.hidden_dims, self.skill_dim), activate_final=False, ensemble=self.ensemble, dtype=self.dtype)
         # If HILP on visual-kitchen-partial impala_small; else None # if self.encoder is not None: # phi = nn.Sequential([self.encoder(), phi])
         self.phi = phi
 
@@ -130,14 +138,15 @@ class Vae_Encoder(nn.Module):
     activations: Callable[[jnp.ndarray], jnp.ndarray] = nn.gelu
     layer_norm : bool = False
     kernel_init: Callable[[PRNGKey, Shape, Dtype], Array] = default_init()
+    dtype: Dtype = jnp.float32
     
     @nn.compact
     def __call__(self, x: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
         for i, size in enumerate(self.hidden_dim):
-            x = nn.Dense(size, kernel_init = self.kernel_init)(x)
+            x = nn.Dense(size, kernel_init = self.kernel_init, dtype=self.dtype)(x)
             x = self.activations(x)
-        mean = nn.Dense(self.rep_dim, kernel_init = self.kernel_init)(x)
-        log_stddev = nn.Dense(self.rep_dim, kernel_init = self.kernel_init)(x)
+        mean = nn.Dense(self.rep_dim, kernel_init = self.kernel_init, dtype=self.dtype)(x).astype(jnp.float32)
+        log_stddev = nn.Dense(self.rep_dim, kernel_init = self.kernel_init, dtype=self.dtype)(x).astype(jnp.float32)
         stddev = jnp.exp(log_stddev)
         z = mean
         return z, mean, stddev
@@ -148,16 +157,17 @@ class Vae_Decoder(nn.Module):
     activations: Callable[[jnp.ndarray], jnp.ndarray] = nn.gelu
     layer_norm : bool = False
     kernel_init: Callable[[PRNGKey, Shape, Dtype], Array] = default_init()
+    dtype: Dtype = jnp.float32
 
     @nn.compact
     def __call__(self, x: jnp.ndarray) -> jnp.ndarray:
         for i, size in enumerate(self.hidden_dim):
-            x = nn.Dense(size, kernel_init = self.kernel_init)(x)
+            x = nn.Dense(size, kernel_init = self.kernel_init, dtype=self.dtype)(x)
             x = self.activations(x)
         if self.layer_norm:
-            x = nn.LayerNorm()(x)
-        output = nn.Dense(self.output_shape, kernel_init = self.kernel_init)(x)
-        return output
+            x = nn.LayerNorm(dtype=jnp.float32)(x)
+        output = nn.Dense(self.output_shape, kernel_init = self.kernel_init, dtype=self.dtype)(x)
+        return output.astype(jnp.float32)
 
 def get_rep(
         encoder: nn.Module, targets: jnp.ndarray, bases: jnp.ndarray = None,